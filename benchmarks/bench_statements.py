@@ -0,0 +1,112 @@
+"""Micro benchmark: plain, commented and prepared execution of the services' fixed queries.
+
+Runs each query against a throwaway local Postgres on one connection, the
+way one pooled connection serves requests, and reports per-statement
+latency for three modes:
+
+    plain      cursor.execute with the query text
+    commented  cursor.execute with a per-request sqlcommenter-style comment
+    prepared   tracey_common.statements.Statement (PREPARE once, then EXECUTE)
+
+    python benchmarks/bench_statements.py --iterations 5000 --output statements.json
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+import psycopg2
+
+from local_postgres import REPO_ROOT, LocalPostgres
+
+sys.path.insert(0, REPO_ROOT)
+# The prepared mode must really prepare, whatever the caller's environment says
+os.environ["PREPARED_STATEMENTS"] = "true"
+from tracey_common.statements import Statement  # noqa: E402
+
+QUERIES = {
+    "select_stock": ("SELECT stock_quantity FROM stock WHERE warehouse_id = %s AND product = %s;", lambda i: (1, "chairs")),
+    "adjust_stock": (
+        "UPDATE stock AS s SET stock_quantity = s.stock_quantity + r.delta "
+        "FROM unnest(%s::varchar[], %s::integer[]) AS r(product, delta) "
+        "WHERE s.warehouse_id = %s AND s.product = r.product "
+        "RETURNING s.product, s.stock_quantity, s.stock_quantity < s.reorder_threshold;",
+        lambda i: (["chairs"], [1 if i % 2 else -1], 1),
+    ),
+    "insert_order": (
+        "INSERT INTO orders (warehouse_id, cupboards, computers, chairs, desks) VALUES (%s, %s, %s, %s, %s) "
+        "RETURNING order_id;",
+        lambda i: (1, i % 5, 1, 2, 3),
+    ),
+    "fetch_unprocessed_orders": (
+        "SELECT order_id, warehouse_id, cupboards, computers, chairs, desks FROM orders "
+        "WHERE is_processed = FALSE AND order_id > %s AND (warehouse_id = ANY(%s)) = %s ORDER BY order_id LIMIT %s;",
+        lambda i: (0, [], False, 100),
+    ),
+}
+
+
+def commented(sql, i):
+    # What sqlcommenter appends: a traceparent that differs on every request
+    traceparent = f"00-{i:032x}-{i:016x}-01"
+    return sql.rstrip(";") + f" /*db_driver='psycopg2',traceparent='{traceparent}'*/;"
+
+
+def run_mode(conn, mode, name, sql, params, iterations):
+    statement = Statement(f"bench_{name}", sql)
+    latencies = []
+    counter = itertools.count()
+    with conn.cursor() as cursor:
+        for _ in range(iterations):
+            i = next(counter)
+            start = time.perf_counter()
+            if mode == "prepared":
+                statement.execute(cursor, params(i))
+            elif mode == "commented":
+                cursor.execute(commented(sql, i), params(i))
+            else:
+                cursor.execute(sql, params(i))
+            cursor.fetchall()
+            conn.commit()
+            latencies.append(time.perf_counter() - start)
+        if mode == "prepared":
+            cursor.execute(f"DEALLOCATE bench_{name};")
+            conn.commit()
+    latencies.sort()
+    return {
+        "ops_per_second": round(iterations / sum(latencies), 1),
+        "mean_us": round(1e6 * sum(latencies) / iterations, 1),
+        "p50_us": round(1e6 * latencies[iterations // 2], 1),
+        "p99_us": round(1e6 * latencies[min(iterations - 1, int(iterations * 0.99))], 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--modes", default="plain,commented,prepared")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = {}
+    with LocalPostgres() as postgres:
+        conn = psycopg2.connect(host="127.0.0.1", port=postgres.port, dbname=postgres.dbname, user=postgres.user)
+        try:
+            for name, (sql, params) in QUERIES.items():
+                results[name] = {}
+                for mode in args.modes.split(","):
+                    result = run_mode(conn, mode, name, sql, params, args.iterations)
+                    results[name][mode] = result
+                    print(f"{name:<26} {mode:<10} {result['ops_per_second']:>10.1f} ops/s  "
+                          f"mean {result['mean_us']:>8.1f} us  p50 {result['p50_us']:>8.1f} us  "
+                          f"p99 {result['p99_us']:>8.1f} us", flush=True)
+        finally:
+            conn.close()
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"iterations": args.iterations, "results": results}, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
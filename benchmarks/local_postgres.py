@@ -0,0 +1,94 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIGMAP = os.path.join(REPO_ROOT, "tracey-database", "postgresql-configmap.yaml")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def init_sql(key="init.sql"):
+    """A script from the postgresql-init ConfigMap, the schema and seed data by default, so benchmarks use the deployed schema."""
+    lines = []
+    in_block = False
+    with open(CONFIGMAP) as configmap:
+        for line in configmap:
+            if line.strip() == f"{key}: |":
+                in_block = True
+                continue
+            if in_block:
+                if line.strip() and not line.startswith("    "):
+                    break
+                lines.append(line[4:])
+    return "".join(lines)
+
+
+def find_bindir():
+    """Locate initdb/pg_ctl/psql from PG_BIN, pg_config or PATH."""
+    if os.environ.get("PG_BIN"):
+        return os.environ["PG_BIN"]
+    if shutil.which("pg_config"):
+        bindir = subprocess.run(["pg_config", "--bindir"], capture_output=True, text=True).stdout.strip()
+        if os.path.exists(os.path.join(bindir, "initdb")):
+            return bindir
+    initdb = shutil.which("initdb")
+    if initdb:
+        return os.path.dirname(initdb)
+    raise RuntimeError("Cannot find initdb; install PostgreSQL or set PG_BIN to its bin directory")
+
+
+class LocalPostgres:
+    """A throwaway Postgres cluster in a temporary directory, loaded with the project schema."""
+
+    def __init__(self, dbname="mydatabase", user="user", port=None):
+        self.dbname = dbname
+        self.user = user
+        self.port = port or free_port()
+        self.bindir = find_bindir()
+        self.datadir = None
+        self._tmp = None
+
+    def _run(self, *args, **kwargs):
+        subprocess.run([os.path.join(self.bindir, args[0]), *args[1:]], check=True,
+                       stdout=subprocess.DEVNULL, **kwargs)
+
+    def start(self):
+        self._tmp = tempfile.mkdtemp(prefix="tracey-bench-pg-")
+        self.datadir = os.path.join(self._tmp, "data")
+        self._run("initdb", "-D", self.datadir, "-U", self.user, "--auth=trust", "-E", "UTF8")
+        options = f"-p {self.port} -k {self._tmp} -c listen_addresses=127.0.0.1 -c max_connections=300"
+        self._run("pg_ctl", "-D", self.datadir, "-o", options, "-l", os.path.join(self._tmp, "postgres.log"),
+                  "-w", "start")
+        self._run("createdb", "-h", "127.0.0.1", "-p", str(self.port), "-U", self.user, self.dbname)
+        # In the order /docker-entrypoint-initdb.d runs them; upgrade.sql is a no-op on a new database
+        self.psql(init_sql())
+        self.psql(init_sql("upgrade.sql"))
+        return self
+
+    def psql(self, sql):
+        self._run("psql", "-h", "127.0.0.1", "-p", str(self.port), "-U", self.user, "-d", self.dbname,
+                  "-v", "ON_ERROR_STOP=1", "-q", input=sql.encode(), stderr=subprocess.PIPE)
+
+    def stop(self):
+        if self.datadir:
+            subprocess.run([os.path.join(self.bindir, "pg_ctl"), "-D", self.datadir, "-m", "fast", "-w", "stop"],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if self._tmp:
+            shutil.rmtree(self._tmp, ignore_errors=True)
+
+    def env(self):
+        """Environment variables pointing a service at this cluster."""
+        return {"DB_HOST": "127.0.0.1", "DB_PORT": str(self.port), "DB_NAME": self.dbname, "DB_USER": self.user}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,89 @@
+import threading
+from concurrent import futures
+import grpc
+from opentelemetry.proto.collector.metrics.v1 import metrics_service_pb2, metrics_service_pb2_grpc
+from opentelemetry.proto.collector.trace.v1 import trace_service_pb2, trace_service_pb2_grpc
+
+
+class CountingTraceService(trace_service_pb2_grpc.TraceServiceServicer):
+    """OTLP/gRPC trace receiver that counts spans per service.name and discards them."""
+
+    def __init__(self):
+        self.spans = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def Export(self, request, context):
+        counts = {}
+        for resource_spans in request.resource_spans:
+            service = "unknown"
+            for attribute in resource_spans.resource.attributes:
+                if attribute.key == "service.name":
+                    service = attribute.value.string_value
+            counts[service] = counts.get(service, 0) + sum(
+                len(scope_spans.spans) for scope_spans in resource_spans.scope_spans)
+        with self._lock:
+            self.requests += 1
+            for service, count in counts.items():
+                self.spans[service] = self.spans.get(service, 0) + count
+        return trace_service_pb2.ExportTraceServiceResponse()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.spans)
+
+
+class CountingMetricsService(metrics_service_pb2_grpc.MetricsServiceServicer):
+    """OTLP/gRPC metrics receiver that counts export requests and discards them.
+
+    Without it metric exports fail with UNIMPLEMENTED and the exporter's
+    retries add load that is not part of the service being measured.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def Export(self, request, context):
+        with self._lock:
+            self.requests += 1
+        return metrics_service_pb2.ExportMetricsServiceResponse()
+
+
+class StubCollector:
+    """In-process stand-in for the node-local OpenTelemetry collector."""
+
+    def __init__(self, port=0):
+        self.service = CountingTraceService()
+        self.metrics_service = CountingMetricsService()
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+        trace_service_pb2_grpc.add_TraceServiceServicer_to_server(self.service, self.server)
+        metrics_service_pb2_grpc.add_MetricsServiceServicer_to_server(self.metrics_service, self.server)
+        self.port = self.server.add_insecure_port(f"127.0.0.1:{port}")
+
+    @property
+    def endpoint(self):
+        return f"127.0.0.1:{self.port}"
+
+    def start(self):
+        self.server.start()
+        return self
+
+    def stop(self):
+        self.server.stop(grace=1)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import time
+    with StubCollector(port=4317) as collector:
+        print(f"Stub OTLP collector listening on {collector.endpoint}")
+        while True:
+            time.sleep(10)
+            print(f"Spans received: {collector.service.snapshot()}, "
+                  f"metric exports received: {collector.metrics_service.requests}")
@@ -0,0 +1,423 @@
+"""Offline benchmarks for order-processor and stock-controller.
+
+Starts each service against a throwaway local Postgres and a stub OTLP
+collector, drives every endpoint with closed-loop keep-alive clients at
+fixed concurrency levels, and writes throughput, latency percentiles,
+CPU, RSS and span counts as JSON.
+
+    python benchmarks/run_benchmarks.py run --output base.json
+    python benchmarks/run_benchmarks.py compare base.json new.json
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from local_postgres import REPO_ROOT, LocalPostgres, free_port
+from otlp_stub import StubCollector
+
+ORDER_PRODUCTS = ("cupboards", "computers", "chairs", "desks")
+STOCK_PRODUCTS = ORDER_PRODUCTS
+ORDER_BATCH_SIZE = 50
+COLUMNAR_MIMETYPE = "application/vnd.tracey.columnar+json"
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# How each serving mode starts a service, relative to the service's directory
+COMMANDS = {
+    "flask": {
+        "order-processor": [sys.executable, "order-processor.py"],
+        "stock-controller": [sys.executable, "stock-controller.py"],
+    },
+    "gunicorn": {
+        "order-processor": [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "order-processor:app"],
+        "stock-controller": [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "stock-controller:app"],
+    },
+    "asgi": {
+        "order-processor": [sys.executable, "order-processor-async.py"],
+        "stock-controller": [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "stock-controller:app"],
+    },
+}
+
+READY_PATHS = {"order-processor": "/checkorders?limit=1", "stock-controller": "/checkstock?product=desks"}
+
+
+class Client:
+    """One keep-alive connection; reconnects after errors."""
+
+    def __init__(self, port):
+        self.port = port
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+    def json(self, method, path, body=None, headers=None):
+        status, payload = self.request(method, path, body, headers)
+        return status, json.loads(payload)
+
+
+# Scenarios: name -> (service, setup(client, concurrency, duration), op(client, state) -> ok)
+
+def order_row(i):
+    return {product: (i + n) % 5 for n, product in enumerate(ORDER_PRODUCTS)}
+
+
+def add_order(client, state):
+    return client.request("POST", "/addorders", order_row(state["i"]))[0] == 201
+
+
+def add_orders_batch(client, state):
+    return client.request("POST", "/addorders/batch", [order_row(i) for i in range(ORDER_BATCH_SIZE)])[0] == 201
+
+
+def check_orders(client, state):
+    return client.request("GET", "/checkorders?limit=100")[0] == 200
+
+
+def seed_order_listing(client, concurrency, duration):
+    """Insert one full page of orders to list, untimed."""
+    client.request("POST", "/addorders/batch", [order_row(i) for i in range(1000)])
+    return None
+
+
+def check_orders_rows(client, state):
+    return client.request("GET", "/checkorders?limit=1000", headers={"Accept-Encoding": "identity"})[0] == 200
+
+
+def check_orders_columnar(client, state):
+    headers = {"Accept": COLUMNAR_MIMETYPE, "Accept-Encoding": "gzip"}
+    return client.request("GET", "/checkorders?limit=1000", headers=headers)[0] == 200
+
+
+def seed_orders(client, concurrency, duration):
+    """Insert orders for the deletes to hit, untimed; each worker gets its own ids."""
+    count = int(max(duration, 1) * 5000)
+    ids = []
+    while len(ids) < count:
+        _, body = client.json("POST", "/addorders/batch", [order_row(i) for i in range(min(1000, count - len(ids)))])
+        ids.extend(result["order_id"] for result in body["results"])
+    return [ids[worker::concurrency] for worker in range(concurrency)]
+
+
+def delete_order(client, state):
+    if not state["ids"]:
+        return False
+    return client.request("GET", f"/deleteorders/{state['ids'].pop()}")[0] == 200
+
+
+def fulfil_order(client, state):
+    if not state["ids"]:
+        return False
+    return client.request("POST", f"/fulfilorders/{state['ids'].pop()}", {})[0] == 200
+
+
+def check_stock(client, state):
+    product = STOCK_PRODUCTS[state["i"] % len(STOCK_PRODUCTS)]
+    return client.request("GET", f"/checkstock?product={product}")[0] == 200
+
+
+def check_stock_no_cache(client, state):
+    product = STOCK_PRODUCTS[state["i"] % len(STOCK_PRODUCTS)]
+    return client.request("GET", f"/checkstock?product={product}", headers={"Cache-Control": "no-cache"})[0] == 200
+
+
+def seed_stock(client, concurrency, duration):
+    """Top the stock up so the decrease scenarios cannot run out, untimed."""
+    for product in STOCK_PRODUCTS:
+        client.request("POST", "/increasestock", {"product": product, "quantity": 100000000})
+    return None
+
+
+def increase_stock(client, state):
+    product = STOCK_PRODUCTS[state["i"] % len(STOCK_PRODUCTS)]
+    return client.request("POST", "/increasestock", {"product": product, "quantity": 1})[0] == 200
+
+
+def decrease_stock(client, state):
+    product = STOCK_PRODUCTS[state["i"] % len(STOCK_PRODUCTS)]
+    return client.request("POST", "/decreasestock", {"product": product, "quantity": 1})[0] == 200
+
+
+def adjust_stock(client, state):
+    adjustments = [{"product": product, "delta": -1} for product in STOCK_PRODUCTS]
+    return client.request("POST", "/adjuststock", {"adjustments": adjustments})[0] == 200
+
+
+SCENARIOS = {
+    "add_order": ("order-processor", None, add_order),
+    "add_orders_batch": ("order-processor", None, add_orders_batch),
+    "check_orders": ("order-processor", None, check_orders),
+    "check_orders_rows": ("order-processor", seed_order_listing, check_orders_rows),
+    "check_orders_columnar": ("order-processor", seed_order_listing, check_orders_columnar),
+    "delete_order": ("order-processor", seed_orders, delete_order),
+    "fulfil_order": ("order-processor", seed_orders, fulfil_order),
+    "check_stock": ("stock-controller", None, check_stock),
+    "check_stock_no_cache": ("stock-controller", None, check_stock_no_cache),
+    "increase_stock": ("stock-controller", None, increase_stock),
+    "decrease_stock": ("stock-controller", seed_stock, decrease_stock),
+    "adjust_stock": ("stock-controller", seed_stock, adjust_stock),
+}
+
+# SQL run against a scenario's fresh database before its service starts. Fulfilment refuses orders it has
+# no stock for and only stock-controller replenishes, so the stock is topped up front.
+DATABASE_SETUP = {
+    "fulfil_order": "UPDATE stock SET stock_quantity = 100000000;",
+}
+
+# Scenarios a serving mode cannot run: the ASGI order-processor only has /checkorders (rows only),
+# /addorders and /deleteorders, and the listing and delete scenarios seed their orders through /addorders/batch
+UNSUPPORTED_SCENARIOS = {
+    "asgi": {"add_orders_batch", "check_orders_rows", "check_orders_columnar", "delete_order", "fulfil_order"},
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def process_tree(pid):
+    """pid and all of its descendants, from /proc."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                ppid = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def tree_usage(pid):
+    """(cpu_seconds, rss_bytes) summed over a process tree."""
+    cpu = rss = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+            cpu += int(fields[11]) + int(fields[12])
+            rss += int(fields[21]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            continue
+    return cpu / CLK_TCK, rss
+
+
+class Service:
+    def __init__(self, name, mode, env):
+        self.name = name
+        self.port = free_port()
+        self.process = subprocess.Popen(
+            COMMANDS[mode][name], cwd=os.path.join(REPO_ROOT, name),
+            env={**env, "PORT": str(self.port)}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def wait_ready(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.name} exited with status {self.process.returncode}")
+            try:
+                if Client(self.port).request("GET", READY_PATHS[self.name])[0] == 200:
+                    return
+            except (OSError, http.client.HTTPException):
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"{self.name} did not become ready within {timeout}s")
+
+    def usage(self):
+        return tree_usage(self.process.pid)
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def drive(service, op, setup, concurrency, duration, warmup):
+    """Run op from concurrency closed-loop clients; returns latencies and counts for the timed window."""
+    seeds = setup(Client(service.port), concurrency, duration + warmup) if setup else None
+    start = time.monotonic() + warmup
+    stop = start + duration
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+
+    def worker(index):
+        client = Client(service.port)
+        state = {"i": index, "ids": seeds[index] if seeds else None}
+        while True:
+            began = time.monotonic()
+            if began >= stop:
+                return
+            try:
+                ok = op(client, state)
+            except (OSError, http.client.HTTPException, ValueError):
+                ok = False
+            finished = time.monotonic()
+            state["i"] += 1
+            if began >= start:
+                latencies[index].append(finished - began)
+                if not ok:
+                    errors[index] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    time.sleep(max(start - time.monotonic(), 0))
+    cpu_before, _ = service.usage()
+    rss_max = 0
+    while time.monotonic() < stop:
+        rss_max = max(rss_max, service.usage()[1])
+        time.sleep(min(0.5, max(stop - time.monotonic(), 0)))
+    cpu_after, rss = service.usage()
+    for thread in threads:
+        thread.join()
+    merged = sorted(latency for worker_latencies in latencies for latency in worker_latencies)
+    cpu_seconds = cpu_after - cpu_before
+    return {
+        "requests": len(merged),
+        "errors": sum(errors),
+        "throughput_rps": round(len(merged) / duration, 2),
+        "latency_ms": {
+            "mean": round(1000 * sum(merged) / len(merged), 3) if merged else 0.0,
+            "p50": round(1000 * percentile(merged, 0.50), 3),
+            "p95": round(1000 * percentile(merged, 0.95), 3),
+            "p99": round(1000 * percentile(merged, 0.99), 3),
+            "max": round(1000 * merged[-1], 3) if merged else 0.0,
+        },
+        "cpu_seconds": round(cpu_seconds, 3),
+        "cpu_percent": round(100 * cpu_seconds / duration, 1),
+        "rss_max_bytes": max(rss_max, rss),
+    }
+
+
+def git_commit():
+    result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+
+def run(args):
+    scenarios = args.scenarios.split(",") if args.scenarios else list(SCENARIOS)
+    concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    results = {
+        "meta": {
+            "git_commit": git_commit(), "mode": args.mode, "duration": args.duration, "warmup": args.warmup,
+            "concurrency": concurrency_levels, "env": extra_env, "host": socket.gethostname(),
+            "python": platform.python_version(), "cpus": os.cpu_count(),
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "scenarios": {},
+    }
+    unsupported = UNSUPPORTED_SCENARIOS.get(args.mode, set())
+    skipped = [name for name in scenarios if name in unsupported]
+    if skipped:
+        print(f"Skipping scenarios the {args.mode} mode does not serve: {', '.join(skipped)}", flush=True)
+        results["meta"]["skipped_scenarios"] = skipped
+    for name in scenarios:
+        if name in unsupported:
+            continue
+        service_name, setup, op = SCENARIOS[name]
+        for concurrency in concurrency_levels:
+            # A fresh database, collector and service per run so runs cannot affect each other
+            with LocalPostgres() as postgres, StubCollector() as collector:
+                if name in DATABASE_SETUP:
+                    postgres.psql(DATABASE_SETUP[name])
+                env = {**os.environ, **postgres.env(), "OTEL_HOST": collector.endpoint,
+                       "PYTHONPATH": REPO_ROOT, "LOG_LEVEL": "WARNING", **extra_env}
+                service = Service(service_name, args.mode, env)
+                try:
+                    service.wait_ready()
+                    result = drive(service, op, setup, concurrency, args.duration, args.warmup)
+                finally:
+                    service.stop()
+                # Spans are flushed on shutdown, so count them after the service stopped
+                result["spans_received"] = collector.service.snapshot().get(service_name, 0)
+            results["scenarios"].setdefault(name, {"service": service_name, "runs": {}})["runs"][str(concurrency)] = result
+            print(f"{name:<22} c={concurrency:<4} {result['throughput_rps']:>10.1f} req/s  "
+                  f"p50 {result['latency_ms']['p50']:>8.2f} ms  p99 {result['latency_ms']['p99']:>8.2f} ms  "
+                  f"errors {result['errors']:<6} cpu {result['cpu_percent']:>6.1f}%  "
+                  f"rss {result['rss_max_bytes'] / 2 ** 20:.0f} MiB", flush=True)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    return 0
+
+
+def compare(args):
+    """Flag scenarios whose throughput fell or p99 latency rose by more than the threshold percent."""
+    with open(args.base) as base_file, open(args.new) as new_file:
+        base, new = json.load(base_file), json.load(new_file)
+    regressions = 0
+    for name, scenario in sorted(new["scenarios"].items()):
+        for concurrency, result in sorted(scenario["runs"].items(), key=lambda item: int(item[0])):
+            before = base["scenarios"].get(name, {}).get("runs", {}).get(concurrency)
+            if before is None:
+                continue
+            rps_change = 100 * (result["throughput_rps"] / before["throughput_rps"] - 1) if before["throughput_rps"] else 0.0
+            p99_change = 100 * (result["latency_ms"]["p99"] / before["latency_ms"]["p99"] - 1) if before["latency_ms"]["p99"] else 0.0
+            regressed = rps_change < -args.threshold or p99_change > args.threshold
+            regressions += regressed
+            print(f"{'REGRESSION' if regressed else 'ok':<10} {name:<22} c={concurrency:<4} "
+                  f"throughput {rps_change:+7.1f}%  p99 {p99_change:+7.1f}%")
+    return 1 if regressions else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Tracey Reloaded service benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("--mode", choices=sorted(COMMANDS), default="gunicorn",
+                            help="How to serve the services (asgi serves order-processor with uvicorn)")
+    run_parser.add_argument("--scenarios", default="", help=f"Comma-separated subset of: {','.join(SCENARIOS)}")
+    run_parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated client concurrency levels")
+    run_parser.add_argument("--duration", type=float, default=20.0, help="Timed seconds per scenario and level")
+    run_parser.add_argument("--warmup", type=float, default=3.0, help="Untimed seconds before each measurement")
+    run_parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                            help="Extra environment for the services, e.g. --env STOCK_CACHE_ENABLED=false")
+    run_parser.add_argument("--output", help="Write the results as JSON to this file")
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=10.0, help="Allowed change in percent")
+    compare_parser.set_defaults(handler=compare)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(args.handler(args))
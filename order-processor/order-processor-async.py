@@ -0,0 +1,211 @@
+# Asyncio (ASGI) serving mode for the order-processor API, backed by asyncpg.
+# Serves the same /checkorders, /addorders and /deleteorders/<id> routes with
+# the same span names as order-processor.py, so the two can be compared
+# side by side: uvicorn order-processor-async:app --host 0.0.0.0 --port 8080
+import asyncio
+import json
+import logging
+import os
+from contextlib import asynccontextmanager
+import asyncpg
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+from opentelemetry import trace
+from opentelemetry import context
+from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
+from opentelemetry.instrumentation.asyncpg import AsyncPGInstrumentor
+from tracey_common.logs import configure_logging
+from tracey_common.telemetry import init_tracing
+from tracey_common.validation import Field, Schema, ValidationError
+
+# Structured JSON logs with trace context, written by a background thread
+configure_logging("order-processor")
+logger = logging.getLogger("order-processor")
+
+# Constants
+DATABASE_MIN_CONNECTIONS = int(os.environ.get("DB_POOL_MIN", default=1))
+DATABASE_MAX_CONNECTIONS = int(os.environ.get("DB_POOL_MAX", default=10))
+DATABASE_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", default=5.0))
+CHECKORDERS_DEFAULT_LIMIT = int(os.environ.get("CHECKORDERS_DEFAULT_LIMIT", default=100))
+CHECKORDERS_MAX_LIMIT = int(os.environ.get("CHECKORDERS_MAX_LIMIT", default=1000))
+ORDER_STREAM_FETCH_SIZE = int(os.environ.get("ORDER_STREAM_FETCH_SIZE", default=500))
+ORDER_PRODUCTS = ("cupboards", "computers", "chairs", "desks")
+
+# The same order layout as order-processor.py; bad input is a 400, not a database error
+ORDER_SCHEMA = Schema(*(Field(product, int, default=0, minimum=0) for product in ORDER_PRODUCTS))
+
+# Set up tracing; sampling, BatchSpanProcessor and exporter settings come from the environment
+init_tracing("order-processor", **{"service.mode": "asgi"})
+
+tracer = trace.get_tracer(__name__)
+
+# Instrument asyncpg
+AsyncPGInstrumentor().instrument()
+
+# Database parameters:
+db_params = {
+    'database': os.environ.get("DB_NAME", default="mydatabase"),
+    'user': os.environ.get("DB_USER", default="user"),
+    'password': os.environ.get("DB_PASSWORD", default="password"),
+    'host': os.environ.get("DB_HOST", default="postgresql"),
+    'port': int(os.environ.get("DB_PORT", default=5432)),
+}
+
+pool = None
+
+@asynccontextmanager
+async def lifespan(app):
+    global pool
+    pool = await asyncpg.create_pool(
+        min_size=DATABASE_MIN_CONNECTIONS, max_size=DATABASE_MAX_CONNECTIONS, **db_params)
+    logger.info("Processor is starting...")
+    try:
+        yield
+    finally:
+        await pool.close()
+        trace.get_tracer_provider().shutdown()
+
+def order_row(row):
+    return {"order_id": row[0], "cupboards": row[1], "computers": row[2], "chairs": row[3], "desks": row[4]}
+
+async def stream_unprocessed_orders(after_order_id):
+    """Stream every unprocessed order as one JSON array from a server-side cursor.
+
+    The connection is acquired, the transaction started and the cursor
+    opened before the response starts, so a pool timeout or a failing
+    query is still answered with an error status rather than a truncated 200.
+    """
+    parent_context = context.get_current()
+    span = tracer.start_span("DB: Stream Unprocessed Orders")
+    conn = None
+    transaction = None
+
+    async def release():
+        try:
+            if transaction is not None:
+                await transaction.rollback()
+        finally:
+            if conn is not None:
+                await pool.release(conn)
+            span.end()
+
+    try:
+        with trace.use_span(span):
+            conn = await pool.acquire(timeout=DATABASE_POOL_TIMEOUT)
+            started = conn.transaction(readonly=True)
+            await started.start()
+            transaction = started
+            cursor = await conn.cursor(
+                "SELECT order_id, cupboards, computers, chairs, desks FROM orders "
+                "WHERE is_processed = FALSE AND order_id > $1 ORDER BY order_id;",
+                after_order_id)
+    except BaseException:
+        await release()
+        raise
+
+    async def generate():
+        token = context.attach(parent_context)
+        try:
+            with trace.use_span(span):
+                yield "["
+                separator = ""
+                count = 0
+                while True:
+                    rows = await cursor.fetch(ORDER_STREAM_FETCH_SIZE)
+                    for row in rows:
+                        yield separator + json.dumps(order_row(row))
+                        separator = ","
+                        count += 1
+                    if len(rows) < ORDER_STREAM_FETCH_SIZE:
+                        break
+                yield "]"
+            logger.info("Streamed %s unprocessed orders", count)
+        finally:
+            context.detach(token)
+            await release()
+
+    return StreamingResponse(generate(), media_type="application/json")
+
+async def check_orders(request):
+    with tracer.start_as_current_span("OrderProcessor: Check Orders"):
+        try:
+            limit = min(int(request.query_params.get("limit", CHECKORDERS_DEFAULT_LIMIT)), CHECKORDERS_MAX_LIMIT)
+            after_order_id = int(request.query_params.get("after_order_id", 0))
+        except ValueError:
+            return JSONResponse({"message": "limit and after_order_id must be integers"}, status_code=400)
+        if limit < 1:
+            return JSONResponse({"message": "limit must be at least 1"}, status_code=400)
+        if request.query_params.get("all", "").lower() in ("1", "true", "yes"):
+            return await stream_unprocessed_orders(after_order_id)
+
+        async with pool.acquire(timeout=DATABASE_POOL_TIMEOUT) as conn:
+            with tracer.start_as_current_span("DB: Fetch Unprocessed Orders"):
+                orders = await conn.fetch(
+                    "SELECT order_id, cupboards, computers, chairs, desks FROM orders "
+                    "WHERE is_processed = FALSE AND order_id > $1 ORDER BY order_id LIMIT $2;",
+                    after_order_id, limit
+                )
+                response_data = [order_row(row) for row in orders]
+        logger.info("Fetched %s unprocessed orders after order_id %s", len(response_data), after_order_id)
+        headers = {}
+        if len(response_data) == limit:
+            # Keyset cursor for the next page
+            headers["X-Next-After-Order-Id"] = str(response_data[-1]["order_id"])
+        return JSONResponse(response_data, headers=headers)
+
+async def add_orders(request):
+    with tracer.start_as_current_span("OrderProcessor: Add Orders"):
+        body = await request.body()
+        try:
+            # No body is an empty order, as in the Flask app; a body that is not JSON fails the schema check
+            data = json.loads(body) if body else {}
+        except ValueError:
+            data = None
+        try:
+            order = ORDER_SCHEMA.validate(data)
+        except ValidationError as e:
+            logger.warning("Rejected %s %s: %s", request.method, request.url.path, e)
+            return JSONResponse({"message": str(e), "errors": e.errors}, status_code=400)
+
+        async with pool.acquire(timeout=DATABASE_POOL_TIMEOUT) as conn:
+            with tracer.start_as_current_span("DB: Insert New Order"):
+                order_id = await conn.fetchval(
+                    "INSERT INTO orders (cupboards, computers, chairs, desks) VALUES ($1, $2, $3, $4) RETURNING order_id;",
+                    *(order[product] for product in ORDER_PRODUCTS)
+                )
+        logger.info("Inserted new order with order_id: %s", order_id)
+        return JSONResponse({"message": "Order added successfully", "order_id": order_id}, status_code=201)
+
+async def delete_orders(request):
+    order_id = request.path_params["order_id"]
+    with tracer.start_as_current_span("OrderProcessor: Delete Order"):
+        async with pool.acquire(timeout=DATABASE_POOL_TIMEOUT) as conn:
+            with tracer.start_as_current_span("DB: Delete Order"):
+                status = await conn.execute("DELETE FROM orders WHERE order_id = $1;", order_id)
+        if status == "DELETE 0":
+            logger.error("No order found to delete.")
+            return JSONResponse({"message": "Order not found"}, status_code=404)
+        logger.info("Deleted order with order_id: %s", order_id)
+        return JSONResponse({"message": f"Order {order_id} deleted successfully"}, status_code=200)
+
+async def handle_pool_timeout(request, exc):
+    logger.error("Database pool exhausted: no connection within %ss", DATABASE_POOL_TIMEOUT)
+    return JSONResponse({"error": "Database busy, try again"}, status_code=503)
+
+app = Starlette(
+    routes=[
+        Route('/checkorders', check_orders),
+        Route('/addorders', add_orders, methods=['POST']),
+        Route('/deleteorders/{order_id:int}', delete_orders),
+    ],
+    exception_handlers={asyncio.TimeoutError: handle_pool_timeout},
+    lifespan=lifespan,
+)
+
+# Instrument the ASGI app: server spans and incoming trace-context extraction, as FlaskInstrumentor does
+app = OpenTelemetryMiddleware(app)
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", default=8080)))
@@ -1,72 +1,134 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
+import heapq
+import itertools
 import logging
 import os
 import psycopg2
-from psycopg2.pool import SimpleConnectionPool
+from contextlib import ExitStack
+from psycopg2.extras import execute_values
+from tracey_common.db_pool import BlockingConnectionPool, PoolTimeout
+from tracey_common.lifecycle import ServiceLifecycle
+from tracey_common.logs import configure_logging
+from tracey_common import serialization
+from tracey_common.statements import SQL_COMMENTER, Statement, prepare_all, statement_stats
+from tracey_common.metrics import ServerMetrics
+from tracey_common.sharding import DEFAULT_WAREHOUSE_ID, ShardRouter
+from tracey_common.telemetry import init_metrics, init_tracing
+from tracey_common.validation import Field, Schema, ValidationError, validate_args, validate_json, validation_stats
 from opentelemetry import trace
 from opentelemetry import context
 from opentelemetry.propagate import extract
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.flask import FlaskInstrumentor
 from opentelemetry.instrumentation.psycopg2 import Psycopg2Instrumentor
-from opentelemetry.trace import get_current_span
-
-logging.basicConfig(level=logging.INFO)
-
-def custom_logger(message, level='info'):
-    current_span = get_current_span()
-    if current_span.is_recording():
-        trace_id = current_span.get_span_context().trace_id
-        span_id = current_span.get_span_context().span_id
-        # Convert to hexadecimal format
-        trace_id_hex = "{:032x}".format(trace_id)
-        span_id_hex = "{:016x}".format(span_id)
-    else:
-        trace_id_hex = span_id_hex = 'N/A'
-
-    log_message = f"[TraceID: {trace_id_hex}, SpanID: {span_id_hex}] {message}"
-
-    if level == 'info':
-        logging.info(log_message)
-    elif level == 'error':
-        logging.error(log_message)
-    elif level == 'warning':
-        logging.warning(log_message)
-    else:
-        logging.debug(log_message)
+
+# Structured JSON logs with trace context, written by a background thread
+configure_logging("order-processor")
+logger = logging.getLogger("order-processor")
 
 # Constants
-DATABASE_MAX_CONNECTIONS = 10
-
-# Get the local otel collector IP
-OTEL_HOST = os.environ.get("OTEL_HOST", default="10.10.0.12:4317")
-if not ":" in OTEL_HOST:
-  OTEL_HOST = OTEL_HOST + ":4317"
-print("OTEL Collector Address: {}".format(OTEL_HOST))
-
-# Set OTEL service name and set the trace provider
-resource = Resource(
-    attributes={
-        "service.name": "order-processor",
-        "version": "v0.0.1",
-        "service.instance.id": "instance-1",
-        "telemetry.sdk.name":"opentelemetry",
-        "telemetry.sdk.language":"python",
-        "telemetry.sdk.version":"1.19.0"
-    }
+DATABASE_MIN_CONNECTIONS = int(os.environ.get("DB_POOL_MIN", default=1))
+DATABASE_MAX_CONNECTIONS = int(os.environ.get("DB_POOL_MAX", default=10))
+DATABASE_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", default=5.0))
+ORDER_PRODUCTS = ("cupboards", "computers", "chairs", "desks")
+ORDER_COLUMNS = ("order_id", "warehouse_id") + ORDER_PRODUCTS
+ORDER_BATCH_MAX_ROWS = int(os.environ.get("ORDER_BATCH_MAX_ROWS", default=10000))
+ORDER_BATCH_PAGE_SIZE = int(os.environ.get("ORDER_BATCH_PAGE_SIZE", default=1000))
+NDJSON_MIMETYPES = ("application/x-ndjson", "application/jsonl")
+CHECKORDERS_DEFAULT_LIMIT = int(os.environ.get("CHECKORDERS_DEFAULT_LIMIT", default=100))
+CHECKORDERS_MAX_LIMIT = int(os.environ.get("CHECKORDERS_MAX_LIMIT", default=1000))
+ORDER_STREAM_FETCH_SIZE = int(os.environ.get("ORDER_STREAM_FETCH_SIZE", default=500))
+ORDER_LEASE_SECONDS = float(os.environ.get("ORDER_LEASE_SECONDS", default=60))
+ORDER_LEASE_MAX_SECONDS = float(os.environ.get("ORDER_LEASE_MAX_SECONDS", default=3600))
+# Shard n hands out order ids from n * ORDER_ID_SHARD_RANGE + 1, so ids stay unique when orders move between shards
+ORDER_ID_SHARD_RANGE = int(os.environ.get("ORDER_ID_SHARD_RANGE", default=1000000000000))
+
+# Request layouts, compiled once; bad input is rejected with a 400 before a connection is checked out.
+# warehouse_id picks the shard; routes keyed by order id look the order up on every shard without it.
+WAREHOUSE_FIELD = Field("warehouse_id", int, minimum=0)
+NEW_ORDER_WAREHOUSE_FIELD = Field("warehouse_id", int, default=DEFAULT_WAREHOUSE_ID, minimum=0)
+ORDER_SCHEMA = Schema(*(Field(product, int, default=0, minimum=0) for product in ORDER_PRODUCTS))
+ADD_ORDER_SCHEMA = Schema(NEW_ORDER_WAREHOUSE_FIELD, *ORDER_SCHEMA.fields)
+ADD_ORDER_BATCH_PARAMS = Schema(NEW_ORDER_WAREHOUSE_FIELD, from_strings=True)
+CHECKORDERS_PARAMS = Schema(
+    Field("limit", int, default=CHECKORDERS_DEFAULT_LIMIT, minimum=1),
+    Field("after_order_id", int, default=0, minimum=0),
+    Field("all", bool, default=False),
+    WAREHOUSE_FIELD,
+    from_strings=True,
+)
+ORDER_PARAMS = Schema(WAREHOUSE_FIELD, from_strings=True)
+LEASE_SCHEMA = Schema(
+    Field("owner", str, required=True),
+    Field("lease_seconds", float, default=ORDER_LEASE_SECONDS, minimum=1),
+    WAREHOUSE_FIELD,
+)
+FULFIL_SCHEMA = Schema(
+    Field("owner", str),
+    Field("delete", bool, default=False),
+    Field("all_or_nothing", bool, default=True),
+    WAREHOUSE_FIELD,
 )
-trace.set_tracer_provider(TracerProvider(resource=resource))
 
-# Create OTLP exporter and point it to the OTEL Collector
-otlp_exporter = OTLPSpanExporter(endpoint=OTEL_HOST, insecure=True)
+# The fixed queries, run as prepared statements on each pooled connection. Listings and claims are limited
+# to the warehouses a shard owns with "(warehouse_id = ANY(%s)) = %s", filled in from Shard.ownership().
+FETCH_UNPROCESSED_ORDERS = Statement(
+    "fetch_unprocessed_orders",
+    "SELECT order_id, warehouse_id, cupboards, computers, chairs, desks FROM orders "
+    "WHERE is_processed = FALSE AND order_id > %s AND (warehouse_id = ANY(%s)) = %s ORDER BY order_id LIMIT %s;")
+STREAM_UNPROCESSED_ORDERS_SQL = (
+    "SELECT order_id, warehouse_id, cupboards, computers, chairs, desks FROM orders "
+    "WHERE is_processed = FALSE AND order_id > %s AND (warehouse_id = ANY(%s)) = %s ORDER BY order_id;")
+INSERT_ORDER = Statement(
+    "insert_order",
+    "INSERT INTO orders (warehouse_id, cupboards, computers, chairs, desks) VALUES (%s, %s, %s, %s, %s) "
+    "RETURNING order_id;")
+DELETE_ORDER = Statement("delete_order", "DELETE FROM orders WHERE order_id = %s;")
+LOCATE_ORDER = Statement("locate_order", "SELECT warehouse_id FROM orders WHERE order_id = %s;")
+CLAIM_NEXT_ORDER = Statement(
+    "claim_next_order",
+    "WITH next AS ("
+    "    SELECT order_id, lease_owner FROM orders"
+    "    WHERE is_processed = FALSE AND (lease_expires_at IS NULL OR lease_expires_at < now())"
+    "    AND (warehouse_id = ANY(%s)) = %s"
+    "    ORDER BY order_id LIMIT 1 FOR UPDATE SKIP LOCKED"
+    ") "
+    "UPDATE orders AS o SET lease_owner = %s, lease_expires_at = now() + make_interval(secs => %s) "
+    "FROM next WHERE o.order_id = next.order_id "
+    "RETURNING o.order_id, o.warehouse_id, o.cupboards, o.computers, o.chairs, o.desks, o.lease_expires_at, "
+    "next.lease_owner;")
+COMPLETE_LEASED_ORDER = Statement(
+    "complete_leased_order",
+    "UPDATE orders SET is_processed = TRUE, lease_owner = NULL, lease_expires_at = NULL "
+    "WHERE order_id = %s AND lease_owner = %s AND is_processed = FALSE;")
+ABANDON_LEASED_ORDER = Statement(
+    "abandon_leased_order",
+    "UPDATE orders SET lease_owner = NULL, lease_expires_at = NULL "
+    "WHERE order_id = %s AND lease_owner = %s AND is_processed = FALSE;")
+SELECT_ORDER_LEASE = Statement("select_order_lease", "SELECT lease_owner, is_processed FROM orders WHERE order_id = %s;")
+LOCK_ORDER = Statement(
+    "lock_order",
+    "SELECT cupboards, computers, chairs, desks, lease_owner, lease_expires_at > now(), warehouse_id FROM orders "
+    "WHERE order_id = %s AND is_processed = FALSE FOR UPDATE;")
+LOCK_ORDER_STOCK = Statement(
+    "lock_order_stock",
+    "SELECT product, stock_quantity FROM stock WHERE warehouse_id = %s AND product = ANY(%s) "
+    "ORDER BY product FOR UPDATE;")
+# Never takes a product below zero; refilling what ends up below its reorder threshold is left to
+# stock-controller's replenisher, woken by the stock table's stock_low NOTIFY trigger
+PICK_ORDER_STOCK = Statement(
+    "pick_order_stock",
+    "UPDATE stock AS s SET stock_quantity = s.stock_quantity - r.quantity "
+    "FROM unnest(%s::varchar[], %s::integer[]) AS r(product, quantity) "
+    "WHERE s.warehouse_id = %s AND s.product = r.product AND s.stock_quantity >= r.quantity "
+    "RETURNING s.product, s.stock_quantity, s.stock_quantity < s.reorder_threshold;")
+COMPLETE_ORDER = Statement(
+    "complete_order",
+    "UPDATE orders SET is_processed = TRUE, lease_owner = NULL, lease_expires_at = NULL WHERE order_id = %s;")
 
-# Set up BatchSpanProcessor and add it to the tracer provider
-trace.get_tracer_provider().add_span_processor(
-    BatchSpanProcessor(otlp_exporter)
-)
+# Set up tracing; sampling, BatchSpanProcessor and exporter settings come from the environment
+init_tracing("order-processor")
+# Request, statement and pool metrics go to the same collector as OTLP metrics
+init_metrics("order-processor")
 
 tracer = trace.get_tracer(__name__)
 app = Flask(__name__)
@@ -74,94 +136,511 @@ app = Flask(__name__)
 # Instrument Flask app
 FlaskInstrumentor().instrument_app(app)
 
+# Request duration per route and status; registered first so it times the other request hooks
+server_metrics = ServerMetrics()
+server_metrics.init_app(app)
+
+# Fast JSON encoding for every response and gzip for large ones
+serialization.init_app(app)
+
 # Instrument psycopg2
-Psycopg2Instrumentor().instrument(skip_dep_check=True, enable_commenter=True)
+Psycopg2Instrumentor().instrument(skip_dep_check=True, enable_commenter=SQL_COMMENTER)
 
-# Database parameters:
+# Database parameters; with DB_SHARDS set, the defaults for whatever a shard's DSN leaves out
 db_params = {
-    'dbname': "mydatabase",
-    'user': "user",
-    'password': "password",
-    'host': "postgresql",
-    'port': 5432,
+    'dbname': os.environ.get("DB_NAME", default="mydatabase"),
+    'user': os.environ.get("DB_USER", default="user"),
+    'password': os.environ.get("DB_PASSWORD", default="password"),
+    'host': os.environ.get("DB_HOST", default="postgresql"),
+    'port': int(os.environ.get("DB_PORT", default=5432)),
 }
 
-# Set up a database connection pool
-pool = SimpleConnectionPool(
-    minconn=1, maxconn=DATABASE_MAX_CONNECTIONS, **db_params)
+def reserve_order_ids(pool, shard):
+    """Move the shard's order id sequence into its own block, once; a no-op on shard 0 and on later starts."""
+    first_id = shard.index * ORDER_ID_SHARD_RANGE + 1
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT setval('orders_order_id_seq', %s, false) FROM orders_order_id_seq WHERE last_value < %s;",
+                (first_id, first_id))
+            if cursor.fetchone():
+                logger.info("Order ids on %s now start at %s", shard.name, first_id)
+        conn.commit()
+    finally:
+        pool.putconn(conn)
+
+def create_shard_pool(shard):
+    pool = BlockingConnectionPool(
+        minconn=DATABASE_MIN_CONNECTIONS, maxconn=DATABASE_MAX_CONNECTIONS, timeout=DATABASE_POOL_TIMEOUT,
+        on_wait=server_metrics.pool_wait_recorder(shard.name), **shard.connect_params)
+    try:
+        reserve_order_ids(pool, shard)
+    except psycopg2.Error:
+        pool.closeall()
+        raise
+    return pool
 
-def get_db_connection():
-    return pool.getconn()
+# One thread-safe database connection pool per shard (DB_SHARDS, or just DB_HOST); callers wait up to
+# DB_POOL_TIMEOUT for a free connection. Pools are created on first use, retrying with backoff, so the
+# service starts before Postgres is reachable. DB_SHARD_MAP assigns warehouses to shards.
+router = ShardRouter(db_params, create_shard_pool)
+server_metrics.observe_pools(router.pools)
 
-def release_db_connection(conn):
-    pool.putconn(conn)
+# /healthz and /readyz, warm-up of DB_POOL_MIN connections per shard (with every statement prepared) and graceful drain
+lifecycle = ServiceLifecycle("order-processor", router.pools, warm_connection=prepare_all)
+lifecycle.init_app(app)
+lifecycle.start_warmup()
 
-@app.route('/checkorders')
-def check_orders():
-    with tracer.start_as_current_span("OrderProcessor: Check Orders"):
-        conn = get_db_connection()
+# Where claims without a warehouse_id start, so concurrent claimers spread over the shards
+claim_rotation = itertools.count()
+
+def get_db_connection(shard):
+    return shard.pool.getconn()
+
+def release_db_connection(shard, conn):
+    shard.pool.putconn(conn)
+
+def listing_shards(warehouse_id):
+    """The shards to read for a listing: the warehouse's own, or all of them."""
+    return router.shards if warehouse_id is None else [router.shard_for(warehouse_id)]
+
+def locate_order(order_id, warehouse_id=None):
+    """The shard holding order_id, or None if there is no such order.
+
+    With the client's warehouse_id (or a single shard) that is a lookup in
+    the shard map; otherwise every shard is asked in parallel.
+    """
+    if warehouse_id is not None:
+        return router.shard_for(warehouse_id)
+    if len(router.shards) == 1:
+        return router.shards[0]
+
+    def holds_order(shard):
+        conn = get_db_connection(shard)
         cursor = conn.cursor()
         try:
-            with tracer.start_as_current_span("DB: Fetch Unprocessed Orders"):
-                cursor.execute("SELECT order_id, cupboards, computers, chairs, desks FROM orders WHERE is_processed = FALSE;")
-                orders = cursor.fetchall()
-                response_data = [{"order_id":row[0], "cupboards": row[1], "computers": row[2], "chairs": row[3], "desks": row[4]} for row in orders]
-            custom_logger(f"Fetched unprocessed orders: {response_data}",level='info')
-            return jsonify(response_data)
+            LOCATE_ORDER.execute(cursor, (order_id,))
+            row = cursor.fetchone()
+            # A copy left behind by a rebalancing, on a shard that no longer owns the warehouse, does not count
+            return row is not None and router.shard_for(row[0]) is shard
         finally:
             cursor.close()
-            release_db_connection(conn)
+            release_db_connection(shard, conn)
+
+    with tracer.start_as_current_span("DB: Locate Order"):
+        found = router.fan_out(holds_order)
+    return next((shard for shard, holds in zip(router.shards, found) if holds), None)
+
+def stream_unprocessed_orders(shards, warehouse_id, after_order_id):
+    """Stream every unprocessed order as one JSON array from a server-side cursor per shard, merged by order_id.
+
+    The connections are checked out and the cursors opened before the
+    response starts, so a pool timeout or a failing query is still answered
+    with an error status rather than a truncated 200.
+    """
+    parent_context = context.get_current()
+    span = tracer.start_span("DB: Stream Unprocessed Orders")
+    conns = []
+    cursors = ExitStack()
+
+    def close():
+        try:
+            cursors.close()
+        finally:
+            # The named cursors live in read-only transactions; end them before returning the connections
+            while conns:
+                shard, conn = conns.pop()
+                conn.rollback()
+                release_db_connection(shard, conn)
+            span.end()
+
+    readers = []
+    try:
+        with trace.use_span(span):
+            for shard in shards:
+                conn = get_db_connection(shard)
+                conns.append((shard, conn))
+                cursor = cursors.enter_context(conn.cursor(name="stream_unprocessed_orders"))
+                cursor.itersize = ORDER_STREAM_FETCH_SIZE
+                cursor.execute(STREAM_UNPROCESSED_ORDERS_SQL, (after_order_id, *shard.ownership(warehouse_id)))
+                readers.append(cursor)
+    except Exception:
+        close()
+        raise
+
+    def generate():
+        token = context.attach(parent_context)
+        try:
+            with trace.use_span(span):
+                yield "["
+                separator = ""
+                count = 0
+                # Each cursor is in order_id order, so the merge holds one fetch per shard in memory
+                for row in heapq.merge(*readers):
+                    yield separator + serialization.dumps(dict(zip(ORDER_COLUMNS, row))).decode()
+                    separator = ","
+                    count += 1
+                yield "]"
+            logger.info("Streamed %s unprocessed orders from %s shards", count, len(shards))
+        finally:
+            context.detach(token)
+
+    response = Response(stream_with_context(generate()), mimetype="application/json")
+    # Runs even if the client goes away before the body is read, when generate() never starts
+    response.call_on_close(close)
+    return response
+
+@app.route('/checkorders')
+@validate_args(CHECKORDERS_PARAMS, error_key="message")
+def check_orders(params):
+    with tracer.start_as_current_span("OrderProcessor: Check Orders"):
+        limit = min(params["limit"], CHECKORDERS_MAX_LIMIT)
+        after_order_id = params["after_order_id"]
+        warehouse_id = params["warehouse_id"]
+        shards = listing_shards(warehouse_id)
+        if params["all"]:
+            return stream_unprocessed_orders(shards, warehouse_id, after_order_id)
+
+        def fetch(shard):
+            conn = get_db_connection(shard)
+            cursor = conn.cursor()
+            try:
+                with tracer.start_as_current_span("DB: Fetch Unprocessed Orders") as span:
+                    span.set_attribute("db.shard", shard.name)
+                    FETCH_UNPROCESSED_ORDERS.execute(cursor, (after_order_id, *shard.ownership(warehouse_id), limit))
+                    return cursor.fetchall()
+            finally:
+                cursor.close()
+                release_db_connection(shard, conn)
+
+        # Every shard returns its own first page in order_id order; merged, their head is the overall first page
+        orders = list(itertools.islice(heapq.merge(*router.fan_out(fetch, shards)), limit))
+        logger.info("Fetched %s unprocessed orders after order_id %s", len(orders), after_order_id)
+        # Rows go straight to the encoder, as objects or, if the client asks for it, one array per column
+        response = serialization.rows_response(ORDER_COLUMNS, orders)
+        if len(orders) == limit:
+            # Keyset cursor for the next page; order ids are unique across shards
+            response.headers["X-Next-After-Order-Id"] = str(orders[-1][0])
+        return response
 
 @app.route('/addorders', methods=['POST'])
-def add_orders():
+@validate_json(ADD_ORDER_SCHEMA, error_key="message")
+def add_orders(body):
     with tracer.start_as_current_span("OrderProcessor: Add Orders"):
-        order_data = request.get_json()
-        order_id = order_data.get("order_id", 0)
-        cupboards = order_data.get("cupboards", 0)
-        computers = order_data.get("computers", 0)
-        chairs = order_data.get("chairs", 0)
-        desks = order_data.get("desks", 0)
-
-        conn = get_db_connection()
+        warehouse_id = body["warehouse_id"]
+        cupboards = body["cupboards"]
+        computers = body["computers"]
+        chairs = body["chairs"]
+        desks = body["desks"]
+
+        shard = router.shard_for(warehouse_id)
+        conn = get_db_connection(shard)
         cursor = conn.cursor()
         try:
             with tracer.start_as_current_span("DB: Insert New Order"):
-                cursor.execute(
-                    "INSERT INTO orders (cupboards, computers, chairs, desks) VALUES (%s, %s, %s, %s) RETURNING order_id;",
-                    (cupboards, computers, chairs, desks)
-                )
+                INSERT_ORDER.execute(cursor, (warehouse_id, cupboards, computers, chairs, desks))
             order_id = cursor.fetchone()[0]
-            custom_logger(f"Inserted new order with order_id: {order_id}",level='info')
+            logger.info("Inserted new order with order_id: %s", order_id)
             conn.commit()
-            return jsonify({"message": "Order added successfully", "order_id": order_id}), 201
+            return jsonify({"message": "Order added successfully", "order_id": order_id, "warehouse_id": warehouse_id}), 201
         finally:
             cursor.close()
-            release_db_connection(conn)
+            release_db_connection(shard, conn)
+
+def parse_order_row(row):
+    """Return (values, None) for a valid order row, or (None, error) for an invalid one."""
+    try:
+        order = ORDER_SCHEMA.validate(row)
+    except ValidationError as e:
+        return None, str(e)
+    return tuple(order[product] for product in ORDER_PRODUCTS), None
+
+def read_order_batch():
+    """Yield (row, error) pairs from a JSON array body or, for large payloads, an NDJSON stream."""
+    if request.mimetype in NDJSON_MIMETYPES:
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield serialization.loads(line), None
+            except ValueError as e:
+                yield None, f"Invalid JSON: {e}"
+        return
+    rows = request.get_json(silent=True)
+    if not isinstance(rows, list):
+        raise ValueError("Request body must be a JSON array of orders or NDJSON")
+    for row in rows:
+        yield row, None
+
+@app.route('/addorders/batch', methods=['POST'])
+@validate_args(ADD_ORDER_BATCH_PARAMS, error_key="message")
+def add_orders_batch(params):
+    warehouse_id = params["warehouse_id"]
+    with tracer.start_as_current_span("OrderProcessor: Add Orders Batch") as span:
+        results = []
+        pending = []
+        try:
+            for index, (row, error) in enumerate(read_order_batch()):
+                if index >= ORDER_BATCH_MAX_ROWS:
+                    return jsonify({"message": f"Batch exceeds {ORDER_BATCH_MAX_ROWS} orders"}), 413
+                values, error = parse_order_row(row) if error is None else (None, error)
+                if error is None:
+                    pending.append((index, values))
+                    results.append({"index": index})
+                else:
+                    results.append({"index": index, "error": error})
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        if not results:
+            return jsonify({"message": "Batch contains no orders"}), 400
+
+        if pending:
+            # The whole batch belongs to one warehouse, so it is still one transaction on one shard
+            shard = router.shard_for(warehouse_id)
+            conn = get_db_connection(shard)
+            cursor = conn.cursor()
+            try:
+                with tracer.start_as_current_span("DB: Insert Order Batch"):
+                    # One multi-row INSERT per page, a single commit for the whole batch.
+                    # RETURNING yields the ids in VALUES order, i.e. the input order.
+                    for start in range(0, len(pending), ORDER_BATCH_PAGE_SIZE):
+                        page = pending[start:start + ORDER_BATCH_PAGE_SIZE]
+                        order_ids = execute_values(
+                            cursor,
+                            "INSERT INTO orders (warehouse_id, cupboards, computers, chairs, desks) VALUES %s "
+                            "RETURNING order_id;",
+                            [(warehouse_id,) + values for _, values in page],
+                            page_size=len(page),
+                            fetch=True,
+                        )
+                        for (index, _), (order_id,) in zip(page, order_ids):
+                            results[index]["order_id"] = order_id
+                conn.commit()
+            finally:
+                cursor.close()
+                release_db_connection(shard, conn)
+
+        rejected = len(results) - len(pending)
+        span.set_attribute("orders.batch.size", len(results))
+        span.set_attribute("orders.batch.rejected", rejected)
+        logger.info("Inserted batch of %s orders, rejected %s", len(pending), rejected)
+        if not pending:
+            status = 400
+        elif rejected:
+            status = 207
+        else:
+            status = 201
+        return jsonify({"message": "Order batch processed", "inserted": len(pending), "rejected": rejected, "results": results}), status
 
 @app.route('/deleteorders/<int:order_id>')
-def delete_orders(order_id):
+@validate_args(ORDER_PARAMS, error_key="message")
+def delete_orders(order_id, params):
     with tracer.start_as_current_span("OrderProcessor: Delete Order"):
-        conn = get_db_connection()
+        shard = locate_order(order_id, params["warehouse_id"])
+        if shard is None:
+            logger.error("No order found to delete.")
+            return jsonify({"message": "Order not found"}), 404
+        conn = get_db_connection(shard)
         cursor = conn.cursor()
         try:
             with tracer.start_as_current_span("DB: Delete Order"):
-                cursor.execute("DELETE FROM orders WHERE order_id = %s;", (order_id,))
+                DELETE_ORDER.execute(cursor, (order_id,))
             if cursor.rowcount == 0:
-                custom_logger(f"No order found to delete.",level='error')
+                logger.error("No order found to delete.")
                 return jsonify({"message": "Order not found"}), 404
-            custom_logger(f"Deleted order with order_id: {order_id}",level='info')
+            logger.info("Deleted order with order_id: %s", order_id)
             conn.commit()
             return jsonify({"message": f"Order {order_id} deleted successfully"}), 200
         finally:
             cursor.close()
-            release_db_connection(conn)
+            release_db_connection(shard, conn)
 
-if __name__ == "__main__":
-    custom_logger(f"Processor is starting...",level='info')
-    app.run(host="0.0.0.0", port=8080)
+@app.route('/claimorders', methods=['POST'])
+@validate_json(LEASE_SCHEMA, error_key="message")
+def claim_orders(body):
+    with tracer.start_as_current_span("OrderProcessor: Claim Order") as span:
+        owner = body["owner"]
+        lease_seconds = min(body["lease_seconds"], ORDER_LEASE_MAX_SECONDS)
+        warehouse_id = body["warehouse_id"]
 
-    # Close all connections in the pool when the app shuts down
-    def shutdown():
-        pool.closeall()
+        shards = listing_shards(warehouse_id)
+        if len(shards) > 1:
+            # Without a warehouse, try every shard in turn until one has an order
+            start = next(claim_rotation) % len(shards)
+            shards = shards[start:] + shards[:start]
+        for shard in shards:
+            row = claim_next_order(shard, warehouse_id, owner, lease_seconds)
+            if row is not None:
+                break
+
+        if row is None:
+            logger.info("No unprocessed orders to claim for %s", owner)
+            return "", 204
+        order_id, warehouse_id, cupboards, computers, chairs, desks, lease_expires_at, previous_owner = row
+        span.set_attribute("order.id", order_id)
+        if previous_owner is not None:
+            logger.warning("Reclaimed order %s from %s after its lease expired", order_id, previous_owner)
+        logger.info("Order %s claimed by %s", order_id, owner)
+        return jsonify({"order_id": order_id, "warehouse_id": warehouse_id, "cupboards": cupboards, "computers": computers,
+                        "chairs": chairs, "desks": desks, "lease_owner": owner, "lease_expires_at": lease_expires_at.isoformat()})
+
+def claim_next_order(shard, warehouse_id, owner, lease_seconds):
+    conn = get_db_connection(shard)
+    cursor = conn.cursor()
+    try:
+        with tracer.start_as_current_span("DB: Claim Next Order") as span:
+            span.set_attribute("db.shard", shard.name)
+            # SKIP LOCKED lets concurrent claimers pass over each other's rows instead of
+            # queueing on them; orders whose lease ran out are claimable again.
+            CLAIM_NEXT_ORDER.execute(cursor, (*shard.ownership(warehouse_id), owner, lease_seconds))
+            row = cursor.fetchone()
+        conn.commit()
+        return row
+    finally:
+        cursor.close()
+        release_db_connection(shard, conn)
+
+def release_lease(order_id, warehouse_id, owner, span_name, statement):
+    """Run a lease-releasing statement on an order still leased by owner; returns an error response, or None on success."""
+    shard = locate_order(order_id, warehouse_id)
+    if shard is None:
+        logger.error("No order %s found to release.", order_id)
+        return jsonify({"message": "Order not found"}), 404
+    conn = get_db_connection(shard)
+    cursor = conn.cursor()
+    try:
+        with tracer.start_as_current_span(span_name):
+            statement.execute(cursor, (order_id, owner))
+            released = cursor.rowcount == 1
+            if not released:
+                SELECT_ORDER_LEASE.execute(cursor, (order_id,))
+                current = cursor.fetchone()
+        conn.commit()
+    finally:
+        cursor.close()
+        release_db_connection(shard, conn)
+
+    if released:
+        return None
+    if current is None:
+        logger.error("No order %s found to release.", order_id)
+        return jsonify({"message": "Order not found"}), 404
+    logger.warning("Order %s is not leased by %s (owner: %s, processed: %s)", order_id, owner, current[0], current[1])
+    return jsonify({"message": "Order is not leased by this owner", "lease_owner": current[0], "is_processed": current[1]}), 409
+
+@app.route('/completeorders/<int:order_id>', methods=['POST'])
+@validate_json(LEASE_SCHEMA, error_key="message")
+def complete_orders(order_id, body):
+    owner = body["owner"]
+    with tracer.start_as_current_span("OrderProcessor: Complete Order"):
+        error = release_lease(order_id, body["warehouse_id"], owner, "DB: Complete Order", COMPLETE_LEASED_ORDER)
+        if error:
+            return error
+        logger.info("Order %s completed by %s", order_id, owner)
+        return jsonify({"message": f"Order {order_id} completed successfully"})
+
+@app.route('/abandonorders/<int:order_id>', methods=['POST'])
+@validate_json(LEASE_SCHEMA, error_key="message")
+def abandon_orders(order_id, body):
+    owner = body["owner"]
+    with tracer.start_as_current_span("OrderProcessor: Abandon Order"):
+        error = release_lease(order_id, body["warehouse_id"], owner, "DB: Abandon Order", ABANDON_LEASED_ORDER)
+        if error:
+            return error
+        logger.info("Order %s abandoned by %s", order_id, owner)
+        return jsonify({"message": f"Order {order_id} released"})
+
+@app.route('/fulfilorders/<int:order_id>', methods=['POST'])
+@validate_json(FULFIL_SCHEMA, error_key="message")
+def fulfil_orders(order_id, body):
+    """Pick an order's stock and complete or delete the order, in one transaction.
+
+    By default the order is refused when any line lacks stock; with
+    all_or_nothing false those lines are skipped and reported instead.
+    Stock never goes below zero either way.
+    """
+    owner = body["owner"]
+    delete = body["delete"]
+    all_or_nothing = body["all_or_nothing"]
+    with tracer.start_as_current_span("OrderProcessor: Fulfil Order") as span:
+        span.set_attribute("order.id", order_id)
+        # The order and its warehouse's stock are on the same shard, so this stays one transaction
+        shard = locate_order(order_id, body["warehouse_id"])
+        if shard is None:
+            logger.error("No unprocessed order %s found to fulfil.", order_id)
+            return jsonify({"message": "Order not found"}), 404
+        conn = get_db_connection(shard)
+        cursor = conn.cursor()
+        try:
+            with tracer.start_as_current_span("DB: Lock Order"):
+                LOCK_ORDER.execute(cursor, (order_id,))
+                row = cursor.fetchone()
+            if row is None:
+                conn.rollback()
+                logger.error("No unprocessed order %s found to fulfil.", order_id)
+                return jsonify({"message": "Order not found"}), 404
+            lease_owner, lease_active, warehouse_id = row[4], row[5], row[6]
+            if lease_active and lease_owner != owner:
+                conn.rollback()
+                logger.warning("Order %s is leased by %s, not %s", order_id, lease_owner, owner)
+                return jsonify({"message": "Order is leased by another owner", "lease_owner": lease_owner}), 409
+            lines = {product: quantity for product, quantity in zip(ORDER_PRODUCTS, row[:4]) if quantity}
+            products = sorted(lines)
+
+            with tracer.start_as_current_span("DB: Pick Order Stock"):
+                # Lock in product order, as stock-controller does, so concurrent pickers cannot deadlock
+                LOCK_ORDER_STOCK.execute(cursor, (warehouse_id, products))
+                current = dict(cursor.fetchall())
+                not_found = [product for product in products if product not in current]
+                insufficient = [product for product in products if product in current and current[product] < lines[product]]
+                if not_found or (all_or_nothing and insufficient):
+                    conn.rollback()
+                    logger.warning("Cannot fulfil order %s. Not found: %s. Insufficient: %s.", order_id, not_found, insufficient)
+                    return jsonify({"message": "Order cannot be fulfilled", "not_found": not_found, "insufficient": insufficient}), 409
+                picking = [product for product in products if product not in insufficient]
+                quantities = {product: current[product] for product in insufficient}
+                low_stock = []
+                if picking:
+                    PICK_ORDER_STOCK.execute(cursor, (picking, [lines[product] for product in picking], warehouse_id))
+                    for product, quantity, below_threshold in cursor.fetchall():
+                        quantities[product] = quantity
+                        if below_threshold:
+                            low_stock.append(product)
+                picked = {product: lines[product] for product in picking}
+
+            if delete:
+                with tracer.start_as_current_span("DB: Delete Order"):
+                    DELETE_ORDER.execute(cursor, (order_id,))
+            else:
+                with tracer.start_as_current_span("DB: Complete Order"):
+                    COMPLETE_ORDER.execute(cursor, (order_id,))
+            conn.commit()
+        finally:
+            cursor.close()
+            release_db_connection(shard, conn)
+
+        span.set_attribute("order.insufficient", len(insufficient))
+        logger.info("Fulfilled order %s: picked %s, insufficient %s, below threshold %s. Quantities: %s.",
+                    order_id, picked, insufficient, low_stock, quantities)
+        return jsonify({"message": f"Order {order_id} fulfilled successfully", "order_id": order_id,
+                        "warehouse_id": warehouse_id, "picked": picked, "insufficient": insufficient,
+                        "quantities": quantities, "low_stock": low_stock, "deleted": delete})
+
+@app.route('/stats')
+def stats():
+    return jsonify({"pool": router.stats(), "validation": validation_stats.snapshot(), "statements": statement_stats.snapshot()})
+
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(e):
+    logger.error("Database pool exhausted: %s", e)
+    return jsonify({"error": "Database busy, try again"}), 503
+
+if __name__ == "__main__":
+    logger.info("Processor is starting...")
+    # Drain on SIGTERM, and close the pool however the server stops; registered before app.run blocks
+    lifecycle.install_signal_handlers()
     import atexit
-    atexit.register(shutdown)
\ No newline at end of file
+    atexit.register(lifecycle.shutdown)
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", default=8080)))
\ No newline at end of file
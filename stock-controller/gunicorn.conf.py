@@ -0,0 +1,28 @@
+# Production serving mode: gunicorn -c gunicorn.conf.py stock-controller:app
+import multiprocessing
+import os
+
+bind = "0.0.0.0:" + os.environ.get("PORT", default="8081")
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", default=multiprocessing.cpu_count()))
+threads = int(os.environ.get("GUNICORN_THREADS", default=8))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", default=30))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", default=30))
+keepalive = 5
+accesslog = None
+
+# Every worker imports the app after the fork, so each one builds its own
+# TracerProvider, BatchSpanProcessor export thread and connection pool.
+# Preloading would create them once in the master and share them across forks.
+preload_app = False
+
+def worker_exit(server, worker):
+    # gunicorn has already stopped accepting and waited up to graceful_timeout for in-flight
+    # requests; stop background threads and close this worker's pool, then flush its spans and metrics
+    from tracey_common import lifecycle
+    lifecycle.shutdown_all()
+    from opentelemetry import metrics, trace
+    for provider in (trace.get_tracer_provider(), metrics.get_meter_provider()):
+        shutdown = getattr(provider, "shutdown", None)
+        if shutdown:
+            shutdown()
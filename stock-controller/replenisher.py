@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+import psycopg2
+from opentelemetry import trace
+from stock_cache import parse_stock_key
+from tracey_common.statements import Statement
+
+logger = logging.getLogger(__name__)
+tracer = trace.get_tracer(__name__)
+
+# Channel the stock table trigger notifies when a product drops below its reorder threshold
+LOW_STOCK_CHANNEL = "stock_low"
+
+# Top up every product that is below its threshold and was not replenished within the window.
+# The conditions are re-checked under the row lock, so concurrent workers on other replicas
+# replenish a product at most once per window.
+REPLENISH_SQL = (
+    "UPDATE stock SET stock_quantity = stock_quantity + reorder_quantity, last_replenished_at = now() "
+    "WHERE stock_quantity < reorder_threshold "
+    "AND (last_replenished_at IS NULL OR last_replenished_at <= now() - make_interval(secs => %s)) "
+)
+REPLENISH_ALL = Statement("replenish_all", REPLENISH_SQL + "RETURNING warehouse_id, product, stock_quantity;")
+REPLENISH_PRODUCTS = Statement(
+    "replenish_products",
+    REPLENISH_SQL + "AND (warehouse_id, product) IN (SELECT * FROM unnest(%s::integer[], %s::varchar[])) "
+    "RETURNING warehouse_id, product, stock_quantity;")
+
+
+class Replenisher(threading.Thread):
+    """Background stock replenishment for one database shard of this stock-controller replica.
+
+    (warehouse_id, product) pairs are queued with request() when a stock
+    change leaves them below their reorder threshold, either seen in an
+    adjustment result or announced on the stock_low channel. Requests arriving within batch_delay of each
+    other are replenished with one statement. Every sweep_interval seconds all
+    products are checked, which covers notifications lost while disconnected.
+    """
+
+    def __init__(self, get_db_connection, window, sweep_interval, batch_delay=0.05):
+        super().__init__(name="stock-replenisher", daemon=True)
+        self.get_db_connection = get_db_connection
+        self.window = window
+        self.sweep_interval = sweep_interval
+        self.batch_delay = batch_delay
+        self.counters = {"requests": 0, "runs": 0, "sweeps": 0, "replenished": 0, "errors": 0}
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+
+    def request(self, products):
+        if isinstance(products, str):
+            # A stock_low notification payload
+            products = [parse_stock_key(products)]
+        with self._lock:
+            self._pending.update(products)
+            self.counters["requests"] += len(products)
+        self._wakeup.set()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wakeup.set()
+
+    def replenish(self, products=None):
+        """Run the guarded top-up for (warehouse_id, product) pairs, or for every product.
+
+        Returns {(warehouse_id, product): new quantity}.
+        """
+        with tracer.start_as_current_span("StockController: Replenish Stock") as span:
+            with self.get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    with tracer.start_as_current_span("DB: Replenish Product Stock"):
+                        if products is None:
+                            REPLENISH_ALL.execute(cursor, (self.window,))
+                        else:
+                            warehouse_ids, names = zip(*sorted(products))
+                            REPLENISH_PRODUCTS.execute(cursor, (self.window, list(warehouse_ids), list(names)))
+                        replenished = {(warehouse_id, product): quantity
+                                       for warehouse_id, product, quantity in cursor.fetchall()}
+                    conn.commit()
+            span.set_attribute("stock.replenished", len(replenished))
+        with self._lock:
+            self.counters["runs"] += 1
+            self.counters["replenished"] += len(replenished)
+        if replenished:
+            logger.info("Replenished stock: %s", replenished)
+        return replenished
+
+    def run(self):
+        next_sweep = time.monotonic() + self.sweep_interval
+        while not self._stop_event.is_set():
+            self._wakeup.wait(max(next_sweep - time.monotonic(), 0))
+            if self._stop_event.is_set():
+                return
+            sweep = time.monotonic() >= next_sweep
+            if self._wakeup.is_set():
+                # Let the rest of a burst of triggers arrive before draining them
+                time.sleep(self.batch_delay)
+            self._wakeup.clear()
+            with self._lock:
+                products, self._pending = self._pending, set()
+            try:
+                if sweep:
+                    next_sweep = time.monotonic() + self.sweep_interval
+                    with self._lock:
+                        self.counters["sweeps"] += 1
+                    self.replenish()
+                elif products:
+                    self.replenish(products)
+            except (psycopg2.Error, OSError) as e:
+                with self._lock:
+                    self.counters["errors"] += 1
+                    self._pending.update(products)
+                logger.warning("Stock replenishment failed, retrying later: %s", e)
+                self._stop_event.wait(1.0)
+            except Exception:
+                # Never let the thread die, nothing else refills stock; the next sweep covers these products
+                with self._lock:
+                    self.counters["errors"] += 1
+                logger.exception("Stock replenishment of %s failed", sorted(products) if products else "all products")
+                self._stop_event.wait(1.0)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats.update(pending=len(self._pending), window_seconds=self.window)
+            return stats
@@ -1,75 +1,72 @@
-
 from flask import Flask, jsonify, request
 import logging
 import os
 import psycopg2
-from psycopg2.pool import SimpleConnectionPool
-from contextlib import contextmanager
+from tracey_common.db_pool import BlockingConnectionPool, PoolTimeout
+from tracey_common.lifecycle import ServiceLifecycle
+from tracey_common.logs import configure_logging
+from tracey_common import serialization
+from tracey_common.statements import SQL_COMMENTER, Statement, prepare_all, statement_stats
+from tracey_common.metrics import ServerMetrics
+from tracey_common.sharding import DEFAULT_WAREHOUSE_ID, ShardRouter
+from tracey_common.telemetry import init_metrics, init_tracing
+from tracey_common.validation import Field, Schema, validate_args, validate_json, validation_stats
+from stock_cache import StockCache, StockChangeListener, stock_key
+from replenisher import LOW_STOCK_CHANNEL, Replenisher
+from stock_coalescer import StockWriteCoalescer
 from opentelemetry import trace
 from opentelemetry import context
 from opentelemetry.propagate import extract
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.flask import FlaskInstrumentor
 from opentelemetry.instrumentation.psycopg2 import Psycopg2Instrumentor
-from opentelemetry.trace import get_current_span
-
-logging.basicConfig(level=logging.INFO)
-
-def custom_logger(message, level='info'):
-    current_span = get_current_span()
-    if current_span.is_recording():
-        trace_id = current_span.get_span_context().trace_id
-        span_id = current_span.get_span_context().span_id
-        # Convert to hexadecimal format
-        trace_id_hex = "{:032x}".format(trace_id)
-        span_id_hex = "{:016x}".format(span_id)
-    else:
-        trace_id_hex = span_id_hex = 'N/A'
-
-    log_message = f"[TraceID: {trace_id_hex}, SpanID: {span_id_hex}] {message}"
-
-    if level == 'info':
-        logging.info(log_message)
-    elif level == 'error':
-        logging.error(log_message)
-    elif level == 'warning':
-        logging.warning(log_message)
-    else:
-        logging.debug(log_message)
 
+# Structured JSON logs with trace context, written by a background thread
+configure_logging("stock-controller")
+logger = logging.getLogger("stock-controller")
 
 # Constants
-DATABASE_MAX_CONNECTIONS = 10
-
-# Get the local otel collector IP
-OTEL_HOST = os.environ.get("OTEL_HOST", default="10.10.0.12:4317")
-if not ":" in OTEL_HOST:
-    OTEL_HOST = OTEL_HOST + ":4317"
-print("OTEL Collector Address: {}".format(OTEL_HOST))
-
-# Set OTEL service name and set the trace provider
-resource = Resource(
-    attributes={
-        "service.name": "stock-controller",
-        "version": "v0.0.1",
-        "service.instance.id": "instance-1",
-        "telemetry.sdk.name":"opentelemetry",
-        "telemetry.sdk.language":"python",
-        "telemetry.sdk.version":"1.19.0"
-    }
+DATABASE_MIN_CONNECTIONS = int(os.environ.get("DB_POOL_MIN", default=1))
+DATABASE_MAX_CONNECTIONS = int(os.environ.get("DB_POOL_MAX", default=10))
+DATABASE_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", default=5.0))
+STOCK_CACHE_ENABLED = os.environ.get("STOCK_CACHE_ENABLED", default="true").lower() == "true"
+STOCK_CACHE_TTL = float(os.environ.get("STOCK_CACHE_TTL", default=5.0))
+STOCK_CACHE_MAX_ENTRIES = int(os.environ.get("STOCK_CACHE_MAX_ENTRIES", default=1024))
+REPLENISH_ENABLED = os.environ.get("REPLENISH_ENABLED", default="true").lower() == "true"
+REPLENISH_WINDOW_SECONDS = float(os.environ.get("REPLENISH_WINDOW_SECONDS", default=60))
+REPLENISH_SWEEP_INTERVAL = float(os.environ.get("REPLENISH_SWEEP_INTERVAL", default=60))
+STOCK_GROUP_COMMIT = os.environ.get("STOCK_GROUP_COMMIT", default="false").lower() == "true"
+STOCK_GROUP_COMMIT_WINDOW_MS = float(os.environ.get("STOCK_GROUP_COMMIT_WINDOW_MS", default=5))
+STOCK_GROUP_COMMIT_MAX_REQUESTS = int(os.environ.get("STOCK_GROUP_COMMIT_MAX_REQUESTS", default=64))
+
+# Request layouts, compiled once; bad input is rejected with a 400 before a connection is checked out.
+# Stock is kept per warehouse, and the warehouse picks the database shard.
+WAREHOUSE_FIELD = Field("warehouse_id", int, default=DEFAULT_WAREHOUSE_ID, minimum=0)
+CHECKSTOCK_PARAMS = Schema(Field("product", str, required=True), WAREHOUSE_FIELD, from_strings=True)
+CHANGE_STOCK_SCHEMA = Schema(Field("product", str, required=True), Field("quantity", int, required=True), WAREHOUSE_FIELD)
+ADJUST_STOCK_SCHEMA = Schema(
+    Field("adjustments", list, required=True, min_length=1,
+          items=Schema(Field("product", str, required=True), Field("delta", int, required=True))),
+    Field("all_or_nothing", bool, default=False),
+    WAREHOUSE_FIELD,
 )
-trace.set_tracer_provider(TracerProvider(resource=resource))
 
-# Create OTLP exporter and point it to the OTEL Collector
-otlp_exporter = OTLPSpanExporter(endpoint=OTEL_HOST, insecure=True)
+# The fixed queries, run as prepared statements on each pooled connection
+SELECT_STOCK = Statement("select_stock", "SELECT stock_quantity FROM stock WHERE warehouse_id = %s AND product = %s;")
+LOCK_STOCK = Statement(
+    "lock_stock",
+    "SELECT product, stock_quantity FROM stock WHERE warehouse_id = %s AND product = ANY(%s) "
+    "ORDER BY product FOR UPDATE;")
+ADJUST_STOCK = Statement(
+    "adjust_stock",
+    "UPDATE stock AS s SET stock_quantity = s.stock_quantity + r.delta "
+    "FROM unnest(%s::varchar[], %s::integer[]) AS r(product, delta) "
+    "WHERE s.warehouse_id = %s AND s.product = r.product "
+    "RETURNING s.product, s.stock_quantity, s.stock_quantity < s.reorder_threshold;")
 
-# Set up BatchSpanProcessor and add it to the tracer provider
-trace.get_tracer_provider().add_span_processor(
-    BatchSpanProcessor(otlp_exporter)
-)
+# Set up tracing; sampling, BatchSpanProcessor and exporter settings come from the environment
+init_tracing("stock-controller")
+# Request, statement and pool metrics go to the same collector as OTLP metrics
+init_metrics("stock-controller")
 
 tracer = trace.get_tracer(__name__)
 app = Flask(__name__)
@@ -77,77 +74,243 @@ app = Flask(__name__)
 # Instrument Flask app
 FlaskInstrumentor().instrument_app(app)
 
-# Database parameters:
+# Request duration per route and status; registered first so it times the other request hooks
+server_metrics = ServerMetrics()
+server_metrics.init_app(app)
+
+# Fast JSON encoding for every response and gzip for large ones
+serialization.init_app(app)
+
+# Database parameters; with DB_SHARDS set, the defaults for whatever a shard's DSN leaves out
 db_params = {
-    'dbname': "mydatabase",
-    'user': "user",
-    'password': "password",
-    'host': "postgresql",
-    'port': 5432,
+    'dbname': os.environ.get("DB_NAME", default="mydatabase"),
+    'user': os.environ.get("DB_USER", default="user"),
+    'password': os.environ.get("DB_PASSWORD", default="password"),
+    'host': os.environ.get("DB_HOST", default="postgresql"),
+    'port': int(os.environ.get("DB_PORT", default=5432)),
 }
 
 # Instrument psycopg2
-Psycopg2Instrumentor().instrument(skip_dep_check=True, enable_commenter=True)
+Psycopg2Instrumentor().instrument(skip_dep_check=True, enable_commenter=SQL_COMMENTER)
+
+# One thread-safe database connection pool per shard (DB_SHARDS, or just DB_HOST); callers wait up to
+# DB_POOL_TIMEOUT for a free connection. Pools are created on first use, retrying with backoff, so the
+# service starts before Postgres is reachable. DB_SHARD_MAP assigns warehouses to shards.
+router = ShardRouter(db_params, lambda shard: BlockingConnectionPool(
+    minconn=DATABASE_MIN_CONNECTIONS, maxconn=DATABASE_MAX_CONNECTIONS, timeout=DATABASE_POOL_TIMEOUT,
+    on_wait=server_metrics.pool_wait_recorder(shard.name), **shard.connect_params))
+server_metrics.observe_pools(router.pools)
+
+# /healthz and /readyz, warm-up of DB_POOL_MIN connections per shard (with every statement prepared) and graceful drain
+lifecycle = ServiceLifecycle("stock-controller", router.pools, warm_connection=prepare_all)
+lifecycle.init_app(app)
+lifecycle.start_warmup()
+
+def get_db_connection(warehouse_id):
+    return router.shard_for(warehouse_id).connection()
 
-# Set up a database connection pool
-pool = SimpleConnectionPool(
-    minconn=1, maxconn=DATABASE_MAX_CONNECTIONS, **db_params)
+# Per shard: a stock read cache, kept consistent across replicas by the stock_changed NOTIFY trigger,
+# and background replenishment, triggered by low adjustment results and the stock_low NOTIFY trigger
+stock_caches = {}
+replenishers = {}
+for shard in router.shards:
+    stock_caches[shard.name] = StockCache(max_entries=STOCK_CACHE_MAX_ENTRIES, ttl=STOCK_CACHE_TTL)
+    replenishers[shard.name] = Replenisher(
+        shard.connection, window=REPLENISH_WINDOW_SECONDS, sweep_interval=REPLENISH_SWEEP_INTERVAL)
+    if REPLENISH_ENABLED:
+        replenishers[shard.name].start()
+        lifecycle.on_shutdown(replenishers[shard.name].stop)
 
-@contextmanager
-def get_db_connection():
-    conn = pool.getconn()
-    try:
-        yield conn
-    finally:
-        pool.putconn(conn)
+    if STOCK_CACHE_ENABLED or REPLENISH_ENABLED:
+        # NOTIFY only reaches listeners on the same database, so each shard gets its own listener
+        stock_listener = StockChangeListener(
+            stock_caches[shard.name] if STOCK_CACHE_ENABLED else None, shard.connect_params,
+            handlers={LOW_STOCK_CHANNEL: replenishers[shard.name].request} if REPLENISH_ENABLED else None,
+        )
+        stock_listener.start()
+        lifecycle.on_shutdown(stock_listener.stop)
+
+def shard_stats(components):
+    """stats() of a per-shard component, per shard name when there is more than one shard."""
+    if len(components) == 1:
+        return next(iter(components.values())).stats()
+    return {name: component.stats() for name, component in components.items()}
 
 @app.route('/checkstock')
-def check_stock():
-    product = request.args.get("product")
-    with tracer.start_as_current_span("StockController: Check Stock"):
-        with get_db_connection() as conn:
+@validate_args(CHECKSTOCK_PARAMS)
+def check_stock(params):
+    product = params["product"]
+    warehouse_id = params["warehouse_id"]
+    key = stock_key(warehouse_id, product)
+    stock_cache = stock_caches[router.shard_for(warehouse_id).name]
+    with tracer.start_as_current_span("StockController: Check Stock") as span:
+        # Cache-Control: no-cache asks for a strongly consistent read from Postgres
+        if "no-cache" in request.headers.get("Cache-Control", ""):
+            stock_cache.count_bypass()
+        else:
+            hit, quantity = stock_cache.get(key)
+            span.set_attribute("stock.cache.hit", hit)
+            if hit:
+                logger.info("Checked stock for product: %s. Quantity: %s (cached).", product, quantity)
+                return jsonify({"product": product, "quantity": quantity})
+        generation = stock_cache.generation(key)
+        with get_db_connection(warehouse_id) as conn:
             with conn.cursor() as cursor:
                 with tracer.start_as_current_span("DB: Check Product Stock"):
-                    cursor.execute("SELECT stock_quantity FROM stock WHERE product = %s;", (product,))
+                    SELECT_STOCK.execute(cursor, (warehouse_id, product))
                     stock = cursor.fetchone()
                     if stock:
-                        custom_logger(f"Checked stock for product: {product}. Quantity: {stock[0]}.")
+                        stock_cache.put(key, stock[0], generation)
+                        logger.info("Checked stock for product: %s. Quantity: %s.", product, stock[0])
                         return jsonify({"product": product, "quantity": stock[0]})
-                    custom_logger(f"Product: {product} not found in stock.", level='warning')
+                    logger.warning("Product: %s not found in stock.", product)
                     return jsonify({"error": "Product not found"}), 404
 
-@app.route('/increasestock', methods=['POST'])
-def increase_stock():
-    product = request.json.get("product")
-    quantity = request.json.get("quantity")
-    with tracer.start_as_current_span("StockController: Increase Stock"):
-        with get_db_connection() as conn:
+class StockAdjustmentError(Exception):
+    """Raised when an all-or-nothing adjustment cannot be applied in full."""
+
+    def __init__(self, not_found, insufficient):
+        super().__init__("Stock adjustment rejected")
+        self.not_found = not_found
+        self.insufficient = insufficient
+
+def adjust_stock_levels(cursor, warehouse_id, deltas, all_or_nothing=False):
+    """Apply {product: delta} to a warehouse's stock in the caller's transaction and return the resulting quantities.
+
+    Unknown products are left out of the result. With all_or_nothing the rows
+    are locked first and StockAdjustmentError is raised, before anything is
+    changed, if a product is missing or would go negative. Products left below
+    their reorder threshold are queued for the replenisher, whose update waits
+    for this transaction's row locks.
+    """
+    products = sorted(deltas)
+    if all_or_nothing or len(products) > 1:
+        # Lock in a fixed order so concurrent multi-product adjustments cannot deadlock
+        LOCK_STOCK.execute(cursor, (warehouse_id, products))
+        current = dict(cursor.fetchall())
+        if all_or_nothing:
+            not_found = [product for product in products if product not in current]
+            insufficient = {
+                product: {"quantity": current[product], "delta": deltas[product]}
+                for product in products
+                if product in current and current[product] + deltas[product] < 0
+            }
+            if not_found or insufficient:
+                raise StockAdjustmentError(not_found, insufficient)
+    ADJUST_STOCK.execute(cursor, (products, [deltas[product] for product in products], warehouse_id))
+    rows = cursor.fetchall()
+    low_stock = [(warehouse_id, product) for product, _, below_threshold in rows if below_threshold]
+    if low_stock and REPLENISH_ENABLED:
+        replenishers[router.shard_for(warehouse_id).name].request(low_stock)
+    return {product: quantity for product, quantity, _ in rows}
+
+def sum_adjustments(adjustments):
+    """Sum validated {"product", "delta"} entries into {product: delta}."""
+    deltas = {}
+    for adjustment in adjustments:
+        deltas[adjustment["product"]] = deltas.get(adjustment["product"], 0) + adjustment["delta"]
+    return deltas
+
+def invalidate_cached_stock(warehouse_id, products):
+    stock_cache = stock_caches[router.shard_for(warehouse_id).name]
+    for product in products:
+        stock_cache.invalidate(stock_key(warehouse_id, product))
+
+def invalidate_flushed_stock(quantities):
+    for warehouse_id, product in quantities:
+        invalidate_cached_stock(warehouse_id, [product])
+
+# Optional group commit for /increasestock and /decreasestock: concurrent changes are
+# summed per product and written in one transaction per shard instead of queueing on the row locks
+stock_coalescers = {}
+if STOCK_GROUP_COMMIT:
+    for shard in router.shards:
+        stock_coalescers[shard.name] = StockWriteCoalescer(
+            shard.connection, adjust_stock_levels, window=STOCK_GROUP_COMMIT_WINDOW_MS / 1000,
+            max_requests=STOCK_GROUP_COMMIT_MAX_REQUESTS, on_flushed=invalidate_flushed_stock)
+        # Flushes what is still queued while the pools are open
+        lifecycle.on_shutdown(stock_coalescers[shard.name].stop)
+
+def change_stock(warehouse_id, product, delta, span_name):
+    """Single-product adjustment shared by the increase and decrease routes."""
+    if stock_coalescers:
+        with tracer.start_as_current_span(span_name):
+            return stock_coalescers[router.shard_for(warehouse_id).name].submit(warehouse_id, product, delta)
+    with get_db_connection(warehouse_id) as conn:
+        with conn.cursor() as cursor:
+            with tracer.start_as_current_span(span_name):
+                quantities = adjust_stock_levels(cursor, warehouse_id, {product: delta})
+                conn.commit()
+    # Other replicas are invalidated by the NOTIFY trigger; do this one right away
+    invalidate_cached_stock(warehouse_id, [product])
+    return quantities.get(product)
+
+@app.route('/adjuststock', methods=['POST'])
+@validate_json(ADJUST_STOCK_SCHEMA)
+def adjust_stock(body):
+    with tracer.start_as_current_span("StockController: Adjust Stock"):
+        deltas = sum_adjustments(body["adjustments"])
+        all_or_nothing = body["all_or_nothing"]
+        warehouse_id = body["warehouse_id"]
+        with get_db_connection(warehouse_id) as conn:
             with conn.cursor() as cursor:
-                with tracer.start_as_current_span("DB: Increase Product Stock"):
-                    cursor.execute("UPDATE stock SET stock_quantity = stock_quantity + %s WHERE product = %s;", (quantity, product))
+                with tracer.start_as_current_span("DB: Adjust Product Stock"):
+                    try:
+                        quantities = adjust_stock_levels(cursor, warehouse_id, deltas, all_or_nothing=all_or_nothing)
+                    except StockAdjustmentError as e:
+                        conn.rollback()
+                        logger.warning("Rejected all-or-nothing stock adjustment. Not found: %s. Insufficient: %s.", e.not_found, e.insufficient)
+                        status = 404 if e.not_found and not e.insufficient else 409
+                        return jsonify({"error": "Stock adjustment rejected", "not_found": e.not_found, "insufficient": e.insufficient}), status
                     conn.commit()
-                    custom_logger(f"Increased stock for product: {product} by {quantity}.")
-                    return jsonify({"message": "Stock increased successfully"})
+        invalidate_cached_stock(warehouse_id, quantities)
+        not_found = [product for product in deltas if product not in quantities]
+        logger.info("Adjusted stock: %s. Quantities: %s.", deltas, quantities)
+        return jsonify({"message": "Stock adjusted successfully", "quantities": quantities, "not_found": not_found})
+
+@app.route('/increasestock', methods=['POST'])
+@validate_json(CHANGE_STOCK_SCHEMA)
+def increase_stock(body):
+    product = body["product"]
+    quantity = body["quantity"]
+    with tracer.start_as_current_span("StockController: Increase Stock"):
+        new_quantity = change_stock(body["warehouse_id"], product, quantity, "DB: Increase Product Stock")
+        if new_quantity is None:
+            logger.warning("Product: %s not found in stock.", product)
+            return jsonify({"error": "Product not found"}), 404
+        logger.info("Increased stock for product: %s by %s.", product, quantity)
+        return jsonify({"message": "Stock increased successfully", "product": product, "quantity": new_quantity})
 
 @app.route('/decreasestock', methods=['POST'])
-def decrease_stock():
-    product = request.json.get("product")
-    quantity = request.json.get("quantity")
+@validate_json(CHANGE_STOCK_SCHEMA)
+def decrease_stock(body):
+    product = body["product"]
+    quantity = body["quantity"]
     with tracer.start_as_current_span("StockController: Decrease Stock"):
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                with tracer.start_as_current_span("DB: Decrease Product Stock"):
-                    cursor.execute("UPDATE stock SET stock_quantity = stock_quantity - %s WHERE product = %s;", (quantity, product))
-                    conn.commit()
-                    custom_logger(f"Decreased stock for product: {product} by {quantity}.")
-                    return jsonify({"message": "Stock decreased successfully"})
+        new_quantity = change_stock(body["warehouse_id"], product, -quantity, "DB: Decrease Product Stock")
+        if new_quantity is None:
+            logger.warning("Product: %s not found in stock.", product)
+            return jsonify({"error": "Product not found"}), 404
+        logger.info("Decreased stock for product: %s by %s.", product, quantity)
+        return jsonify({"message": "Stock decreased successfully", "product": product, "quantity": new_quantity})
 
-if __name__ == "__main__":
-    app.logger.info('Stock Controller is starting...')
-    app.run(host="0.0.0.0", port=8081)
+@app.route('/stats')
+def stats():
+    stats = {"cache": shard_stats(stock_caches), "replenisher": shard_stats(replenishers),
+             "pool": router.stats(), "validation": validation_stats.snapshot(), "statements": statement_stats.snapshot()}
+    if stock_coalescers:
+        stats["group_commit"] = shard_stats(stock_coalescers)
+    return jsonify(stats)
 
-    # Close all connections in the pool when the app shuts down
-    def shutdown():
-        pool.closeall()
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(e):
+    logger.error("Database pool exhausted: %s", e)
+    return jsonify({"error": "Database busy, try again"}), 503
+
+if __name__ == "__main__":
+    logger.info('Stock Controller is starting...')
+    # Drain on SIGTERM, and close the pool however the server stops; registered before app.run blocks
+    lifecycle.install_signal_handlers()
     import atexit
-    atexit.register(shutdown)
\ No newline at end of file
+    atexit.register(lifecycle.shutdown)
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", default=8081)))
\ No newline at end of file
@@ -0,0 +1,164 @@
+import logging
+import select
+import threading
+import time
+from collections import OrderedDict
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+# Channel the stock table trigger notifies with the changed row's stock_key
+STOCK_CHANNEL = "stock_changed"
+
+# How long the listener waits for a notification before checking whether it should stop
+LISTEN_POLL_TIMEOUT = 5.0
+LISTEN_RETRY_MAX_DELAY = 30.0
+
+
+def stock_key(warehouse_id, product):
+    """The cache key, and NOTIFY payload, for a product in a warehouse: "warehouse_id:product"."""
+    return f"{warehouse_id}:{product}"
+
+
+def parse_stock_key(key):
+    warehouse_id, _, product = key.partition(":")
+    return int(warehouse_id), product
+
+
+class StockCache:
+    """Bounded read-through cache of stock quantities with a TTL.
+
+    Entries are only served while the change listener is connected, so a lost
+    LISTEN connection degrades to reading from Postgres rather than to stale
+    reads. Entries are keyed by stock_key(warehouse_id, product). Each key
+    carries an invalidation generation: a value read from the database is
+    only stored if no invalidation arrived while it was read.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.listening = False
+        self.counters = {"hits": 0, "misses": 0, "bypasses": 0, "invalidations": 0, "evictions": 0}
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (True, quantity) on a hit, (False, None) otherwise."""
+        with self._lock:
+            entry = self._entries.get(key) if self.listening else None
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return True, entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.counters["misses"] += 1
+            return False, None
+
+    def count_bypass(self):
+        with self._lock:
+            self.counters["bypasses"] += 1
+
+    def generation(self, key):
+        with self._lock:
+            return self._epoch, self._generations.get(key, 0)
+
+    def put(self, key, quantity, generation):
+        with self._lock:
+            if not self.listening or generation != (self._epoch, self._generations.get(key, 0)):
+                return
+            self._entries[key] = (quantity, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._entries.pop(key, None)
+            self.counters["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._generations.clear()
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats.update(entries=len(self._entries), listening=self.listening)
+            return stats
+
+
+class StockChangeListener(threading.Thread):
+    """Invalidate cache entries from Postgres NOTIFY events on the stock channel.
+
+    Uses its own autocommit connection outside the pool and reconnects with
+    backoff; the cache is cleared and switched off while disconnected, since
+    notifications sent in the meantime are lost. handlers maps further
+    channels to callables taking the notification payload; cache may be None
+    to listen for those alone.
+    """
+
+    def __init__(self, cache, db_params, handlers=None):
+        super().__init__(name="stock-change-listener", daemon=True)
+        self.cache = cache
+        self.db_params = db_params
+        self.handlers = dict(handlers or {})
+        if cache is not None:
+            self.handlers[STOCK_CHANNEL] = cache.invalidate
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _listen(self):
+        conn = psycopg2.connect(**self.db_params)
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                for channel in self.handlers:
+                    cursor.execute(f"LISTEN {channel};")
+            if self.cache is not None:
+                self.cache.clear()
+                self.cache.listening = True
+            logger.info("Listening for stock changes on %s", sorted(self.handlers))
+            while not self._stop_event.is_set():
+                if select.select([conn], [], [], LISTEN_POLL_TIMEOUT) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    try:
+                        self.handlers[notify.channel](notify.payload)
+                    except Exception:
+                        logger.exception("Handling %s notification %r failed", notify.channel, notify.payload)
+                        if self.cache is not None and notify.channel == STOCK_CHANNEL:
+                            # The entry it should have dropped may now be stale
+                            self.cache.clear()
+        finally:
+            if self.cache is not None:
+                self.cache.listening = False
+                self.cache.clear()
+            conn.close()
+
+    def run(self):
+        delay = 1.0
+        while not self._stop_event.is_set():
+            started = time.monotonic()
+            try:
+                self._listen()
+            except (psycopg2.Error, OSError) as e:
+                logger.warning("Stock cache listener disconnected, retrying in %.0fs: %s", delay, e)
+            except Exception:
+                # Never let the thread die: the cache is already bypassed and is re-enabled on reconnect
+                logger.exception("Stock cache listener failed, reconnecting in %.0fs", delay)
+            if time.monotonic() - started > LISTEN_RETRY_MAX_DELAY:
+                delay = 1.0
+            self._stop_event.wait(delay)
+            delay = min(delay * 2, LISTEN_RETRY_MAX_DELAY)
@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+from opentelemetry import trace
+from opentelemetry.trace import Link
+
+logger = logging.getLogger(__name__)
+tracer = trace.get_tracer(__name__)
+
+
+class _Waiter:
+    __slots__ = ("key", "delta", "span_context", "done", "quantity", "error")
+
+    def __init__(self, key, delta, span_context):
+        self.key = key
+        self.delta = delta
+        self.span_context = span_context
+        self.done = threading.Event()
+        self.quantity = None
+        self.error = None
+
+
+class StockWriteCoalescer:
+    """Group commit for single-product stock changes.
+
+    Requests are queued and a flusher thread applies everything that arrived
+    within window seconds (or once max_requests are waiting) as one summed
+    update per warehouse and product in a single transaction, with
+    apply_deltas(cursor, warehouse_id, {product: delta}) called per warehouse
+    in warehouse order. Each request is acknowledged
+    only after that commit, with the quantity it would have seen had the
+    batch been applied one request at a time in arrival order. The flush span
+    links to the span of every request in the batch. stop() flushes what is
+    still queued and ends the flusher; changes submitted after it are refused.
+    """
+
+    def __init__(self, get_db_connection, apply_deltas, window, max_requests, on_flushed=None):
+        self.get_db_connection = get_db_connection
+        self.apply_deltas = apply_deltas
+        self.window = window
+        self.max_requests = max_requests
+        self.on_flushed = on_flushed
+        self.counters = {"batches": 0, "requests": 0, "errors": 0, "batch_size_max": 0}
+        self.flush_seconds_total = 0.0
+        self.flush_seconds_max = 0.0
+        self._queue = []
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="stock-group-commit", daemon=True)
+        self._thread.start()
+
+    def submit(self, warehouse_id, product, delta):
+        """Queue a change and block until it is committed; returns the product's quantity, or None if unknown."""
+        waiter = _Waiter((warehouse_id, product), delta, trace.get_current_span().get_span_context())
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("Stock group commit is shut down")
+            self._queue.append(waiter)
+            if len(self._queue) == 1 or len(self._queue) >= self.max_requests:
+                self._condition.notify()
+        waiter.done.wait()
+        if waiter.error is not None:
+            raise waiter.error
+        return waiter.quantity
+
+    def stop(self, timeout=10):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join(timeout)
+
+    def _next_batch(self):
+        """The next batch to flush, or None once stopped with nothing left to flush."""
+        with self._condition:
+            while not self._queue:
+                if self._stopped:
+                    return None
+                self._condition.wait()
+            deadline = time.monotonic() + self.window
+            while len(self._queue) < self.max_requests and not self._stopped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch, self._queue = self._queue[:self.max_requests], self._queue[self.max_requests:]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self._flush(batch)
+            except Exception as e:
+                logger.warning("Stock group commit of %s requests failed: %s", len(batch), e)
+                with self._condition:
+                    self.counters["errors"] += 1
+                for waiter in batch:
+                    waiter.error = e
+            finally:
+                for waiter in batch:
+                    waiter.done.set()
+
+    def _flush(self, batch):
+        deltas = {}
+        for waiter in batch:
+            deltas[waiter.key] = deltas.get(waiter.key, 0) + waiter.delta
+        warehouses = {}
+        for (warehouse_id, product), delta in deltas.items():
+            warehouses.setdefault(warehouse_id, {})[product] = delta
+        links = [Link(waiter.span_context) for waiter in batch if waiter.span_context.is_valid]
+        start = time.perf_counter()
+        with tracer.start_as_current_span("StockController: Group Commit Stock", links=links) as span:
+            span.set_attribute("stock.batch.requests", len(batch))
+            span.set_attribute("stock.batch.products", len(deltas))
+            with self.get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    quantities = {}
+                    with tracer.start_as_current_span("DB: Adjust Product Stock"):
+                        # Warehouses in a fixed order, then products, so row locks are always taken in one order
+                        for warehouse_id in sorted(warehouses):
+                            applied = self.apply_deltas(cursor, warehouse_id, warehouses[warehouse_id])
+                            quantities.update(((warehouse_id, product), quantity) for product, quantity in applied.items())
+                    conn.commit()
+        elapsed = time.perf_counter() - start
+
+        # Replay the batch in arrival order from the quantities before it
+        running = {key: quantity - deltas[key] for key, quantity in quantities.items()}
+        for waiter in batch:
+            if waiter.key in running:
+                running[waiter.key] += waiter.delta
+                waiter.quantity = running[waiter.key]
+
+        with self._condition:
+            self.counters["batches"] += 1
+            self.counters["requests"] += len(batch)
+            self.counters["batch_size_max"] = max(self.counters["batch_size_max"], len(batch))
+            self.flush_seconds_total += elapsed
+            self.flush_seconds_max = max(self.flush_seconds_max, elapsed)
+        logger.debug("Group committed %s stock changes for %s products in %.1f ms", len(batch), len(deltas), 1000 * elapsed)
+        if self.on_flushed:
+            self.on_flushed(quantities)
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self.counters)
+            batches = stats["batches"]
+            stats["batch_size_avg"] = round(stats["requests"] / batches, 2) if batches else 0.0
+            stats["flush_latency_avg_ms"] = round(1000 * self.flush_seconds_total / batches, 2) if batches else 0.0
+            stats["flush_latency_max_ms"] = round(1000 * self.flush_seconds_max, 2)
+            stats["queued"] = len(self._queue)
+            return stats
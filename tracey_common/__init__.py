@@ -0,0 +1 @@
+"""Code shared by the Tracey Reloaded services, copied into each image next to the service."""
@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(PoolError):
+    """Raised when no connection became free within the pool timeout."""
+
+
+class BlockingConnectionPool(ThreadedConnectionPool):
+    """Thread-safe psycopg2 pool that waits for a free connection instead of raising.
+
+    ThreadedConnectionPool raises PoolError as soon as maxconn connections are
+    checked out. Here a request thread waits up to timeout seconds for one to
+    be returned, and only then raises PoolTimeout. Checkouts that had to wait
+    and those that timed out are counted, and on_wait(seconds) is called with
+    each wait.
+
+    Returned connections are reset first: an open or aborted transaction is
+    rolled back, and a connection that is closed, lost or fails to roll back
+    is discarded rather than handed to the next request.
+    """
+
+    def __init__(self, minconn, maxconn, *args, timeout=5.0, on_wait=None, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.timeout = timeout
+        self.on_wait = on_wait
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self.counters = {"rolled_back": 0, "discarded": 0, "waits": 0, "timeouts": 0}
+        self._counter_lock = threading.Lock()
+
+    def _count(self, key):
+        with self._counter_lock:
+            self.counters[key] += 1
+
+    def _reset(self, conn):
+        """Return True if conn is clean and reusable, rolling back any transaction left open."""
+        if conn.closed:
+            return False
+        status = conn.info.transaction_status
+        if status == extensions.TRANSACTION_STATUS_IDLE:
+            return True
+        if status in (extensions.TRANSACTION_STATUS_INTRANS, extensions.TRANSACTION_STATUS_INERROR):
+            try:
+                conn.rollback()
+            except psycopg2.Error as e:
+                logger.warning("Discarding database connection that failed to roll back: %s", e)
+                return False
+            self._count("rolled_back")
+            return True
+        # A statement still running or the server connection lost
+        return False
+
+    def getconn(self, key=None, timeout=None):
+        # A free slot is taken without timing anything; only exhausted checkouts are measured
+        if not self._slots.acquire(blocking=False):
+            timeout = self.timeout if timeout is None else timeout
+            self._count("waits")
+            start = time.perf_counter()
+            acquired = self._slots.acquire(timeout=timeout)
+            if self.on_wait:
+                self.on_wait(time.perf_counter() - start)
+            if not acquired:
+                self._count("timeouts")
+                raise PoolTimeout(f"No database connection became available within {timeout}s")
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            if not close and conn is not None and not self._reset(conn):
+                self._count("discarded")
+                close = True
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        with self._counter_lock:
+            stats = dict(self.counters)
+        stats.update(idle=len(self._pool), in_use=len(self._used), max=self.maxconn)
+        return stats
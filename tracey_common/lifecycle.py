@@ -0,0 +1,261 @@
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import psycopg2
+from flask import jsonify, request
+from opentelemetry import metrics, trace
+from psycopg2.pool import PoolError
+from tracey_common.db_pool import PoolTimeout
+
+logger = logging.getLogger(__name__)
+
+# Settings, overridable by environment variables
+DB_CONNECT_RETRY_INITIAL = float(os.environ.get("DB_CONNECT_RETRY_INITIAL", default=0.5))
+DB_CONNECT_RETRY_MAX = float(os.environ.get("DB_CONNECT_RETRY_MAX", default=10.0))
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", default=25.0))
+READY_CHECK_TIMEOUT = float(os.environ.get("READY_CHECK_TIMEOUT", default=1.0))
+
+PROBE_PATHS = ("/healthz", "/readyz")
+
+# Every lifecycle in this process, so a server hook can shut them all down
+_lifecycles = []
+
+
+class PoolUnavailable(PoolTimeout):
+    """Raised while the database cannot be reached and the pool does not exist yet."""
+
+
+class LazyPool:
+    """Connection pool created on first use instead of at import.
+
+    If Postgres is not reachable the failure is remembered and callers get
+    PoolUnavailable straight away until the next attempt is due, with the
+    delay doubling up to DB_CONNECT_RETRY_MAX. The service therefore starts,
+    answers probes and recovers once the database is up.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.last_error = None
+        self._pool = None
+        self._lock = threading.Lock()
+        self._delay = DB_CONNECT_RETRY_INITIAL
+        self._next_attempt = 0.0
+
+    @property
+    def created(self):
+        return self._pool is not None
+
+    def get(self):
+        pool = self._pool
+        if pool is not None:
+            return pool
+        with self._lock:
+            if self._pool is not None:
+                return self._pool
+            if time.monotonic() < self._next_attempt:
+                raise PoolUnavailable(f"Database unavailable: {self.last_error}")
+            try:
+                self._pool = self.factory()
+            except psycopg2.Error as e:
+                self.last_error = str(e).strip()
+                self._next_attempt = time.monotonic() + self._delay
+                logger.warning("Could not create database pool, retrying in %.1fs: %s", self._delay, self.last_error)
+                self._delay = min(self._delay * 2, DB_CONNECT_RETRY_MAX)
+                raise PoolUnavailable(f"Database unavailable: {self.last_error}") from e
+            self.last_error = None
+            self._delay = DB_CONNECT_RETRY_INITIAL
+            logger.info("Database pool created")
+            return self._pool
+
+    def getconn(self, key=None, timeout=None):
+        return self.get().getconn(key, timeout)
+
+    def putconn(self, conn=None, key=None, close=False):
+        pool = self._pool
+        if pool is None or pool.closed:
+            # Returned after closeall() during drain or worker exit; there is no pool left to take it back
+            if conn is not None and not conn.closed:
+                conn.close()
+            return
+        pool.putconn(conn, key, close)
+
+    def closeall(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None and not pool.closed:
+            pool.closeall()
+
+    def stats(self):
+        pool = self._pool
+        if pool is None:
+            return {"created": False, "last_error": self.last_error}
+        return dict(pool.stats(), created=True)
+
+
+class ServiceLifecycle:
+    """Warm-up, health probes and graceful drain for one Flask service.
+
+    pools maps a name to each LazyPool the service uses (one per database
+    shard). A background thread creates every pool, checks out its minconn
+    connections and runs warm_connection(cursor) on each, retrying with
+    backoff until it succeeds; /readyz reports ready only after that, and
+    while every shard answers. /healthz is liveness and does not touch the
+    database. On drain new requests get 503, in-flight ones are given up to
+    DRAIN_TIMEOUT to finish, then spans are flushed and the pools are closed.
+    """
+
+    def __init__(self, service_name, pools, warm_connection=None):
+        self.service_name = service_name
+        self.pools = pools
+        self.warm_connection = warm_connection
+        self.warmed = False
+        self.draining = False
+        self.in_flight = 0
+        self._idle = threading.Condition()
+        self._shut_down = False
+        self._shutdown_callbacks = []
+        _lifecycles.append(self)
+
+    def on_shutdown(self, callback):
+        """Run callback (e.g. stopping a background thread) on shutdown, before the pools are closed."""
+        self._shutdown_callbacks.append(callback)
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule("/healthz", "healthz", self.healthz)
+        app.add_url_rule("/readyz", "readyz", self.readyz)
+
+    def start_warmup(self):
+        thread = threading.Thread(target=self._warm_up, name=f"{self.service_name}-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def _warm_up(self):
+        delay = DB_CONNECT_RETRY_INITIAL
+        pending = list(self.pools.items())
+        while not self.draining:
+            try:
+                while pending:
+                    self._warm_once(pending[0][1])
+                    pending.pop(0)
+                self.warmed = True
+                logger.info("Warmed %s database connections, ready",
+                            sum(pool.get().minconn for pool in self.pools.values()))
+                return
+            except (psycopg2.Error, PoolError) as e:
+                logger.warning("Warm-up of %s failed, retrying in %.1fs: %s", pending[0][0], delay, e)
+            time.sleep(delay)
+            delay = min(delay * 2, DB_CONNECT_RETRY_MAX)
+
+    def _warm_once(self, lazy_pool):
+        pool = lazy_pool.get()
+        conns = []
+        try:
+            for _ in range(pool.minconn):
+                conns.append(pool.getconn())
+            for conn in conns:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1;")
+                    if self.warm_connection:
+                        self.warm_connection(cursor)
+                conn.commit()
+        finally:
+            for conn in conns:
+                pool.putconn(conn)
+
+    def _before_request(self):
+        if request.path in PROBE_PATHS:
+            return None
+        if self.draining:
+            response = jsonify({"error": "Service is shutting down"})
+            response.status_code = 503
+            response.headers["Connection"] = "close"
+            return response
+        with self._idle:
+            self.in_flight += 1
+        request.environ["tracey.in_flight"] = True
+        return None
+
+    def _teardown_request(self, exc):
+        if request.environ.pop("tracey.in_flight", False):
+            with self._idle:
+                self.in_flight -= 1
+                if self.in_flight == 0:
+                    self._idle.notify_all()
+
+    def _check_database(self, pool):
+        conn = pool.getconn(timeout=READY_CHECK_TIMEOUT)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            conn.commit()
+        finally:
+            pool.putconn(conn)
+
+    def _pool_stats(self):
+        if len(self.pools) == 1:
+            return next(iter(self.pools.values())).stats()
+        return {name: pool.stats() for name, pool in self.pools.items()}
+
+    def healthz(self):
+        return jsonify({"status": "ok", "draining": self.draining, "in_flight": self.in_flight,
+                        "pool": self._pool_stats()})
+
+    def readyz(self):
+        status = {"warmed": self.warmed, "draining": self.draining, "pool": self._pool_stats()}
+        if self.draining or not self.warmed:
+            return jsonify(dict(status, status="not ready")), 503
+        for name, pool in self.pools.items():
+            try:
+                self._check_database(pool)
+            except (psycopg2.Error, PoolError) as e:
+                return jsonify(dict(status, status="not ready", database=str(e).strip(), shard=name)), 503
+        return jsonify(dict(status, status="ready"))
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """Stop taking requests and wait up to timeout for in-flight ones; returns True if none are left."""
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self.in_flight > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning("Drain timed out with %s requests in flight", self.in_flight)
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def shutdown(self):
+        """Stop background work, flush pending spans and metrics and close the pools; safe to call more than once."""
+        if self._shut_down:
+            return
+        self._shut_down = True
+        self.draining = True
+        for callback in self._shutdown_callbacks:
+            callback()
+        for provider in (trace.get_tracer_provider(), metrics.get_meter_provider()):
+            if hasattr(provider, "force_flush"):
+                provider.force_flush()
+        for pool in self.pools.values():
+            pool.closeall()
+        logger.info("%s shut down", self.service_name)
+
+    def install_signal_handlers(self):
+        """For the development server: drain and shut down on SIGTERM, then exit."""
+        def handle_sigterm(signum, frame):
+            logger.info("SIGTERM received, draining %s in-flight requests", self.in_flight)
+            self.drain()
+            self.shutdown()
+            sys.exit(0)
+        signal.signal(signal.SIGTERM, handle_sigterm)
+
+
+def shutdown_all():
+    """Shut down every lifecycle in this process (for gunicorn's worker_exit hook)."""
+    for lifecycle in _lifecycles:
+        lifecycle.shutdown()
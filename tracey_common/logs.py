@@ -0,0 +1,197 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from opentelemetry.trace import get_current_span
+
+# Settings, overridable by environment variables
+LOG_LEVEL = os.environ.get("LOG_LEVEL", default="INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", default="json")
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", default=10000))
+LOG_MAX_MESSAGE_CHARS = int(os.environ.get("LOG_MAX_MESSAGE_CHARS", default=2048))
+LOG_RATE_LIMIT = float(os.environ.get("LOG_RATE_LIMIT", default=50))
+LOG_RATE_BURST = float(os.environ.get("LOG_RATE_BURST", default=100))
+LOG_SAMPLE_RATIO = float(os.environ.get("LOG_SAMPLE_RATIO", default=1.0))
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s [TraceID: %(trace_id)s, SpanID: %(span_id)s] %(message)s"
+
+
+class TraceContextFilter(logging.Filter):
+    """Add trace_id and span_id of the current span to every record that is emitted.
+
+    Attached to the queue handler, so it runs in the logging thread (where the
+    span is current) and only for records that passed the level check.
+    """
+
+    def filter(self, record):
+        span_context = get_current_span().get_span_context()
+        if span_context.is_valid:
+            record.trace_id = format(span_context.trace_id, "032x")
+            record.span_id = format(span_context.span_id, "016x")
+        else:
+            record.trace_id = record.span_id = "N/A"
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per message template, plus head sampling of records below WARNING.
+
+    Keyed on the unformatted message, so a hot log line is limited on its own
+    without silencing others. The number of records suppressed since the last
+    one that got through is attached to it as "suppressed".
+    """
+
+    def __init__(self, rate=LOG_RATE_LIMIT, burst=LOG_RATE_BURST, sample_ratio=LOG_SAMPLE_RATIO, max_keys=1000):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample_ratio = sample_ratio
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._sample_counter = 0
+
+    def filter(self, record):
+        if self.sample_ratio < 1.0 and record.levelno < logging.WARNING:
+            # Deterministic sampling avoids a random() call per record: keep the nth record when
+            # floor(n * ratio) steps up, so the first n records keep floor(n * ratio) of them
+            with self._lock:
+                self._sample_counter += 1
+                n = self._sample_counter
+                if int(n * self.sample_ratio) == int((n - 1) * self.sample_ratio):
+                    return False
+        if self.rate <= 0:
+            return True
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.clear()
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1.0:
+                bucket[0] = tokens
+                bucket[2] += 1
+                return False
+            bucket[0] = tokens - 1.0
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+        return True
+
+
+class MergeMessageFilter(logging.Filter):
+    """Merge args and any traceback into the message and cap its size.
+
+    Attached to the stream handler, so it runs on the listener thread. The
+    record reaches the formatter as a plain message, whatever the format.
+    """
+
+    def __init__(self, max_message_chars=LOG_MAX_MESSAGE_CHARS):
+        super().__init__()
+        self.max_message_chars = max_message_chars
+        self._formatter = logging.Formatter()
+
+    def filter(self, record):
+        msg = self._formatter.format(record)
+        if len(msg) > self.max_message_chars:
+            msg = f"{msg[:self.max_message_chars]}... [truncated {len(msg) - self.max_message_chars} chars]"
+        record.msg = msg
+        record.args = None
+        record.exc_info = record.exc_text = record.stack_info = None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; runs on the listener thread, off the request path."""
+
+    def __init__(self, service_name):
+        super().__init__()
+        self.service_name = service_name
+
+    def format(self, record):
+        entry = {
+            "timestamp": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + ".%03dZ" % record.msecs,
+            "level": record.levelname,
+            "service": self.service_name,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "trace_id": getattr(record, "trace_id", "N/A"),
+            "span_id": getattr(record, "span_id", "N/A"),
+        }
+        suppressed = getattr(record, "suppressed", None)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        return json.dumps(entry)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Queue handler that drops records when the queue is full instead of blocking or raising."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Only a shallow copy here; the message is merged and formatted on the listener thread,
+        # so log values rather than objects the caller goes on to change
+        return copy.copy(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+
+
+def configure_logging(service_name, level=LOG_LEVEL):
+    """Route the root logger through a bounded queue to a background stdout writer.
+
+    Request threads only run the level check, the trace/rate-limit filters, a
+    record copy and a queue put; merging the message with its args, formatting
+    and writing happen on the listener thread.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(TraceContextFilter())
+    queue_handler.addFilter(RateLimitFilter())
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.addFilter(MergeMessageFilter())
+    if LOG_FORMAT == "text":
+        stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    else:
+        stream_handler.setFormatter(JsonFormatter(service_name))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flush queued records and stop the background writer."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
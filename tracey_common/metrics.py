@@ -0,0 +1,97 @@
+import threading
+import time
+from flask import request
+from opentelemetry import metrics
+from opentelemetry.metrics import Observation
+
+# Created on the API's proxy meter, which forwards to the MeterProvider once init_metrics sets it
+meter = metrics.get_meter(__name__)
+
+
+class ServerMetrics:
+    """RED metrics for one Flask service, plus its connection pool's gauges and counters.
+
+    http.server.duration (ms) is recorded for every request with the route
+    template, method and status code, so rate, errors and latency per route
+    come from one histogram. The attribute dicts are built once per
+    (route, method, status) and reused, so recording allocates almost nothing.
+    """
+
+    def __init__(self):
+        self.request_duration = meter.create_histogram(
+            "http.server.duration", unit="ms", description="Duration of HTTP requests, per route and status")
+        self.pool_wait = meter.create_histogram(
+            "db.client.connection.wait_time", unit="ms",
+            description="Time requests waited for a pooled connection, when none was free")
+        self._attributes = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        # Registered before the other hooks, so the timing covers them (after_request runs in reverse)
+        app.before_request(self._start)
+        app.after_request(self._record)
+
+    def _start(self):
+        request.environ["tracey.request_start"] = time.perf_counter()
+
+    def _route_attributes(self, route, method, status):
+        key = (route, method, status)
+        attributes = self._attributes.get(key)
+        if attributes is None:
+            with self._lock:
+                attributes = self._attributes.setdefault(
+                    key, {"http.route": route, "http.request.method": method, "http.response.status_code": status})
+        return attributes
+
+    def _record(self, response):
+        start = request.environ.get("tracey.request_start")
+        if start is not None:
+            rule = request.url_rule
+            attributes = self._route_attributes(rule.rule if rule else "unmatched", request.method, response.status_code)
+            self.request_duration.record(1000 * (time.perf_counter() - start), attributes)
+        return response
+
+    def pool_wait_recorder(self, pool_name):
+        """The on_wait callback for the named pool's BlockingConnectionPool."""
+        attributes = {"db.client.connection.pool.name": pool_name}
+
+        def record_pool_wait(seconds):
+            self.pool_wait.record(1000 * seconds, attributes)
+        return record_pool_wait
+
+    def observe_pools(self, pools):
+        """Export each pool's stats() (a BlockingConnectionPool or LazyPool) as gauges and counters.
+
+        pools maps a name, recorded as db.client.connection.pool.name, to
+        each pool, e.g. one per database shard.
+        """
+        pools = [(pool, {"db.client.connection.pool.name": name}) for name, pool in pools.items()]
+
+        def connections(options):
+            for pool, attributes in pools:
+                stats = pool.stats()
+                if "in_use" in stats:
+                    yield Observation(stats["in_use"], dict(attributes, state="used"))
+                    yield Observation(stats["idle"], dict(attributes, state="idle"))
+
+        def counter(key):
+            def observe(options):
+                for pool, attributes in pools:
+                    stats = pool.stats()
+                    if key in stats:
+                        yield Observation(stats[key], attributes)
+            return observe
+
+        meter.create_observable_gauge(
+            "db.client.connection.count", callbacks=[connections], description="Pooled connections by state")
+        meter.create_observable_gauge(
+            "db.client.connection.max", callbacks=[counter("max")], description="Pool size limit")
+        meter.create_observable_counter(
+            "db.client.connection.timeouts", callbacks=[counter("timeouts")],
+            description="Checkouts that failed because the pool stayed exhausted for the whole timeout")
+        meter.create_observable_counter(
+            "db.client.connection.waits", callbacks=[counter("waits")],
+            description="Checkouts that found the pool exhausted and had to wait")
+        meter.create_observable_counter(
+            "db.client.connection.discarded", callbacks=[counter("discarded")],
+            description="Returned connections closed instead of reused")
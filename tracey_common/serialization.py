@@ -0,0 +1,99 @@
+import gzip
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Response encoding settings, overridable by environment variables
+FAST_JSON = os.environ.get("FAST_JSON", default="true").lower() == "true" and orjson is not None
+RESPONSE_GZIP_MIN_BYTES = int(os.environ.get("RESPONSE_GZIP_MIN_BYTES", default=2048))
+RESPONSE_GZIP_LEVEL = int(os.environ.get("RESPONSE_GZIP_LEVEL", default=5))
+
+JSON_MIMETYPE = "application/json"
+# One JSON array per column instead of one object per row: {"order_id": [1, 2], "chairs": [3, 0], ...}
+COLUMNAR_MIMETYPE = "application/vnd.tracey.columnar+json"
+
+# Flask is only imported by the server-side helpers below, so the Warehouse Interface can use
+# dumps/loads/from_columns without it
+
+
+def dumps(obj, default=None):
+    """Serialize obj to UTF-8 JSON bytes, with orjson when it is installed and FAST_JSON is on."""
+    if FAST_JSON:
+        # Datetimes go through default too, so they are formatted exactly as before
+        return orjson.dumps(obj, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(obj, default=default, separators=(",", ":")).encode()
+
+
+def loads(data):
+    if FAST_JSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def to_columns(columns, rows):
+    """Turn row tuples (e.g. from cursor.fetchall()) into {column: [values]} without a dict per row."""
+    if not rows:
+        return {column: [] for column in columns}
+    return dict(zip(columns, map(list, zip(*rows))))
+
+
+def from_columns(data):
+    """Turn a columnar body back into a list of row dicts."""
+    columns = list(data)
+    return [dict(zip(columns, values)) for values in zip(*data.values())]
+
+
+def wants_columnar():
+    """True if the current request's Accept header prefers the columnar form over plain JSON."""
+    from flask import request
+    return request.accept_mimetypes.best_match([JSON_MIMETYPE, COLUMNAR_MIMETYPE]) == COLUMNAR_MIMETYPE
+
+
+def rows_response(columns, rows):
+    """Flask response for a listing of row tuples, as columnar JSON or an array of objects as negotiated."""
+    from flask import current_app
+    if wants_columnar():
+        response = current_app.response_class(dumps(to_columns(columns, rows)), mimetype=COLUMNAR_MIMETYPE)
+    else:
+        response = current_app.response_class(
+            dumps([dict(zip(columns, row)) for row in rows]), mimetype=JSON_MIMETYPE)
+    response.vary.add("Accept")
+    return response
+
+
+def _gzip_response(response):
+    from flask import request
+    if (response.direct_passthrough or response.is_streamed or "Content-Encoding" in response.headers
+            or response.status_code in (204, 304)):
+        return response
+    response.vary.add("Accept-Encoding")
+    if "gzip" not in request.accept_encodings or response.content_length is None \
+            or response.content_length < RESPONSE_GZIP_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(response.get_data(), compresslevel=RESPONSE_GZIP_LEVEL))
+    response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+def init_app(app):
+    """Encode every jsonify() with the fast encoder and gzip large responses for clients that accept it."""
+    if FAST_JSON:
+        from flask.json.provider import DefaultJSONProvider
+
+        class FastJSONProvider(DefaultJSONProvider):
+            def dumps(self, obj, **kwargs):
+                return dumps(obj, default=self.default).decode()
+
+            def loads(self, s, **kwargs):
+                return loads(s)
+
+            def response(self, *args, **kwargs):
+                obj = self._prepare_response_obj(args, kwargs)
+                return self._app.response_class(dumps(obj, default=self.default), mimetype=self.mimetype)
+
+        app.json = FastJSONProvider(app)
+    app.after_request(_gzip_response)
@@ -0,0 +1,133 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from psycopg2.extensions import parse_dsn
+from opentelemetry import context
+from tracey_common.lifecycle import LazyPool
+
+logger = logging.getLogger(__name__)
+
+# Shard settings, overridable by environment variables. DB_SHARDS lists one DSN per shard, comma separated;
+# a shard's position in the list is its index and must not change. Empty means one shard on DB_HOST.
+DB_SHARDS = os.environ.get("DB_SHARDS", default="")
+# warehouse:shard pairs, e.g. "1:0,2:1,3:1"; warehouses not listed live on shard 0
+DB_SHARD_MAP = os.environ.get("DB_SHARD_MAP", default="")
+DEFAULT_WAREHOUSE_ID = int(os.environ.get("DEFAULT_WAREHOUSE_ID", default=1))
+# Threads shared by all requests for the shards a fan-out does not query on the request's own thread
+SHARD_FAN_OUT_WORKERS = int(os.environ.get("SHARD_FAN_OUT_WORKERS", default=32))
+
+
+def parse_shard_map(spec, shard_count):
+    """Parse "warehouse:shard,..." into {warehouse_id: shard index}."""
+    mapping = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        warehouse, _, shard = entry.partition(":")
+        try:
+            warehouse_id, index = int(warehouse), int(shard)
+        except ValueError:
+            raise ValueError(f"Invalid DB_SHARD_MAP entry {entry!r}, expected warehouse:shard") from None
+        if not 0 <= index < shard_count:
+            raise ValueError(f"DB_SHARD_MAP maps warehouse {warehouse_id} to shard {index}, "
+                             f"but only {shard_count} shards are configured")
+        mapping[warehouse_id] = index
+    return mapping
+
+
+class Shard:
+    """One Postgres instance: its connection parameters, its lazily created pool and the warehouses it owns.
+
+    Rows of warehouses owned by another shard (left behind by a
+    rebalancing, or seed data) are never read: ownership() is the
+    (warehouses, included) pair for the "(warehouse_id = ANY(%s)) = %s"
+    filter that limits a query to this shard's own warehouses.
+    """
+
+    def __init__(self, index, connect_params, pool_factory):
+        self.index = index
+        self.name = f"shard{index}"
+        self.connect_params = connect_params
+        self.pool = LazyPool(lambda: pool_factory(self))
+        self.warehouses = []
+        self.foreign_warehouses = []
+
+    def ownership(self, warehouse_id=None):
+        if warehouse_id is not None:
+            return [warehouse_id], True
+        if self.index == 0:
+            # The default shard owns every warehouse not mapped elsewhere
+            return self.foreign_warehouses, False
+        return self.warehouses, True
+
+    @contextmanager
+    def connection(self):
+        conn = self.pool.getconn()
+        try:
+            yield conn
+        finally:
+            self.pool.putconn(conn)
+
+    def __repr__(self):
+        return f"Shard({self.name}, host={self.connect_params.get('host')})"
+
+
+class ShardRouter:
+    """Route each warehouse to the Postgres shard holding its orders and stock.
+
+    A warehouse's orders and stock live on the same shard, so a transaction
+    touching both (picking an order) stays on one database. Each shard has
+    its own pool, created by pool_factory(shard) on first use. db_params
+    supplies whatever a shard's DSN leaves out (user, password, dbname).
+    Queries spanning every shard go through fan_out, which runs them in
+    parallel.
+    """
+
+    def __init__(self, db_params, pool_factory, shards=DB_SHARDS, shard_map=DB_SHARD_MAP):
+        dsns = [dsn.strip() for dsn in shards.split(",") if dsn.strip()]
+        params = [dict(db_params, **parse_dsn(dsn)) for dsn in dsns] or [dict(db_params)]
+        self.shards = [Shard(index, connect_params, pool_factory) for index, connect_params in enumerate(params)]
+        self.shard_map = parse_shard_map(shard_map, len(self.shards))
+        for warehouse_id, index in sorted(self.shard_map.items()):
+            self.shards[index].warehouses.append(warehouse_id)
+            if index != 0:
+                self.shards[0].foreign_warehouses.append(warehouse_id)
+        self._executor = None
+        if len(self.shards) > 1:
+            self._executor = ThreadPoolExecutor(max_workers=SHARD_FAN_OUT_WORKERS, thread_name_prefix="shard-fan-out")
+            logger.info("Routing warehouses across %s shards: %s, map %s", len(self.shards), self.shards, self.shard_map)
+
+    @property
+    def pools(self):
+        return {shard.name: shard.pool for shard in self.shards}
+
+    def shard_for(self, warehouse_id):
+        return self.shards[self.shard_map.get(warehouse_id, 0)]
+
+    def fan_out(self, fn, shards=None):
+        """Run fn(shard) on every shard in parallel, returning the results in shard order.
+
+        The first shard is queried on the calling thread, the others on the
+        shared workers, in the caller's trace context so their spans are
+        children of the request's. The first exception raised is re-raised.
+        """
+        shards = self.shards if shards is None else shards
+        if self._executor is None or len(shards) == 1:
+            return [fn(shard) for shard in shards]
+        parent_context = context.get_current()
+
+        def run(shard):
+            token = context.attach(parent_context)
+            try:
+                return fn(shard)
+            finally:
+                context.detach(token)
+
+        futures = [self._executor.submit(run, shard) for shard in shards[1:]]
+        first = fn(shards[0])
+        return [first] + [future.result() for future in futures]
+
+    def stats(self):
+        """Pool stats, per shard name when there is more than one."""
+        if len(self.shards) == 1:
+            return self.shards[0].pool.stats()
+        return {shard.name: shard.pool.stats() for shard in self.shards}
@@ -0,0 +1,281 @@
+import fcntl
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+import grpc
+from opentelemetry import metrics
+from opentelemetry.exporter.otlp.proto.common.trace_encoder import encode_spans
+from opentelemetry.metrics import Observation
+from opentelemetry.proto.collector.trace.v1.trace_service_pb2 import ExportTraceServiceRequest
+from opentelemetry.proto.collector.trace.v1.trace_service_pb2_grpc import TraceServiceStub
+from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+
+logger = logging.getLogger(__name__)
+
+# Spool settings, overridable by environment variables; an empty SPAN_SPOOL_DIR turns spooling off
+SPAN_SPOOL_DIR = os.environ.get("SPAN_SPOOL_DIR", default="")
+SPAN_SPOOL_MAX_BYTES = int(os.environ.get("SPAN_SPOOL_MAX_BYTES", default=256 * 1024 * 1024))
+SPAN_SPOOL_SEGMENT_BYTES = int(os.environ.get("SPAN_SPOOL_SEGMENT_BYTES", default=8 * 1024 * 1024))
+SPAN_SPOOL_DRAIN_RATE = float(os.environ.get("SPAN_SPOOL_DRAIN_RATE", default=20))
+SPAN_SPOOL_RETRY_INTERVAL = float(os.environ.get("SPAN_SPOOL_RETRY_INTERVAL", default=5))
+SPAN_SPOOL_EXPORT_TIMEOUT = float(os.environ.get("SPAN_SPOOL_EXPORT_TIMEOUT", default=10))
+# Deadline for a live export when spooling, retries included; shorter than the exporter's first
+# backoff (about a second), so a failed attempt is spooled at once instead of being retried
+SPAN_SPOOL_LIVE_EXPORT_TIMEOUT = float(os.environ.get("SPAN_SPOOL_LIVE_EXPORT_TIMEOUT", default=0.5))
+SPAN_SPOOL_STATS_INTERVAL = float(os.environ.get("TRACE_STATS_INTERVAL", default=60))
+
+# Each record: payload length and CRC32, then a serialized ExportTraceServiceRequest
+RECORD_HEADER = struct.Struct(">II")
+LOCK_FILE = "spool.lock"
+
+
+class _Segment:
+    __slots__ = ("path", "size", "records")
+
+    def __init__(self, path, size=0, records=0):
+        self.path = path
+        self.size = size
+        self.records = records
+
+
+def _scan(path):
+    """Count the complete records in a segment written by an earlier process."""
+    records = 0
+    offset = 0
+    size = os.path.getsize(path)
+    with open(path, "rb") as segment:
+        while offset + RECORD_HEADER.size <= size:
+            length, _ = RECORD_HEADER.unpack(segment.read(RECORD_HEADER.size))
+            if offset + RECORD_HEADER.size + length > size:
+                break
+            segment.seek(length, os.SEEK_CUR)
+            offset += RECORD_HEADER.size + length
+            records += 1
+    return _Segment(path, offset, records)
+
+
+class SpoolingSpanExporter(SpanExporter):
+    """Export through delegate, spooling batches to a bounded on-disk ring while the collector is down.
+
+    When an export fails the batch is serialized to OTLP protobuf and
+    appended to the newest segment file in directory, and further batches
+    go straight to disk, without the delegate's retries, until the
+    collector answers again. A drain thread sends the spooled batches
+    oldest first, at most drain_rate per second, on its own gRPC channel.
+    Fresh batches are exported directly as soon as the collector is back.
+    Segments roll over at segment_bytes. Beyond max_bytes the oldest
+    segment is deleted and its batches are counted as dropped, so disk use
+    is bounded and memory does not grow with the outage. Spools left behind
+    by processes that exited (other gunicorn workers, an earlier container)
+    are picked up and drained too. The delegate should give up after one
+    attempt (SPAN_SPOOL_LIVE_EXPORT_TIMEOUT); waiting out its retry backoff
+    would stall the batch processor until its queue overflows.
+    """
+
+    def __init__(self, delegate, directory, endpoint, compression=grpc.Compression.NoCompression,
+                 max_bytes=SPAN_SPOOL_MAX_BYTES, segment_bytes=SPAN_SPOOL_SEGMENT_BYTES,
+                 drain_rate=SPAN_SPOOL_DRAIN_RATE, retry_interval=SPAN_SPOOL_RETRY_INTERVAL):
+        self.delegate = delegate
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.drain_interval = 1.0 / drain_rate if drain_rate > 0 else 0.0
+        self.retry_interval = retry_interval
+        self.healthy = True
+        self.counters = {"batches_spooled": 0, "batches_drained": 0, "batches_dropped": 0, "spool_write_errors": 0}
+        self._parent = directory
+        self.directory = os.path.join(directory, str(os.getpid()))
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_file = open(os.path.join(self.directory, LOCK_FILE), "w")
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._segments = []
+        self._sequence = 0
+        self._writer = None
+        self._read_offset = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._channel = grpc.insecure_channel(endpoint, compression=compression)
+        self._stub = TraceServiceStub(self._channel)
+        self._adopt_orphans()
+        meter = metrics.get_meter(__name__)
+        meter.create_observable_gauge("otel.span_spool.batches", callbacks=[self._observe("depth_batches")],
+                                      description="Span batches waiting in the on-disk spool")
+        meter.create_observable_gauge("otel.span_spool.size", callbacks=[self._observe("depth_bytes")], unit="By",
+                                      description="Bytes waiting in the on-disk spool")
+        self._thread = threading.Thread(target=self._drain, name="span-spool-drain", daemon=True)
+        self._thread.start()
+
+    def _adopt_orphans(self):
+        """Queue the segments of spools whose process is gone (their lock is free), oldest first."""
+        # A restarted container can reuse our pid, and so find its predecessor's spool in our directory
+        for entry in sorted(os.listdir(self.directory)):
+            if entry.endswith(".seg"):
+                self._segments.append(_scan(os.path.join(self.directory, entry)))
+        for name in sorted(os.listdir(self._parent)):
+            directory = os.path.join(self._parent, name)
+            if directory == self.directory or not os.path.isdir(directory):
+                continue
+            try:
+                with open(os.path.join(directory, LOCK_FILE), "a") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    segments = sorted(entry for entry in os.listdir(directory) if entry.endswith(".seg"))
+                    for entry in segments:
+                        target = os.path.join(self.directory, f"adopted-{name}-{entry}")
+                        os.rename(os.path.join(directory, entry), target)
+                        self._segments.append(_scan(target))
+                os.remove(os.path.join(directory, LOCK_FILE))
+                os.rmdir(directory)
+            except OSError:
+                # Still locked by a live process, or not ours to take
+                continue
+        if self._segments:
+            logger.info("Adopted %s spooled span batches from earlier processes",
+                        sum(segment.records for segment in self._segments))
+
+    def export(self, spans):
+        if self.healthy:
+            result = self.delegate.export(spans)
+            if result == SpanExportResult.SUCCESS:
+                return result
+            self.healthy = False
+            logger.warning("Span export failed, spooling to %s until the collector is back", self.directory)
+        try:
+            self._append(encode_spans(spans).SerializeToString())
+        except OSError as e:
+            with self._lock:
+                self.counters["spool_write_errors"] += 1
+            logger.warning("Could not spool %s spans: %s", len(spans), e)
+            return SpanExportResult.FAILURE
+        return SpanExportResult.SUCCESS
+
+    def _append(self, payload):
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._writer is None or self._segments[-1].size + len(record) > self.segment_bytes:
+                self._roll()
+            self._writer.write(record)
+            self._writer.flush()
+            segment = self._segments[-1]
+            segment.size += len(record)
+            segment.records += 1
+            self.counters["batches_spooled"] += 1
+            self._enforce_limit()
+        self._wakeup.set()
+
+    def _roll(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._sequence += 1
+        path = os.path.join(self.directory, f"{time.time_ns():020d}-{self._sequence:06d}.seg")
+        self._writer = open(path, "ab")
+        self._segments.append(_Segment(path))
+
+    def _enforce_limit(self):
+        # Drop whole segments, oldest first, but never the one being written
+        while len(self._segments) > 1 and sum(segment.size for segment in self._segments) > self.max_bytes:
+            oldest = self._segments.pop(0)
+            self.counters["batches_dropped"] += oldest.records
+            self._read_offset = 0
+            os.remove(oldest.path)
+            logger.warning("Span spool full, dropped %s oldest batches", oldest.records)
+
+    def _next_record(self):
+        """The oldest unsent record as (segment, offset, payload), or None when the spool is empty."""
+        with self._lock:
+            while self._segments:
+                segment = self._segments[0]
+                active = self._writer is not None and segment is self._segments[-1]
+                if self._read_offset + RECORD_HEADER.size <= segment.size:
+                    with open(segment.path, "rb") as reader:
+                        reader.seek(self._read_offset)
+                        length, checksum = RECORD_HEADER.unpack(reader.read(RECORD_HEADER.size))
+                        payload = reader.read(length)
+                    if len(payload) == length and zlib.crc32(payload) == checksum:
+                        return segment, self._read_offset, payload
+                    logger.warning("Skipping the corrupt rest of span spool segment %s", segment.path)
+                if active:
+                    return None
+                self._segments.pop(0)
+                self._read_offset = 0
+                os.remove(segment.path)
+            return None
+
+    def _consume(self, segment, offset, payload):
+        with self._lock:
+            if self._segments and self._segments[0] is segment and self._read_offset == offset:
+                self._read_offset += RECORD_HEADER.size + len(payload)
+                segment.records -= 1
+                self.counters["batches_drained"] += 1
+                if segment.records <= 0 and segment is not self._segments[-1]:
+                    self._segments.pop(0)
+                    self._read_offset = 0
+                    os.remove(segment.path)
+
+    def _send(self, payload):
+        try:
+            self._stub.Export(ExportTraceServiceRequest.FromString(payload), timeout=SPAN_SPOOL_EXPORT_TIMEOUT)
+            return True
+        except grpc.RpcError as e:
+            logger.debug("Draining the span spool failed: %s", e)
+            return False
+
+    def _drain(self):
+        next_report = time.monotonic() + SPAN_SPOOL_STATS_INTERVAL
+        while not self._stop.is_set():
+            if SPAN_SPOOL_STATS_INTERVAL > 0 and time.monotonic() >= next_report:
+                next_report = time.monotonic() + SPAN_SPOOL_STATS_INTERVAL
+                stats = self.stats()
+                if stats["depth_batches"] or not self.healthy:
+                    logger.info("Span spool stats: %s", stats)
+            record = self._next_record()
+            if record is None:
+                self.healthy = True if self.healthy else self._probe()
+                self._wakeup.wait(self.retry_interval)
+                self._wakeup.clear()
+                continue
+            if self._send(record[2]):
+                self._consume(*record)
+                if not self.healthy:
+                    logger.info("Collector reachable again, draining the span spool")
+                    self.healthy = True
+                self._stop.wait(self.drain_interval)
+            else:
+                self.healthy = False
+                self._stop.wait(self.retry_interval)
+
+    def _probe(self):
+        """With an empty spool, an empty export tells whether live exports can resume."""
+        return self._send(ExportTraceServiceRequest().SerializeToString())
+
+    def _observe(self, key):
+        def observe(options):
+            yield Observation(self.stats()[key])
+        return observe
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["depth_batches"] = sum(segment.records for segment in self._segments)
+            stats["depth_bytes"] = sum(segment.size for segment in self._segments) - self._read_offset
+            stats["segments"] = len(self._segments)
+        stats["healthy"] = self.healthy
+        return stats
+
+    def shutdown(self):
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join(timeout=5)
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        self._channel.close()
+        # Leave whatever is still spooled for the next process to adopt
+        self._lock_file.close()
+        self.delegate.shutdown()
+
+    def force_flush(self, timeout_millis=30000):
+        return self.delegate.force_flush(timeout_millis)
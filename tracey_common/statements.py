@@ -0,0 +1,100 @@
+import os
+import re
+import threading
+import time
+import weakref
+from opentelemetry import metrics
+
+# Run the fixed queries as server-side prepared statements (parsed and planned once per connection)
+PREPARED_STATEMENTS = os.environ.get("PREPARED_STATEMENTS", default="true").lower() == "true"
+
+# Append sqlcommenter trace context to statements. With prepared statements the comment lands on
+# the short EXECUTE text only, so it no longer costs a parse and plan of the full query.
+SQL_COMMENTER = os.environ.get("SQL_COMMENTER", default="true").lower() == "true"
+
+_PLACEHOLDER = re.compile(r"%s")
+
+
+class StatementStats:
+    """Counts of PREPAREs sent and statements executed either way."""
+
+    def __init__(self):
+        self.counters = {"prepared": 0, "executed_prepared": 0, "executed_plain": 0}
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        with self._lock:
+            self.counters[key] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters, enabled=PREPARED_STATEMENTS)
+
+
+statement_stats = StatementStats()
+
+# Execution time per statement; a no-op until init_metrics sets a MeterProvider
+db_operation_duration = metrics.get_meter(__name__).create_histogram(
+    "db.client.operation.duration", unit="ms", description="Duration of each fixed query, per statement name")
+
+# Names already prepared on each connection; entries go away with the connection
+_prepared = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+# Every Statement defined in this process, for prepare_all()
+_statements = []
+
+
+class Statement:
+    """A fixed query, written with %s placeholders, that runs as a named prepared statement.
+
+    The first execute() on a connection sends PREPARE; later ones send
+    EXECUTE with the parameters, so Postgres reuses the parsed statement and,
+    after a few executions, a generic plan. Prepared statements survive
+    rollbacks and live as long as the connection, so each is tracked per
+    connection. With PREPARED_STATEMENTS=false the query runs as before.
+    """
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        placeholders = iter(range(1, sql.count("%s") + 1))
+        body = _PLACEHOLDER.sub(lambda match: f"${next(placeholders)}", sql.rstrip().rstrip(";"))
+        self.prepare_sql = f"PREPARE {name} AS {body};"
+        arguments = ", ".join(["%s"] * sql.count("%s"))
+        self.execute_sql = f"EXECUTE {name} ({arguments});" if arguments else f"EXECUTE {name};"
+        self.metric_attributes = {"db.operation.name": name}
+        _statements.append(self)
+
+    def prepare(self, cursor):
+        """Send PREPARE on cursor's connection unless it was already prepared there."""
+        conn = cursor.connection
+        with _prepared_lock:
+            names = _prepared.get(conn)
+            if names is None:
+                names = _prepared[conn] = set()
+            ready = self.name in names
+        if not ready:
+            cursor.execute(self.prepare_sql)
+            with _prepared_lock:
+                names.add(self.name)
+            statement_stats.add("prepared")
+
+    def execute(self, cursor, params=()):
+        start = time.perf_counter()
+        if not PREPARED_STATEMENTS:
+            cursor.execute(self.sql, params)
+            statement_stats.add("executed_plain")
+        else:
+            self.prepare(cursor)
+            cursor.execute(self.execute_sql, params)
+            statement_stats.add("executed_prepared")
+        db_operation_duration.record(1000 * (time.perf_counter() - start), self.metric_attributes)
+        return cursor
+
+
+def prepare_all(cursor):
+    """Prepare every statement defined so far on cursor's connection, e.g. while warming up the pool."""
+    if PREPARED_STATEMENTS:
+        for statement in _statements:
+            statement.prepare(cursor)
@@ -0,0 +1,298 @@
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+import grpc
+from opentelemetry import metrics, trace
+from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
+from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, SpanProcessor, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.sdk.trace.sampling import (
+    Decision, ParentBased, Sampler, SamplingResult, TraceIdRatioBased)
+from opentelemetry.trace import SpanContext, StatusCode, TraceFlags
+from tracey_common.span_spool import SPAN_SPOOL_DIR, SPAN_SPOOL_LIVE_EXPORT_TIMEOUT, SpoolingSpanExporter
+
+logger = logging.getLogger(__name__)
+
+# Sampling settings
+TRACE_SAMPLE_RATIO = float(os.environ.get("TRACE_SAMPLE_RATIO", default=1.0))
+TRACE_KEEP_ERRORS = os.environ.get("TRACE_KEEP_ERRORS", default="true").lower() == "true"
+TRACE_SLOW_THRESHOLD_MS = float(os.environ.get("TRACE_SLOW_THRESHOLD_MS", default=0))
+TRACE_TAIL_MAX_TRACES = int(os.environ.get("TRACE_TAIL_MAX_TRACES", default=2048))
+
+# BatchSpanProcessor and exporter settings (the standard OTEL_* names)
+BSP_MAX_QUEUE_SIZE = int(os.environ.get("OTEL_BSP_MAX_QUEUE_SIZE", default=2048))
+BSP_MAX_EXPORT_BATCH_SIZE = int(os.environ.get("OTEL_BSP_MAX_EXPORT_BATCH_SIZE", default=512))
+BSP_SCHEDULE_DELAY_MILLIS = int(os.environ.get("OTEL_BSP_SCHEDULE_DELAY", default=5000))
+BSP_EXPORT_TIMEOUT_MILLIS = int(os.environ.get("OTEL_BSP_EXPORT_TIMEOUT", default=30000))
+EXPORTER_COMPRESSION = os.environ.get("OTEL_EXPORTER_OTLP_COMPRESSION", default="none").lower()
+TRACE_STATS_INTERVAL = float(os.environ.get("TRACE_STATS_INTERVAL", default=60))
+METRIC_EXPORT_INTERVAL_MILLIS = int(os.environ.get("OTEL_METRIC_EXPORT_INTERVAL", default=60000))
+
+COMPRESSION = {"none": grpc.Compression.NoCompression, "gzip": grpc.Compression.Gzip, "deflate": grpc.Compression.Deflate}
+
+
+def otel_host():
+    """The node-local collector address from OTEL_HOST, with the default gRPC port if none is given."""
+    host = os.environ.get("OTEL_HOST", default="10.10.0.12:4317")
+    if not ":" in host:
+        host = host + ":4317"
+    return host
+
+
+def service_resource(service_name, **attributes):
+    return Resource(
+        attributes={
+            "service.name": service_name,
+            "version": "v0.0.1",
+            "service.instance.id": "instance-1",
+            "telemetry.sdk.name":"opentelemetry",
+            "telemetry.sdk.language":"python",
+            "telemetry.sdk.version":"1.19.0",
+            **attributes
+        }
+    )
+
+
+class TraceStats:
+    """Counters for the span pipeline: what was exported, dropped or kept by the tail rules."""
+
+    def __init__(self):
+        self.counters = {
+            "spans_exported": 0, "spans_export_failed": 0, "export_batches": 0,
+            "spans_dropped_queue_full": 0, "tail_spans_promoted": 0,
+            "tail_traces_discarded": 0, "tail_traces_evicted": 0,
+        }
+        self.export_seconds_total = 0.0
+        self.export_seconds_max = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, key, amount=1):
+        with self._lock:
+            self.counters[key] += amount
+
+    def record_export(self, spans, seconds, success):
+        with self._lock:
+            self.counters["export_batches"] += 1
+            self.counters["spans_exported" if success else "spans_export_failed"] += spans
+            self.export_seconds_total += seconds
+            self.export_seconds_max = max(self.export_seconds_max, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.counters)
+            batches = stats["export_batches"]
+            stats["export_latency_avg_ms"] = round(1000 * self.export_seconds_total / batches, 2) if batches else 0.0
+            stats["export_latency_max_ms"] = round(1000 * self.export_seconds_max, 2)
+            return stats
+
+
+trace_stats = TraceStats()
+
+
+class RecordOnlySampler(Sampler):
+    """Turn the delegate's DROP decisions into RECORD_ONLY.
+
+    Unsampled spans are then still recorded in process, so the tail rules can
+    look at their status and duration, but are not exported unless promoted.
+    """
+
+    def __init__(self, delegate):
+        self.delegate = delegate
+
+    def should_sample(self, parent_context, trace_id, name, kind=None, attributes=None, links=None, trace_state=None):
+        result = self.delegate.should_sample(parent_context, trace_id, name, kind, attributes, links, trace_state)
+        if result.decision == Decision.DROP:
+            return SamplingResult(Decision.RECORD_ONLY, result.attributes, result.trace_state)
+        return result
+
+    def get_description(self):
+        return f"RecordOnly{{{self.delegate.get_description()}}}"
+
+
+def _promote(span):
+    """Copy of an unsampled span with the sampled flag set, so the span processor exports it."""
+    context = span.context
+    return ReadableSpan(
+        name=span.name,
+        context=SpanContext(context.trace_id, context.span_id, context.is_remote,
+                            TraceFlags(TraceFlags.SAMPLED), context.trace_state),
+        parent=span.parent,
+        resource=span.resource,
+        attributes=span.attributes,
+        events=span.events,
+        links=span.links,
+        kind=span.kind,
+        status=span.status,
+        start_time=span.start_time,
+        end_time=span.end_time,
+        instrumentation_scope=span.instrumentation_scope,
+    )
+
+
+class TailRuleSpanProcessor(SpanProcessor):
+    """Keep whole unsampled traces that contain an error or a slow span.
+
+    Sampled spans go straight to the delegate. Unsampled (record-only) spans
+    are buffered per trace until the trace's local root span ends; the trace
+    is then promoted to the delegate if any of its spans failed or ran longer
+    than the slow threshold, and discarded otherwise. At most max_traces are
+    buffered; the oldest are evicted beyond that.
+    """
+
+    def __init__(self, delegate, keep_errors=TRACE_KEEP_ERRORS, slow_threshold_ms=TRACE_SLOW_THRESHOLD_MS,
+                 max_traces=TRACE_TAIL_MAX_TRACES):
+        self.delegate = delegate
+        self.keep_errors = keep_errors
+        self.slow_threshold_ns = int(slow_threshold_ms * 1e6) if slow_threshold_ms > 0 else None
+        self.max_traces = max_traces
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _interesting(self, span):
+        if self.keep_errors and span.status.status_code == StatusCode.ERROR:
+            return True
+        return self.slow_threshold_ns is not None and span.end_time - span.start_time >= self.slow_threshold_ns
+
+    def on_start(self, span, parent_context=None):
+        self.delegate.on_start(span, parent_context=parent_context)
+
+    def on_end(self, span):
+        if span.context.trace_flags.sampled:
+            self.delegate.on_end(span)
+            return
+        trace_id = span.context.trace_id
+        local_root = span.parent is None or span.parent.is_remote
+        with self._lock:
+            entry = self._pending.get(trace_id)
+            if entry is None:
+                entry = self._pending[trace_id] = [[], False]
+            entry[0].append(span)
+            entry[1] = entry[1] or self._interesting(span)
+            if not local_root:
+                if len(self._pending) > self.max_traces:
+                    self._pending.popitem(last=False)
+                    trace_stats.add("tail_traces_evicted")
+                return
+            spans, keep = self._pending.pop(trace_id)
+        if not keep:
+            trace_stats.add("tail_traces_discarded")
+            return
+        for buffered in spans:
+            self.delegate.on_end(_promote(buffered))
+        trace_stats.add("tail_spans_promoted", len(spans))
+
+    def shutdown(self):
+        self.delegate.shutdown()
+
+    def force_flush(self, timeout_millis=30000):
+        return self.delegate.force_flush(timeout_millis)
+
+
+class CountingBatchSpanProcessor(BatchSpanProcessor):
+    """BatchSpanProcessor that counts spans dropped because its queue was full."""
+
+    def _queue_is_full(self):
+        queue = getattr(self, "queue", None)
+        if queue is None:
+            queue = getattr(getattr(self, "_batch_processor", None), "_queue", None)
+        maxlen = getattr(queue, "maxlen", None)
+        return maxlen is not None and len(queue) >= maxlen
+
+    def on_end(self, span):
+        if span.context.trace_flags.sampled and self._queue_is_full():
+            trace_stats.add("spans_dropped_queue_full")
+        super().on_end(span)
+
+
+class CountingSpanExporter(SpanExporter):
+    """Wrap an exporter to count exported and failed spans and time each export."""
+
+    def __init__(self, delegate, stats_interval=TRACE_STATS_INTERVAL):
+        self.delegate = delegate
+        self.stats_interval = stats_interval
+        self._next_report = time.monotonic() + stats_interval
+
+    def export(self, spans):
+        start = time.perf_counter()
+        result = self.delegate.export(spans)
+        trace_stats.record_export(len(spans), time.perf_counter() - start, result == SpanExportResult.SUCCESS)
+        if self.stats_interval > 0 and time.monotonic() >= self._next_report:
+            self._next_report = time.monotonic() + self.stats_interval
+            logger.info("Trace pipeline stats: %s", trace_stats.snapshot())
+        return result
+
+    def shutdown(self):
+        self.delegate.shutdown()
+
+    def force_flush(self, timeout_millis=30000):
+        return self.delegate.force_flush(timeout_millis)
+
+
+def build_sampler():
+    """Parent-based ratio sampling; record-only below the ratio when tail rules are on."""
+    sampler = ParentBased(root=TraceIdRatioBased(TRACE_SAMPLE_RATIO))
+    if tail_rules_enabled():
+        sampler = RecordOnlySampler(sampler)
+    return sampler
+
+
+def tail_rules_enabled():
+    return TRACE_SAMPLE_RATIO < 1.0 and (TRACE_KEEP_ERRORS or TRACE_SLOW_THRESHOLD_MS > 0)
+
+
+def init_tracing(service_name, **resource_attributes):
+    """Create this process's TracerProvider, exporter and span processors from the environment.
+
+    Call once per process; under gunicorn that is once per worker, after fork.
+    """
+    host = otel_host()
+    logger.info("OTEL Collector Address: %s", host)
+    provider = TracerProvider(resource=service_resource(service_name, **resource_attributes), sampler=build_sampler())
+    trace.set_tracer_provider(provider)
+
+    # Create OTLP exporter and point it to the OTEL Collector
+    compression = COMPRESSION.get(EXPORTER_COMPRESSION, grpc.Compression.NoCompression)
+    # With a spool behind it a live export gets one short attempt; the spool rides out the outage, not retries
+    timeout = SPAN_SPOOL_LIVE_EXPORT_TIMEOUT if SPAN_SPOOL_DIR else None
+    otlp_exporter = OTLPSpanExporter(endpoint=host, insecure=True, compression=compression, timeout=timeout)
+    exporter = CountingSpanExporter(otlp_exporter)
+    if SPAN_SPOOL_DIR:
+        # Batches that fail to export wait on disk instead of filling the queue
+        exporter = SpoolingSpanExporter(exporter, os.path.join(SPAN_SPOOL_DIR, service_name), host, compression)
+
+    # Set up BatchSpanProcessor and add it to the tracer provider
+    processor = CountingBatchSpanProcessor(
+        exporter,
+        max_queue_size=BSP_MAX_QUEUE_SIZE,
+        schedule_delay_millis=BSP_SCHEDULE_DELAY_MILLIS,
+        max_export_batch_size=BSP_MAX_EXPORT_BATCH_SIZE,
+        export_timeout_millis=BSP_EXPORT_TIMEOUT_MILLIS,
+    )
+    if tail_rules_enabled():
+        processor = TailRuleSpanProcessor(processor)
+    provider.add_span_processor(processor)
+    return provider
+
+
+def init_metrics(service_name, **resource_attributes):
+    """Create this process's MeterProvider, exporting to the same collector as the traces.
+
+    Call once per process, like init_tracing. Every process exports its own
+    cumulative series, so unless the caller sets one, service.instance.id is
+    made unique per process (host and pid; one per gunicorn worker).
+    """
+    resource_attributes.setdefault("service.instance.id", f"{socket.gethostname()}:{os.getpid()}")
+    exporter = OTLPMetricExporter(
+        endpoint=otel_host(), insecure=True,
+        compression=COMPRESSION.get(EXPORTER_COMPRESSION, grpc.Compression.NoCompression))
+    reader = PeriodicExportingMetricReader(exporter, export_interval_millis=METRIC_EXPORT_INTERVAL_MILLIS)
+    provider = MeterProvider(resource=service_resource(service_name, **resource_attributes), metric_readers=[reader])
+    metrics.set_meter_provider(provider)
+    return provider
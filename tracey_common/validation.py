@@ -0,0 +1,199 @@
+import functools
+import logging
+import math
+import threading
+from flask import jsonify, request
+
+logger = logging.getLogger(__name__)
+
+TRUE_STRINGS = ("1", "true", "yes", "on")
+FALSE_STRINGS = ("0", "false", "no", "off", "")
+
+
+class ValidationError(ValueError):
+    """Raised with every problem found in a request, not just the first."""
+
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+class Field:
+    """One named value in a request: its type, whether it is required, default and bounds.
+
+    kind is int, float, str, bool or list; a list's entries are objects
+    checked against the items Schema. With from_strings (query parameters)
+    values arrive as strings and are converted first.
+    """
+
+    def __init__(self, name, kind, required=False, default=None, minimum=None, maximum=None,
+                 min_length=None, max_length=None, items=None):
+        self.name = name
+        self.kind = kind
+        self.required = required
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+        self.min_length = min_length
+        self.max_length = max_length
+        self.items = items
+
+    def _converter(self, from_strings):
+        kind = self.kind
+        if kind is int:
+            if from_strings:
+                return int
+            def check_int(value):
+                if isinstance(value, bool) or not isinstance(value, int):
+                    raise ValueError
+                return value
+            return check_int
+        if kind is float:
+            # NaN and infinity get past the bounds checks (and JSON bodies may carry them), so they are refused here
+            if from_strings:
+                def parse_number(value):
+                    number = float(value)
+                    if not math.isfinite(number):
+                        raise ValueError
+                    return number
+                return parse_number
+            def check_number(value):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    raise ValueError
+                if isinstance(value, float) and not math.isfinite(value):
+                    raise ValueError
+                return value
+            return check_number
+        if kind is bool:
+            def check_bool(value):
+                if isinstance(value, bool):
+                    return value
+                if from_strings and value.lower() in TRUE_STRINGS:
+                    return True
+                if from_strings and value.lower() in FALSE_STRINGS:
+                    return False
+                raise ValueError
+            return check_bool
+        if kind is str:
+            def check_str(value):
+                if not isinstance(value, str) or not value:
+                    raise ValueError
+                return value
+            return check_str
+        if kind is list:
+            items = self.items
+            def check_list(value):
+                if not isinstance(value, list):
+                    raise ValueError
+                if items is None:
+                    return value
+                return [items.validate(item) for item in value]
+            return check_list
+        raise TypeError(f"Unsupported field type for {self.name}: {kind!r}")
+
+    def compile(self, from_strings=False):
+        """Build the checker once: a function taking the mapping and returning (value, error)."""
+        name, required, default = self.name, self.required, self.default
+        minimum, maximum = self.minimum, self.maximum
+        min_length, max_length = self.min_length, self.max_length
+        convert = self._converter(from_strings)
+        type_name = {int: "an integer", float: "a finite number", bool: "a boolean", str: "a non-empty string",
+                     list: "a list"}[self.kind]
+
+        def check(data):
+            value = data.get(name)
+            if value is None:
+                if required:
+                    return None, f"'{name}' is required"
+                return default, None
+            try:
+                value = convert(value)
+            except ValidationError as e:
+                return None, f"'{name}': {e}"
+            except (ValueError, TypeError, AttributeError):
+                return None, f"'{name}' must be {type_name}, got {value!r}"
+            if minimum is not None and value < minimum:
+                return None, f"'{name}' must be at least {minimum}"
+            if maximum is not None and value > maximum:
+                return None, f"'{name}' must be at most {maximum}"
+            if min_length is not None and len(value) < min_length:
+                return None, f"'{name}' must have at least {min_length} entries"
+            if max_length is not None and len(value) > max_length:
+                return None, f"'{name}' must have at most {max_length} entries"
+            return value, None
+
+        return check
+
+
+class Schema:
+    """A request body or query string layout, compiled into field checkers when it is built."""
+
+    def __init__(self, *fields, from_strings=False):
+        self.fields = fields
+        self._checks = [(field.name, field.compile(from_strings)) for field in fields]
+
+    def validate(self, data):
+        """Return {name: value} for every field, or raise ValidationError."""
+        if not hasattr(data, "get"):
+            raise ValidationError(["expected a JSON object"])
+        values = {}
+        errors = []
+        for name, check in self._checks:
+            value, error = check(data)
+            if error is None:
+                values[name] = value
+            else:
+                errors.append(error)
+        if errors:
+            raise ValidationError(errors)
+        return values
+
+
+class ValidationStats:
+    """Requests rejected by validation, per endpoint."""
+
+    def __init__(self):
+        self.rejected = {}
+        self._lock = threading.Lock()
+
+    def reject(self, endpoint):
+        with self._lock:
+            self.rejected[endpoint] = self.rejected.get(endpoint, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return {"rejected": dict(self.rejected), "rejected_total": sum(self.rejected.values())}
+
+
+validation_stats = ValidationStats()
+
+
+def _validated(schema, read, keyword, error_key):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                kwargs[keyword] = schema.validate(read())
+            except ValidationError as e:
+                validation_stats.reject(request.endpoint)
+                logger.warning("Rejected %s %s: %s", request.method, request.path, e)
+                return jsonify({error_key: str(e), "errors": e.errors}), 400
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _json_body():
+    body = request.get_json(silent=True)
+    # No body at all is checked as an empty object, so optional-only schemas accept it
+    return {} if body is None and not request.get_data(cache=True) else body
+
+
+def validate_json(schema, error_key="error"):
+    """Flask view decorator: check the JSON body against schema before the view runs, passing it as body=."""
+    return _validated(schema, _json_body, "body", error_key)
+
+
+def validate_args(schema, error_key="error"):
+    """Flask view decorator: check the query string against schema, passing the values as params=."""
+    return _validated(schema, lambda: request.args, "params", error_key)
@@ -0,0 +1,191 @@
+import logging
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Connection pool, timeout, retry and circuit breaker settings
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", default=32))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", default=2.0))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", default=10.0))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", default=2))
+HTTP_RETRY_BACKOFF = float(os.environ.get("HTTP_RETRY_BACKOFF", default=0.1))
+HTTP_RETRY_BACKOFF_MAX = float(os.environ.get("HTTP_RETRY_BACKOFF_MAX", default=2.0))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", default=5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("BREAKER_RESET_TIMEOUT", default=10.0))
+
+# Responses that mean the backend itself is unavailable, as opposed to rejecting the request
+UNAVAILABLE_STATUS_CODES = (502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised without touching the network while a service's circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a single half-open trial call."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f"Circuit breaker for {self.name} is open")
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Circuit breaker for %s closed", self.name)
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                self._trial_in_flight = False
+                logger.warning("Circuit breaker for %s opened after %s consecutive failures", self.name, self.failures)
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.failures,
+                    "times_opened": self.times_opened, "rejected": self.rejected}
+
+
+class ServiceClient:
+    """Keep-alive HTTP client for one backend service.
+
+    Every call shares one pooled session, has connect and read timeouts, is
+    retried with jittered exponential backoff when idempotent, and goes
+    through the service's circuit breaker.
+    """
+
+    def __init__(self, name, base_url):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        self.breaker = CircuitBreaker(name)
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.counters = {"requests": 0, "retries": 0, "failures": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, key):
+        with self._lock:
+            self.counters[key] += 1
+
+    def _backoff(self, attempt):
+        # Full jitter: anywhere between 0 and the capped exponential delay
+        time.sleep(random.uniform(0, min(HTTP_RETRY_BACKOFF_MAX, HTTP_RETRY_BACKOFF * (2 ** attempt))))
+
+    def request(self, method, path, idempotent=None, **kwargs):
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempts = 1 + (HTTP_RETRIES if idempotent else 0)
+        kwargs.setdefault("timeout", self.timeout)
+        url = self.base_url + path
+        for attempt in range(attempts):
+            if attempt:
+                self._count("retries")
+                self._backoff(attempt - 1)
+            self.breaker.before_call()
+            self._count("requests")
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._count("failures")
+                self.breaker.record_failure()
+                if attempt == attempts - 1:
+                    raise
+                continue
+            except requests.RequestException:
+                # Not worth retrying (e.g. a broken chunked body), but it must still settle a half-open trial
+                self._count("failures")
+                self.breaker.record_failure()
+                raise
+            if response.status_code in UNAVAILABLE_STATUS_CODES:
+                self._count("failures")
+                self.breaker.record_failure()
+                if attempt < attempts - 1:
+                    continue
+            else:
+                self.breaker.record_success()
+            return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def connection_stats(self):
+        """Sockets opened versus requests sent over them, summed over the per-host pools."""
+        opened = sent = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                sent += pool.num_requests
+        return {"connections_opened": opened, "connections_reused": max(sent - opened, 0)}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats.update(self.connection_stats())
+        stats["breaker"] = self.breaker.stats()
+        return stats
+
+
+order_processor = ServiceClient(
+    "order-processor", os.environ.get("ORDER_PROCESSOR_URL", default="http://order-processor:8080"))
+stock_controller = ServiceClient(
+    "stock-controller", os.environ.get("STOCK_CONTROLLER_URL", default="http://stock-controller:8081"))
+
+
+def client_stats():
+    return {client.name: client.stats() for client in (order_processor, stock_controller)}
+
+
+def start_stats_reporter(interval):
+    """Log the client counters every interval seconds from a daemon thread."""
+    def report():
+        while True:
+            time.sleep(interval)
+            logger.info("HTTP client stats: %s", client_stats())
+    thread = threading.Thread(target=report, name="http-client-stats", daemon=True)
+    thread.start()
+    return thread
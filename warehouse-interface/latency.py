@@ -0,0 +1,179 @@
+import functools
+import logging
+import os
+import threading
+import time
+from opentelemetry import metrics
+from opentelemetry.metrics import Observation
+
+logger = logging.getLogger(__name__)
+
+# Seconds between latency summaries in the log (and refreshes of the exported percentiles)
+LATENCY_REPORT_INTERVAL = float(os.environ.get("LATENCY_REPORT_INTERVAL", default=30))
+
+# Histogram layout: values in microseconds, exact below 256 and within 1/128 (under 1%) above,
+# up to about an hour; 3328 counters per histogram whatever the traffic
+SUB_BUCKETS = 128
+LINEAR_LIMIT = 2 * SUB_BUCKETS
+MAX_SHIFT = 24
+BUCKETS = LINEAR_LIMIT + MAX_SHIFT * SUB_BUCKETS
+
+PERCENTILES = (("p50", 0.50), ("p90", 0.90), ("p99", 0.99))
+
+_local = threading.local()
+
+
+def _bucket(micros):
+    if micros < LINEAR_LIMIT:
+        return max(micros, 0)
+    shift = micros.bit_length() - 8
+    if shift > MAX_SHIFT:
+        return BUCKETS - 1
+    return LINEAR_LIMIT + (shift - 1) * SUB_BUCKETS + (micros >> shift) - SUB_BUCKETS
+
+
+def _bucket_value(index):
+    """The midpoint of the values that land in bucket index."""
+    if index < LINEAR_LIMIT:
+        return index
+    shift, sub = divmod(index - LINEAR_LIMIT, SUB_BUCKETS)
+    shift += 1
+    return ((sub + SUB_BUCKETS) << shift) + (1 << (shift - 1))
+
+
+class LatencyHistogram:
+    """HDR-style log-linear histogram of latencies with fixed memory and under 1% error."""
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.total = 0
+        self.max_micros = 0
+
+    def record(self, seconds):
+        micros = int(seconds * 1e6)
+        self.counts[_bucket(micros)] += 1
+        self.total += 1
+        if micros > self.max_micros:
+            self.max_micros = micros
+
+    def percentile(self, fraction):
+        """The latency in seconds below which fraction of the recorded values fall."""
+        if not self.total:
+            return 0.0
+        rank = max(1, int(round(fraction * self.total)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(_bucket_value(index), self.max_micros) / 1e6
+        return self.max_micros / 1e6
+
+    def summary(self):
+        summary = {"count": self.total}
+        for name, fraction in PERCENTILES:
+            summary[name + "_ms"] = round(1000 * self.percentile(fraction), 2)
+        summary["max_ms"] = round(self.max_micros / 1000, 2)
+        return summary
+
+
+class LatencyRecorder:
+    """Per-operation latency histograms, summarised and reset every report interval.
+
+    Also exports each call as an OTLP histogram (warehouse.operation.duration)
+    and the last interval's percentiles and max as gauges
+    (warehouse.operation.latency), once init_metrics has set a MeterProvider.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._last_summary = {}
+        self._lock = threading.Lock()
+        self._duration = None
+
+    def init_metrics(self):
+        meter = metrics.get_meter(__name__)
+        self._duration = meter.create_histogram(
+            "warehouse.operation.duration", unit="ms",
+            description="Latency of warehouse operations, measured from their intended start")
+        meter.create_observable_gauge(
+            "warehouse.operation.latency", callbacks=[self._observe], unit="ms",
+            description="Latency percentiles and max over the last report interval")
+
+    def record(self, operation, seconds):
+        with self._lock:
+            histogram = self._histograms.get(operation)
+            if histogram is None:
+                histogram = self._histograms[operation] = LatencyHistogram()
+            histogram.record(seconds)
+        if self._duration is not None:
+            self._duration.record(1000 * seconds, {"operation": operation})
+
+    def _observe(self, options):
+        with self._lock:
+            summaries = dict(self._last_summary)
+        for operation, summary in summaries.items():
+            for statistic in [name for name, _ in PERCENTILES] + ["max"]:
+                yield Observation(summary[statistic + "_ms"], {"operation": operation, "statistic": statistic})
+
+    def report(self):
+        """Log each operation's summary for the interval just ended and start a new interval."""
+        with self._lock:
+            histograms, self._histograms = self._histograms, {}
+        summaries = {operation: histogram.summary() for operation, histogram in sorted(histograms.items())}
+        with self._lock:
+            self._last_summary = summaries
+        for operation, summary in summaries.items():
+            logger.info("Latency %s: count=%s p50=%sms p90=%sms p99=%sms max=%sms", operation, summary["count"],
+                        summary["p50_ms"], summary["p90_ms"], summary["p99_ms"], summary["max_ms"])
+        return summaries
+
+    def start_reporter(self, interval=LATENCY_REPORT_INTERVAL):
+        if interval <= 0:
+            return None
+        def run():
+            while True:
+                time.sleep(interval)
+                self.report()
+        thread = threading.Thread(target=run, name="latency-reporter", daemon=True)
+        thread.start()
+        return thread
+
+
+latency_recorder = LatencyRecorder()
+
+
+def timed(operation):
+    """Decorator recording a client call's latency under operation.
+
+    Inside a tracked iteration the call is measured from its intended send
+    time: the iteration's scheduled start for its first call, the end of the
+    previous call for later ones. Time spent waiting behind a stalled backend
+    or a busy worker is therefore counted, not omitted.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            intended = getattr(_local, "intended", None)
+            start = time.monotonic()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                end = time.monotonic()
+                latency_recorder.record(operation, end - (start if intended is None else min(intended, start)))
+                if intended is not None:
+                    _local.intended = end
+        return wrapper
+    return decorator
+
+
+def track_iteration(iteration_fn, operation="iteration"):
+    """Return iteration_fn(intended_start, ...) recording the whole iteration from its intended start."""
+    @functools.wraps(iteration_fn)
+    def tracked(intended_start, *args):
+        _local.intended = intended_start
+        try:
+            return iteration_fn(intended_start, *args)
+        finally:
+            _local.intended = None
+            latency_recorder.record(operation, time.monotonic() - intended_start)
+    return tracked
@@ -0,0 +1,246 @@
+import argparse
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Defaults, overridable by environment variables or CLI flags
+DEFAULT_MODE = "loop"
+DEFAULT_LOOP_INTERVAL = 10.0
+DEFAULT_RATE = 1.0
+DEFAULT_CONCURRENCY = 16
+DEFAULT_REPORT_INTERVAL = 10.0
+
+# A start this far behind its intended send time is counted as late
+LATE_THRESHOLD = 0.1
+
+# Scheduler resolution: send times are accurate to within this many seconds
+SCHEDULE_TICK = 0.01
+
+
+class Phase:
+    """A stretch of the load profile whose rate moves linearly from start_rate to end_rate."""
+
+    def __init__(self, name, duration, start_rate, end_rate=None):
+        self.name = name
+        self.duration = duration
+        self.start_rate = start_rate
+        self.end_rate = start_rate if end_rate is None else end_rate
+
+    def rate_at(self, elapsed):
+        if not self.duration:
+            return self.end_rate
+        fraction = min(max(elapsed / self.duration, 0.0), 1.0)
+        return self.start_rate + (self.end_rate - self.start_rate) * fraction
+
+    def __repr__(self):
+        return f"{self.name}({self.duration}s, {self.start_rate}->{self.end_rate}/s)"
+
+
+def parse_phases(spec):
+    """Parse "ramp:30:50,steady:120:50,spike:20:200" into phases.
+
+    Each entry is name:seconds:rate. A ramp phase moves linearly from the
+    previous phase's rate to its own; every other phase holds its rate. A
+    duration of 0 on the last phase runs it forever.
+    """
+    phases = []
+    previous_rate = 0.0
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        try:
+            name, duration, rate = entry.split(":")
+            duration, rate = float(duration), float(rate)
+        except ValueError:
+            raise ValueError(f"Invalid load phase '{entry}', expected name:seconds:rate")
+        if duration < 0 or rate < 0:
+            raise ValueError(f"Invalid load phase '{entry}', seconds and rate must not be negative")
+        start_rate = previous_rate if name == "ramp" else rate
+        phases.append(Phase(name, duration, start_rate, rate))
+        previous_rate = rate
+    if not phases:
+        raise ValueError("Load profile has no phases")
+    return phases
+
+
+def build_phases(rate, duration=0, ramp_up=0, spike_rate=0, spike_duration=0):
+    """Build ramp-up, steady and spike phases from the simple settings.
+
+    The spike sits in the middle of the steady phase. A duration of 0 holds
+    the steady rate forever, in which case there is no spike.
+    """
+    phases = []
+    if ramp_up > 0:
+        phases.append(Phase("ramp", ramp_up, 0.0, rate))
+    if duration > 0 and spike_rate > 0 and spike_duration > 0:
+        phases.append(Phase("steady", duration / 2, rate))
+        phases.append(Phase("spike", spike_duration, spike_rate))
+        phases.append(Phase("steady", duration / 2, rate))
+    else:
+        phases.append(Phase("steady", duration, rate))
+    return phases
+
+
+class OpenLoopRunner:
+    """Issue iterations on a fixed schedule, independent of how long earlier ones took.
+
+    Send times are computed from the load profile alone. When every worker is
+    busy, iterations wait in the executor queue up to max_backlog and are
+    dropped (and counted) beyond that, so a slow backend shows up as late or
+    dropped iterations instead of silently lowering the offered load.
+    """
+
+    def __init__(self, iteration_fn, phases, concurrency=DEFAULT_CONCURRENCY,
+                 max_backlog=None, report_interval=DEFAULT_REPORT_INTERVAL):
+        self.iteration_fn = iteration_fn
+        self.phases = phases
+        self.concurrency = concurrency
+        self.max_backlog = max_backlog if max_backlog is not None else concurrency * 10
+        self.report_interval = report_interval
+        self.stats = {"scheduled": 0, "started": 0, "completed": 0, "failed": 0, "dropped": 0, "late": 0}
+        self._outstanding = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _run_iteration(self, intended_start):
+        if time.monotonic() - intended_start > LATE_THRESHOLD:
+            self._count("late")
+        self._count("started")
+        try:
+            self.iteration_fn(intended_start)
+            self._count("completed")
+        except Exception:
+            logger.exception("Load iteration failed")
+            self._count("failed")
+        finally:
+            with self._lock:
+                self._outstanding -= 1
+
+    def _submit(self, executor, intended_start):
+        with self._lock:
+            self.stats["scheduled"] += 1
+            if self._outstanding >= self.max_backlog:
+                self.stats["dropped"] += 1
+                return
+            self._outstanding += 1
+        executor.submit(self._run_iteration, intended_start)
+
+    def _report(self, phase, rate):
+        with self._lock:
+            stats = dict(self.stats)
+            outstanding = self._outstanding
+        logger.info("Load engine: phase=%s rate=%.2f/s outstanding=%s %s", phase.name, rate, outstanding, stats)
+
+    def run(self):
+        logger.info("Load engine starting: phases=%s concurrency=%s max_backlog=%s", self.phases, self.concurrency, self.max_backlog)
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="load") as executor:
+            start = time.monotonic()
+            tick = start
+            credit = 0.0
+            next_report = start + self.report_interval
+            phase_start = start
+            for phase in self.phases:
+                forever = phase.duration == 0
+                phase_end = phase_start + phase.duration
+                while not self._stop.is_set() and (forever or tick < phase_end):
+                    # Accrue send credit in small steps so ramps from a low rate still start on time
+                    rate = phase.rate_at(tick - phase_start)
+                    step = SCHEDULE_TICK if rate <= 0 else min(SCHEDULE_TICK, 1.0 / rate)
+                    credit += rate * step
+                    tick += step
+                    now = time.monotonic()
+                    if tick > now and self._stop.wait(tick - now):
+                        break
+                    while credit >= 1.0:
+                        credit -= 1.0
+                        self._submit(executor, tick)
+                    if tick >= next_report:
+                        self._report(phase, rate)
+                        next_report = tick + self.report_interval
+                if self._stop.is_set():
+                    break
+                phase_start = phase_end
+            self._report(self.phases[-1], 0.0)
+        return dict(self.stats)
+
+
+def run_closed_loop(iteration_fn, interval=DEFAULT_LOOP_INTERVAL, duration=0):
+    """The original mode: one iteration at a time with a fixed pause between them."""
+    deadline = time.monotonic() + duration if duration > 0 else None
+    while deadline is None or time.monotonic() < deadline:
+        iteration_fn(time.monotonic())
+        time.sleep(interval)
+
+
+def parse_args(argv=None):
+    """Read the load settings from CLI flags, falling back to environment variables."""
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description="Warehouse interface load generator")
+    parser.add_argument("--mode", choices=["loop", "open"], default=env("LOAD_MODE", DEFAULT_MODE),
+                        help="loop: one iteration then a fixed pause; open: rate-controlled open loop")
+    parser.add_argument("--interval", type=float, default=float(env("LOOP_INTERVAL", DEFAULT_LOOP_INTERVAL)),
+                        help="Pause between iterations in loop mode (seconds)")
+    parser.add_argument("--rate", type=float, default=float(env("LOAD_RATE", DEFAULT_RATE)),
+                        help="Steady target rate in open mode (iterations/s)")
+    parser.add_argument("--concurrency", type=int, default=int(env("LOAD_CONCURRENCY", DEFAULT_CONCURRENCY)),
+                        help="Maximum iterations in flight in open mode")
+    parser.add_argument("--max-backlog", type=int, default=int(env("LOAD_MAX_BACKLOG", 0)) or None,
+                        help="Iterations allowed to queue behind busy workers before being dropped")
+    parser.add_argument("--duration", type=float, default=float(env("LOAD_DURATION", 0)),
+                        help="Steady phase length in seconds (0 runs forever)")
+    parser.add_argument("--ramp-up", type=float, default=float(env("LOAD_RAMP_UP", 0)),
+                        help="Seconds to ramp linearly from 0 to the target rate")
+    parser.add_argument("--spike-rate", type=float, default=float(env("LOAD_SPIKE_RATE", 0)),
+                        help="Rate during the spike phase in the middle of the steady phase")
+    parser.add_argument("--spike-duration", type=float, default=float(env("LOAD_SPIKE_DURATION", 0)),
+                        help="Length of the spike phase in seconds")
+    parser.add_argument("--phases", default=env("LOAD_PHASES", ""),
+                        help='Explicit profile such as "ramp:30:50,steady:120:50,spike:20:200"; overrides the rate flags')
+    parser.add_argument("--report-interval", type=float,
+                        default=float(env("LOAD_REPORT_INTERVAL", DEFAULT_REPORT_INTERVAL)),
+                        help="Seconds between load engine progress log lines")
+    parser.add_argument("--record", default=env("TRAFFIC_RECORD", ""),
+                        help="Append every iteration's client calls to this capture file (.gz to compress)")
+    parser.add_argument("--replay", default=env("TRAFFIC_REPLAY", ""),
+                        help="Replay this capture file instead of generating traffic")
+    parser.add_argument("--replay-speed", type=float, default=float(env("REPLAY_SPEED", 1.0)),
+                        help="Replay speed multiplier; 0 replays as fast as possible")
+    parser.add_argument("--seed", type=int, default=int(env("RANDOM_SEED")) if env("RANDOM_SEED") else None,
+                        help="Seed for the random order generator")
+    args = parser.parse_args(argv)
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if args.rate < 0:
+        parser.error("--rate must not be negative")
+    if args.replay_speed < 0:
+        parser.error("--replay-speed must not be negative")
+    if args.record and args.replay:
+        parser.error("--record and --replay cannot be combined")
+    return args
+
+
+def run(iteration_fn, args):
+    """Run iteration_fn(intended_start) in the configured mode."""
+    if args.mode == "loop":
+        run_closed_loop(iteration_fn, interval=args.interval, duration=args.duration)
+        return None
+    if args.phases:
+        phases = parse_phases(args.phases)
+    else:
+        phases = build_phases(args.rate, duration=args.duration, ramp_up=args.ramp_up,
+                              spike_rate=args.spike_rate, spike_duration=args.spike_duration)
+    runner = OpenLoopRunner(iteration_fn, phases, concurrency=args.concurrency,
+                            max_backlog=args.max_backlog, report_interval=args.report_interval)
+    return runner.run()
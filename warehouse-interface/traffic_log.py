@@ -0,0 +1,222 @@
+import functools
+import gzip
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# A replayed iteration starting this far behind its recorded time (scaled by speed) is counted as late
+LATE_THRESHOLD = 0.1
+
+# Recordable client calls: name -> (function, index of an order id argument, order id from the result)
+_operations = {}
+_local = threading.local()
+
+
+def _open(path, mode):
+    # Captures ending in .gz are compressed; appending adds a gzip member, which reads back as one stream
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8", buffering=1 if mode == "a" else -1)
+
+
+def _injected_errors(args, kwargs):
+    """Names of fields carrying an injected "error" value, e.g. from generate_random_order."""
+    fields = []
+    for value in list(args) + list(kwargs.values()):
+        if isinstance(value, dict):
+            fields.extend(key for key, item in value.items() if item == "error")
+    return fields
+
+
+def operation(order_id_arg=None, result_order_id=None):
+    """Decorator for a client call that is recorded while a TrafficRecorder runs and can be replayed.
+
+    order_id_arg is the position of an order id argument and result_order_id
+    extracts the order id a call returned. Replay uses them to translate
+    recorded order ids to the ones the live services hand out.
+    """
+    def decorator(fn):
+        _operations[fn.__name__] = (fn, order_id_arg, result_order_id)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            ops = getattr(_local, "ops", None)
+            if ops is None:
+                return fn(*args, **kwargs)
+            entry = {"dt": round(time.monotonic() - _local.started, 6), "op": fn.__name__, "args": list(args)}
+            if kwargs:
+                entry["kwargs"] = kwargs
+            injected = _injected_errors(args, kwargs)
+            if injected:
+                entry["injected"] = injected
+            ops.append(entry)
+            result = fn(*args, **kwargs)
+            if result_order_id:
+                entry["order_id"] = result_order_id(result)
+            return result
+        return wrapper
+    return decorator
+
+
+class TrafficRecorder:
+    """Append every iteration's client calls to an NDJSON capture, one line per iteration.
+
+    A line holds the iteration's intended start relative to the recording
+    session (t) and its operations in call order: offset into the iteration,
+    operation name, arguments and any injected error fields. Each session
+    starts with a header line, so one file can hold several captures.
+    """
+
+    def __init__(self, path, seed=None):
+        self.path = path
+        self.started = time.monotonic()
+        self.iterations = 0
+        self._file = _open(path, "a")
+        self._lock = threading.Lock()
+        self._write({"session": time.time(), "seed": seed})
+        logger.info("Recording traffic to %s", path)
+
+    def _write(self, record, iteration=False):
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._file.write(line)
+            if iteration:
+                self.iterations += 1
+
+    def wrap(self, iteration_fn):
+        """Return iteration_fn(intended_start) with its operations recorded."""
+        def recorded_iteration(intended_start):
+            _local.ops = []
+            _local.started = time.monotonic()
+            try:
+                return iteration_fn(intended_start)
+            finally:
+                ops, _local.ops = _local.ops, None
+                if ops:
+                    self._write({"t": round(intended_start - self.started, 6), "ops": ops}, iteration=True)
+        return recorded_iteration
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        logger.info("Recorded %s iterations to %s", self.iterations, self.path)
+
+
+def read_capture(path):
+    """Yield (session_start, record) for every iteration in a capture, reading it lazily."""
+    session = None
+    with _open(path, "r") as capture:
+        for number, line in enumerate(capture, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning("Skipping malformed line %s of %s", number, path)
+                continue
+            if "session" in record:
+                session = record["session"]
+                continue
+            yield session, record
+
+
+def replay_operations(ops, stats=None):
+    """Run one recorded iteration's operations in order against the live services.
+
+    Order ids returned by the live calls replace the recorded ones in later
+    operations of the same iteration. An operation whose order id has no
+    live counterpart (no order was available this time) is skipped.
+    """
+    ids = {}
+    for entry in ops:
+        name = entry["op"]
+        if name not in _operations:
+            logger.warning("Skipping unknown recorded operation %s", name)
+            _count(stats, "skipped")
+            continue
+        fn, order_id_arg, result_order_id = _operations[name]
+        args = list(entry.get("args", ()))
+        if order_id_arg is not None:
+            recorded_id = args[order_id_arg]
+            if recorded_id not in ids:
+                _count(stats, "skipped")
+                continue
+            args[order_id_arg] = ids[recorded_id]
+        result = fn(*args, **entry.get("kwargs", {}))
+        _count(stats, "operations")
+        if result_order_id and entry.get("order_id") is not None:
+            live_id = result_order_id(result)
+            if live_id is not None:
+                ids[entry["order_id"]] = live_id
+
+
+def _count(stats, key):
+    if stats is not None:
+        stats.add(key)
+
+
+class ReplayStats:
+    def __init__(self):
+        self.counters = {"iterations": 0, "operations": 0, "skipped": 0, "failed": 0, "late": 0}
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        with self._lock:
+            self.counters[key] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+def replay(path, iteration_fn, speed=1.0, concurrency=16):
+    """Replay a capture, streaming it from disk.
+
+    Each recorded iteration is started at its recorded offset divided by
+    speed (speed 0 replays as fast as possible) and handed to
+    iteration_fn(intended_start, ops, stats) on a worker. Iterations run
+    concurrently as they did when recorded, operations within one run in
+    order. At most concurrency iterations are read ahead of the workers, so
+    memory stays flat however long the capture is.
+    """
+    stats = ReplayStats()
+    slots = threading.BoundedSemaphore(concurrency)
+
+    def run(ops, due):
+        try:
+            if speed > 0 and time.monotonic() - due > LATE_THRESHOLD:
+                stats.add("late")
+            iteration_fn(due, ops, stats)
+            stats.add("iterations")
+        except Exception:
+            logger.exception("Replayed iteration failed")
+            stats.add("failed")
+        finally:
+            slots.release()
+
+    logger.info("Replaying %s at %sx with concurrency %s", path, speed or "max", concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="replay") as executor:
+        current_session = object()
+        base = time.monotonic()
+        for session, record in read_capture(path):
+            if session != current_session:
+                # Each recorded session starts its clock from zero
+                current_session = session
+                base = time.monotonic()
+            if speed > 0:
+                due = base + record["t"] / speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                due = time.monotonic()
+            slots.acquire()
+            executor.submit(run, record["ops"], due)
+    result = stats.snapshot()
+    logger.info("Replay of %s finished: %s", path, result)
+    return result
@@ -1,70 +1,56 @@
 import requests
-import time
 import logging
 import os
 import random
 import json
+import socket
+import http_client
+import latency
+import load_engine
+import traffic_log
+from http_client import order_processor, stock_controller
 from opentelemetry import trace
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.requests import RequestsInstrumentor
-from opentelemetry.trace import get_current_span
 from opentelemetry.propagate import set_global_textmap
 from opentelemetry.trace import Status, StatusCode
-
-logging.basicConfig(level=logging.INFO)
-
-def custom_logger(message, level='info'):
-    current_span = get_current_span()
-    if current_span.is_recording():
-        trace_id = current_span.get_span_context().trace_id
-        span_id = current_span.get_span_context().span_id
-        # Convert to hexadecimal format
-        trace_id_hex = "{:032x}".format(trace_id)
-        span_id_hex = "{:016x}".format(span_id)
-    else:
-        trace_id_hex = span_id_hex = 'N/A'
-
-    log_message = f"[TraceID: {trace_id_hex}, SpanID: {span_id_hex}] {message}"
-    
-    if level == 'info':
-        logging.info(log_message)
-    elif level == 'error':
-        logging.error(log_message)
-    elif level == 'warning':
-        logging.warning(log_message)
-    else:
-        logging.debug(log_message)
-
-
-# Get the local otel collector IP
-OTEL_HOST = os.environ.get("OTEL_HOST", default="10.10.0.12:4317")
-if not ":" in OTEL_HOST:
-  OTEL_HOST = OTEL_HOST + ":4317"
-print("OTEL Collector Address: {}".format(OTEL_HOST))
-
-# Create OTLP exporter and point it to the OTEL Collector
-otlp_exporter = OTLPSpanExporter(endpoint=OTEL_HOST, insecure=True)
-
-# Set OTEL service name and set the trace provider
-resource = Resource(
-    attributes={
-        "service.name": "warehouse-interface",
-        "version": "v0.0.1",
-        "service.instance.id": "instance-1",
-        "telemetry.sdk.name":"opentelemetry",
-        "telemetry.sdk.language":"python",
-        "telemetry.sdk.version":"1.19.0"
-    }
-)
-trace.set_tracer_provider(TracerProvider(resource=resource))
-
-# Set up BatchSpanProcessor and add it to the tracer provider
-trace.get_tracer_provider().add_span_processor(
-    BatchSpanProcessor(otlp_exporter)
-)
+from tracey_common.logs import configure_logging
+from tracey_common.serialization import COLUMNAR_MIMETYPE, from_columns, loads
+from tracey_common.telemetry import init_metrics, init_tracing
+
+# Structured JSON logs with trace context, written by a background thread
+configure_logging("warehouse-interface")
+logger = logging.getLogger("warehouse-interface")
+
+
+# Stock flow: "per_product" calls /decreasestock once per product (the trace demo),
+# "batch" applies the whole order with a single /adjuststock call, "fulfil" picks,
+# replenishes and completes the order in one order-processor transaction
+STOCK_FLOW = os.environ.get("STOCK_FLOW", default="per_product")
+# stock-controller replenishes stock in the background; CLIENT_REPLENISHMENT=true restores
+# the original check-and-increase after every pick
+CLIENT_REPLENISHMENT = os.environ.get("CLIENT_REPLENISHMENT", default="false").lower() == "true"
+REPLENISH_THRESHOLD = 100
+REPLENISH_QUANTITY = 100
+
+# Order picking: "checkorders" takes the first unprocessed order and deletes it afterwards,
+# "claim" leases the next order through /claimorders so replicas never pick the same one
+ORDER_PICKING = os.environ.get("ORDER_PICKING", default="checkorders")
+ORDER_LEASE_SECONDS = float(os.environ.get("ORDER_LEASE_SECONDS", default=60))
+WORKER_ID = os.environ.get("WORKER_ID", default=f"{socket.gethostname()}:{os.getpid()}")
+ORDER_PRODUCTS = ("cupboards", "computers", "chairs", "desks")
+# Warehouse this replica works for, which picks the database shard behind the services. Unset, new orders
+# go to the services' DEFAULT_WAREHOUSE_ID and listings and claims span every warehouse; an order's
+# warehouse_id from the response is passed back with later calls about it either way.
+WAREHOUSE_ID = int(os.environ["WAREHOUSE_ID"]) if os.environ.get("WAREHOUSE_ID") else None
+# Ask /checkorders for one array per column rather than an object per order; plain JSON is still understood
+CHECKORDERS_HEADERS = {"Accept": f"{COLUMNAR_MIMETYPE}, application/json;q=0.5"}
+
+# Set up tracing; sampling, BatchSpanProcessor and exporter settings come from the environment
+init_tracing("warehouse-interface")
+
+# Client-side latency histograms, exported as OTLP metrics next to the traces
+init_metrics("warehouse-interface")
+latency.latency_recorder.init_metrics()
 
 # Instrument requests
 RequestsInstrumentor().instrument(
@@ -113,13 +99,28 @@ def generate_random_order():
         'cupboards': random_cupboards()
     }
 
-def delete_order_from_order_processor(order_id):
+def warehouse_scope(warehouse_id):
+    """The warehouse_id parameter for a request, or nothing to leave it to the service."""
+    return {} if warehouse_id is None else {'warehouse_id': warehouse_id}
+
+def first_order_id(response):
+    """The order id in a response from /checkorders, /claimorders or /addorders, for traffic replay."""
+    if isinstance(response, list):
+        response = response[0] if response else None
+    return response.get('order_id') if isinstance(response, dict) else None
+
+@traffic_log.operation(order_id_arg=0)
+@latency.timed("delete_order")
+def delete_order_from_order_processor(order_id, warehouse_id=None):
     """Delete a processed order from the order-processor service."""
     with tracer.start_as_current_span("WarehouseInterface: Delete Order from Processor", kind=trace.SpanKind.CLIENT):
-        url = f"http://order-processor:8080/deleteorders/{order_id}"
 #        headers = inject_tracer_to_request_headers({})
-        response = requests.get(url)
-        custom_logger(f"Attempting to delete order with ID: {order_id}",level='info')
+        try:
+            response = order_processor.get(f"/deleteorders/{order_id}", params=warehouse_scope(warehouse_id), idempotent=True)
+        except requests.RequestException as e:
+            logger.error("Failed to delete order with ID: %s: %s", order_id, e)
+            return None
+        logger.info("Attempting to delete order with ID: %s", order_id)
         
         # Add additional span for HTTP response status
 #        with tracer.start_as_current_span("HTTP Response"):
@@ -129,15 +130,22 @@ def delete_order_from_order_processor(order_id):
 #            current_span.set_status(set_http_status(http_status_code))
 
         if response.status_code != 200:
-            custom_logger(f"Failed to delete order with ID: {order_id}",level='error')
+            logger.error("Failed to delete order with ID: %s", order_id)
             return None
         return response.json()
 
+@traffic_log.operation(result_order_id=first_order_id)
+@latency.timed("check_orders")
 def get_order_from_order_processor():
     with tracer.start_as_current_span("WarehouseInterface: Get Order from Processor", kind=trace.SpanKind.CLIENT):
-        url = "http://order-processor:8080/checkorders"
-        response = requests.get(url)
-        custom_logger(f"Getting orders from Processor",level='info')
+        try:
+            # Only the first unprocessed order is used, so only ask for one
+            response = order_processor.get("/checkorders", params={"limit": 1, **warehouse_scope(WAREHOUSE_ID)},
+                                           headers=CHECKORDERS_HEADERS)
+        except requests.RequestException as e:
+            logger.error("Failed to get orders from Processor: %s", e)
+            return None
+        logger.info("Getting orders from Processor")
 
         # Add additional span for HTTP response status
 #        with tracer.start_as_current_span("HTTP Response"):
@@ -147,19 +155,74 @@ def get_order_from_order_processor():
 #            current_span.set_status(set_http_status(http_status_code))
 
         # Check the content type of the response
-        content_type = response.headers.get('Content-Type')
-        if 'application/json' in content_type:
+        content_type = response.headers.get('Content-Type', '')
+        if COLUMNAR_MIMETYPE in content_type:
+            return from_columns(loads(response.content))
+        elif 'application/json' in content_type:
             return response.json()
         else:
-            custom_logger(f"Unexpected response content type: {content_type}. Content: {response.text}",level='error')
+            logger.error("Unexpected response content type: %s. Content: %s", content_type, response.text)
             return None
 
+@traffic_log.operation(result_order_id=first_order_id)
+@latency.timed("claim_order")
+def claim_order_from_order_processor():
+    """Lease the next unprocessed order, or return None if there is none."""
+    with tracer.start_as_current_span("WarehouseInterface: Claim Order from Processor", kind=trace.SpanKind.CLIENT):
+        try:
+            response = order_processor.post("/claimorders", json={"owner": WORKER_ID, "lease_seconds": ORDER_LEASE_SECONDS,
+                                                                   **warehouse_scope(WAREHOUSE_ID)})
+        except requests.RequestException as e:
+            logger.error("Failed to claim an order from Processor: %s", e)
+            return None
+        if response.status_code == 204:
+            return None
+        if response.status_code != 200:
+            logger.error("Failed to claim an order from Processor: HTTP %s", response.status_code)
+            return None
+        return response.json()
 
+@traffic_log.operation(order_id_arg=0)
+@latency.timed("release_order")
+def release_order_from_order_processor(order_id, action, warehouse_id=None):
+    """Complete or abandon a claimed order; action is "complete" or "abandon"."""
+    with tracer.start_as_current_span(f"WarehouseInterface: {action.capitalize()} Order in Processor", kind=trace.SpanKind.CLIENT):
+        try:
+            response = order_processor.post(f"/{action}orders/{order_id}", json={"owner": WORKER_ID, **warehouse_scope(warehouse_id)})
+        except requests.RequestException as e:
+            logger.error("Failed to %s order with ID: %s: %s", action, order_id, e)
+            return None
+        if response.status_code != 200:
+            logger.error("Failed to %s order with ID: %s: HTTP %s", action, order_id, response.status_code)
+            return None
+        return response.json()
+
+@traffic_log.operation(order_id_arg=0)
+@latency.timed("fulfil_order")
+def fulfil_order_in_order_processor(order_id, delete, warehouse_id=None):
+    """Pick, replenish and complete (or delete) an order server-side in one call."""
+    with tracer.start_as_current_span("WarehouseInterface: Fulfil Order in Processor", kind=trace.SpanKind.CLIENT):
+        try:
+            response = order_processor.post(f"/fulfilorders/{order_id}",
+                                            json={"owner": WORKER_ID, "delete": delete, **warehouse_scope(warehouse_id)})
+        except requests.RequestException as e:
+            logger.error("Failed to fulfil order with ID: %s: %s", order_id, e)
+            return None
+        if response.status_code != 200:
+            logger.error("Failed to fulfil order with ID: %s: HTTP %s", order_id, response.status_code)
+            return None
+        return response.json()
+
+
+@traffic_log.operation(result_order_id=first_order_id)
+@latency.timed("add_order")
 def add_order_to_order_processor(order_data):
     with tracer.start_as_current_span("WarehouseInterface: Add Order to Processor", kind=trace.SpanKind.CLIENT):
-        url = "http://order-processor:8080/addorders"
-        
-        response = requests.post(url, json=order_data)
+        try:
+            response = order_processor.post("/addorders", json={**order_data, **warehouse_scope(WAREHOUSE_ID)})
+        except requests.RequestException as e:
+            logger.error("Failed to add order to Processor: %s", e)
+            return None
 
 #        with tracer.start_as_current_span("HTTP Response"):
 #            http_status_code = response.status_code
@@ -168,26 +231,31 @@ def add_order_to_order_processor(order_data):
 #            current_span.set_status(set_http_status(http_status_code))
 
         if response.status_code == 201:
-            custom_logger(f"Order was added.",level='info')
+            logger.info("Order was added.")
 
         # Check if the response has content before attempting to parse it as JSON
         if response.text.strip():
             try:
                 return response.json()
             except json.decoder.JSONDecodeError:
-                custom_logger(f"Failed to decode JSON from response. Content: {response.text}",level='error')
+                logger.error("Failed to decode JSON from response. Content: %s", response.text)
                 return None
         else:
-            custom_logger(f"Received an empty response from the server.",level='warning')
+            logger.warning("Received an empty response from the server.")
             return None
 
 
-def check_stock_from_stock_processor(product):
+@traffic_log.operation()
+@latency.timed("check_stock")
+def check_stock_from_stock_processor(product, warehouse_id=None):
     with tracer.start_as_current_span("WarehouseInterface: Check Stock from stock-controller", kind=trace.SpanKind.CLIENT):
-        url = f"http://stock-controller:8081/checkstock?product={product}"
   #      headers = inject_tracer_to_request_headers({})
-        response = requests.get(url)
-        custom_logger(f"Checking stock for product {product}.",level='info')
+        try:
+            response = stock_controller.get("/checkstock", params={"product": product, **warehouse_scope(warehouse_id)})
+        except requests.RequestException as e:
+            logger.error("Failed to check stock for %s: %s", product, e)
+            return None
+        logger.info("Checking stock for product %s.", product)
         
 #        with tracer.start_as_current_span("HTTP Response"):
 #            http_status_code = response.status_code
@@ -196,20 +264,26 @@ def check_stock_from_stock_processor(product):
 #            current_span.set_status(set_http_status(http_status_code))
 
         if response.status_code != 200:
-            custom_logger(f"Failed to check stock for {product}.",level='error')
+            logger.error("Failed to check stock for %s.", product)
             return None
         return response.json()
 
-def increase_stock_from_stock_processor(product, quantity):
+@traffic_log.operation()
+@latency.timed("increase_stock")
+def increase_stock_from_stock_processor(product, quantity, warehouse_id=None):
     with tracer.start_as_current_span("WarehouseInterface: Increase Stock from stock-controller", kind=trace.SpanKind.CLIENT):
-        url = "http://stock-controller:8081/increasestock"
         data = {
             'product': product,
-            'quantity': quantity
+            'quantity': quantity,
+            **warehouse_scope(warehouse_id)
         }
 
-        response = requests.post(url, json=data)
-        custom_logger(f"Attempting to increase stock for {product} by {quantity}",level='info')
+        try:
+            response = stock_controller.post("/increasestock", json=data)
+        except requests.RequestException as e:
+            logger.error("Failed to increase stock for %s: %s", product, e)
+            return None
+        logger.info("Attempting to increase stock for %s by %s", product, quantity)
 
         
 #        with tracer.start_as_current_span("HTTP Response"):
@@ -219,20 +293,26 @@ def increase_stock_from_stock_processor(product, quantity):
 #            current_span.set_status(set_http_status(http_status_code))
 
         if response.status_code != 200:
-            custom_logger(f"Failed to increase stock for {product}",level='error')
+            logger.error("Failed to increase stock for %s", product)
             return None
         return response.json()
 
-def decrease_stock_from_stock_processor(product, quantity):
+@traffic_log.operation()
+@latency.timed("decrease_stock")
+def decrease_stock_from_stock_processor(product, quantity, warehouse_id=None):
     with tracer.start_as_current_span("WarehouseInterface: Decrease Stock from stock-controller", kind=trace.SpanKind.CLIENT):
-        url = "http://stock-controller:8081/decreasestock"
         data = {
             'product': product,
-            'quantity': quantity
+            'quantity': quantity,
+            **warehouse_scope(warehouse_id)
         }
 #        headers = inject_tracer_to_request_headers({})
-        response = requests.post(url, json=data)
-        custom_logger(f"Attempting to decrease stock for {product} by {quantity}",level='info')
+        try:
+            response = stock_controller.post("/decreasestock", json=data)
+        except requests.RequestException as e:
+            logger.error("Failed to decrease stock for %s: %s", product, e)
+            return None
+        logger.info("Attempting to decrease stock for %s by %s", product, quantity)
         
 #        with tracer.start_as_current_span("HTTP Response"):
 #            http_status_code = response.status_code
@@ -241,54 +321,165 @@ def decrease_stock_from_stock_processor(product, quantity):
 #            current_span.set_status(set_http_status(http_status_code))
 
         if response.status_code != 200:
-            custom_logger(f"Failed to decrease stock for {product}",level='error')
+            logger.error("Failed to decrease stock for %s", product)
             return None
         return response.json()
 
-if __name__ == "__main__":
-    while True:
-        with tracer.start_as_current_span("Warehouse Interface: Processing Interation", kind=trace.SpanKind.CLIENT):
-            # Generate a random order
-            order = generate_random_order()
-            
-            # Add each product and its quantity to the order-processor
-            add_order_to_order_processor(order)
-
-            # Retrieve an unprocessed order
-            response = get_order_from_order_processor()
-
-            if response:
-                if isinstance(response, list):
-                    # Assuming the first element contains what you need; adjust if needed
-                    first_order = response[0] if response else None
-                    order_id = first_order.get('order_id', None) if first_order else None
-                elif isinstance(response, dict):
-                    order_id = response.get('order_id', None)
-                else:
-                    custom_logger("Unknown response type",level='error')
-                    order_id = None
-
-                if order_id:
-                    # Decrease stock after retrieving order
-                    for product, quantity in order.items():
-                        stock_response = decrease_stock_from_stock_processor(product, quantity)
-                        if stock_response and 'error' in stock_response:
-                            logging.error(f"Failed to decrease stock for {product}")
-                        else:
-                            # Check current stock quantity after decrease
-                            current_stock = check_stock_from_stock_processor(product)
-                            if current_stock and current_stock['quantity'] < 100:
-                                increase_stock_from_stock_processor(product, 100)
-                            logging.info(f"Picked up order: {order_id} - {product} (Quantity: {quantity})")
-
-                    # Delete the order if it is processed
-                    delete_order_response = delete_order_from_order_processor(order_id)
-                    if delete_order_response:
-                        custom_logger("Deleted processed order with ID: {order_id}",level='info')
-                else:
-                    custom_logger("No order_id found in the response",level='error')
+@traffic_log.operation()
+@latency.timed("adjust_stock")
+def adjust_stock_from_stock_processor(deltas, all_or_nothing=False, warehouse_id=None):
+    with tracer.start_as_current_span("WarehouseInterface: Adjust Stock from stock-controller", kind=trace.SpanKind.CLIENT):
+        data = {
+            'adjustments': [{'product': product, 'delta': delta} for product, delta in deltas.items()],
+            'all_or_nothing': all_or_nothing,
+            **warehouse_scope(warehouse_id)
+        }
+        try:
+            response = stock_controller.post("/adjuststock", json=data)
+        except requests.RequestException as e:
+            logger.error("Failed to adjust stock %s: %s", deltas, e)
+            return None
+        logger.info("Attempting to adjust stock %s", deltas)
+
+        if response.status_code != 200:
+            logger.error("Failed to adjust stock %s: HTTP %s", deltas, response.status_code)
+            return None
+        return response.json()
+
+def pick_stock_per_product(order_id, order, warehouse_id=None):
+    for product, quantity in order.items():
+        stock_response = decrease_stock_from_stock_processor(product, quantity, warehouse_id)
+        if stock_response and 'error' in stock_response:
+            logger.error("Failed to decrease stock for %s", product)
+        else:
+            if CLIENT_REPLENISHMENT:
+                # The decrease returns the new quantity; only read it back if it didn't
+                remaining = stock_response.get('quantity') if stock_response else None
+                if remaining is None:
+                    current_stock = check_stock_from_stock_processor(product, warehouse_id)
+                    remaining = current_stock['quantity'] if current_stock else None
+                if remaining is not None and remaining < REPLENISH_THRESHOLD:
+                    increase_stock_from_stock_processor(product, REPLENISH_QUANTITY, warehouse_id)
+            logger.info("Picked up order: %s - %s (Quantity: %s)", order_id, product, quantity)
+
+def pick_stock_batch(order_id, order, warehouse_id=None):
+    # Injected "error" quantities are passed through for the stock-controller to reject
+    deltas = {product: -quantity if isinstance(quantity, int) else quantity for product, quantity in order.items()}
+    stock_response = adjust_stock_from_stock_processor(deltas, warehouse_id=warehouse_id)
+    if not stock_response:
+        return
+    if CLIENT_REPLENISHMENT:
+        low_stock = {product: REPLENISH_QUANTITY for product, remaining in stock_response['quantities'].items()
+                     if remaining < REPLENISH_THRESHOLD}
+        if low_stock:
+            adjust_stock_from_stock_processor(low_stock, warehouse_id=warehouse_id)
+    logger.info("Picked up order: %s - %s", order_id, order)
+
+def pick_stock(order_id, order, warehouse_id=None):
+    if STOCK_FLOW == "batch":
+        pick_stock_batch(order_id, order, warehouse_id)
+    else:
+        pick_stock_per_product(order_id, order, warehouse_id)
+
+def process_claimed_order():
+    """Claim the next order, pick its stock and mark it processed; abandon it if picking fails."""
+    claimed = claim_order_from_order_processor()
+    if not claimed:
+        logger.info("No more orders to pick up")
+        return
+    order_id = claimed['order_id']
+    warehouse_id = claimed.get('warehouse_id')
+    if STOCK_FLOW == "fulfil":
+        if fulfil_order_in_order_processor(order_id, delete=False, warehouse_id=warehouse_id):
+            logger.info("Completed processed order with ID: %s", order_id)
+        else:
+            release_order_from_order_processor(order_id, "abandon", warehouse_id)
+        return
+    order = {product: claimed[product] for product in ORDER_PRODUCTS}
+    try:
+        pick_stock(order_id, order, warehouse_id)
+    except Exception:
+        logger.exception("Failed to pick order %s, releasing it", order_id)
+        release_order_from_order_processor(order_id, "abandon", warehouse_id)
+        raise
+    if release_order_from_order_processor(order_id, "complete", warehouse_id):
+        logger.info("Completed processed order with ID: %s", order_id)
+
+def process_iteration(intended_start=None):
+    """Run one warehouse iteration: add an order, pick an order, move stock and delete it."""
+    with tracer.start_as_current_span("Warehouse Interface: Processing Interation", kind=trace.SpanKind.CLIENT):
+        # Generate a random order
+        order = generate_random_order()
+
+        # Add each product and its quantity to the order-processor
+        add_order_to_order_processor(order)
+
+        if ORDER_PICKING == "claim":
+            process_claimed_order()
+            return
+
+        # Retrieve an unprocessed order
+        response = get_order_from_order_processor()
+
+        if response:
+            if isinstance(response, list):
+                # Assuming the first element contains what you need; adjust if needed
+                first_order = response[0] if response else None
+                order_id = first_order.get('order_id', None) if first_order else None
+                warehouse_id = first_order.get('warehouse_id', None) if first_order else None
+            elif isinstance(response, dict):
+                order_id = response.get('order_id', None)
+                warehouse_id = response.get('warehouse_id', None)
             else:
-                custom_logger("No more orders to pick up",level='info')
-            
-        # Wait for 10 seconds before the next iteration
-        time.sleep(10)
\ No newline at end of file
+                logger.error("Unknown response type")
+                order_id = None
+
+            if order_id and STOCK_FLOW == "fulfil":
+                fulfilled = fulfil_order_in_order_processor(order_id, delete=True, warehouse_id=warehouse_id)
+                if fulfilled:
+                    logger.info("Fulfilled and deleted order with ID: %s. Quantities: %s", order_id, fulfilled['quantities'])
+            elif order_id:
+                # Decrease stock after retrieving order
+                pick_stock(order_id, order, warehouse_id)
+
+                # Delete the order if it is processed
+                delete_order_response = delete_order_from_order_processor(order_id, warehouse_id)
+                if delete_order_response:
+                    logger.info("Deleted processed order with ID: %s", order_id)
+            else:
+                logger.error("No order_id found in the response")
+        else:
+            logger.info("No more orders to pick up")
+
+def replay_iteration(intended_start, ops, stats):
+    """Replay one recorded iteration under the same span as a live one."""
+    with tracer.start_as_current_span("Warehouse Interface: Processing Interation", kind=trace.SpanKind.CLIENT):
+        traffic_log.replay_operations(ops, stats)
+
+if __name__ == "__main__":
+    http_client.start_stats_reporter(float(os.environ.get("HTTP_STATS_INTERVAL", default=60)))
+    args = load_engine.parse_args()
+    if args.seed is not None:
+        # The same seed generates the same orders and injected errors (in loop mode, where one thread draws them)
+        random.seed(args.seed)
+
+    # Every call and iteration is timed from its intended start; percentiles are logged every LATENCY_REPORT_INTERVAL
+    latency.latency_recorder.start_reporter()
+
+    if args.replay:
+        # Rerun a recorded capture instead of generating traffic
+        traffic_log.replay(args.replay, latency.track_iteration(replay_iteration), speed=args.replay_speed,
+                           concurrency=args.concurrency)
+    else:
+        iteration = latency.track_iteration(process_iteration)
+        recorder = None
+        if args.record:
+            recorder = traffic_log.TrafficRecorder(args.record, seed=args.seed)
+            iteration = recorder.wrap(iteration)
+        try:
+            # LOAD_MODE=loop keeps the original one-iteration-every-10-seconds behaviour,
+            # LOAD_MODE=open drives iterations at a target rate with a worker pool
+            load_engine.run(iteration, args)
+        finally:
+            if recorder:
+                recorder.close()